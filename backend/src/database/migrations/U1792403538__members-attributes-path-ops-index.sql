@@ -0,0 +1 @@
+DROP INDEX IF EXISTS "ix_members_attributes_path_ops";
@@ -0,0 +1 @@
+DROP INDEX IF EXISTS "ix_members_tenantId_createdAt_id";
@@ -0,0 +1 @@
+DROP INDEX IF EXISTS "ix_activities_tenantId_updatedAt";
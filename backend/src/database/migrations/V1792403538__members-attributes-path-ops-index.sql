@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_members_attributes_path_ops" ON members USING gin (attributes jsonb_path_ops);
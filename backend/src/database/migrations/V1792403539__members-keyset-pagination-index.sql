@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_members_tenantId_createdAt_id" ON members ("tenantId", "createdAt", id);
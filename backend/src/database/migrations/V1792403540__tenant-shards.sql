@@ -0,0 +1,8 @@
+-- Database each tenant lives in, read by the python workers when DB_SHARD_LOOKUP is enabled.
+-- Tenants without a row live in the default database.
+CREATE TABLE IF NOT EXISTS "tenantShards" (
+    "tenantId" UUID PRIMARY KEY,
+    "shard" VARCHAR(255) NOT NULL,
+    "createdAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    "updatedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
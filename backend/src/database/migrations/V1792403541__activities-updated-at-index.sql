@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_activities_tenantId_updatedAt" ON activities ("tenantId", "updatedAt");
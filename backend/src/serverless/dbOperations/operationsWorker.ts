@@ -4,6 +4,9 @@ import ActivityService from '../../services/activityService'
 import IntegrationService from '../../services/integrationService'
 import MicroserviceService from '../../services/microserviceService'
 import { IServiceOptions } from '../../services/IServiceOptions'
+import { KUBE_MODE } from '../../conf'
+import { sendPythonWorkerMessage } from '../utils/pythonWorkerSQS'
+import { PythonWorkerMessageType } from '../types/workerTypes'
 
 /**
  * Update a bulk of members
@@ -44,10 +47,32 @@ async function upsertActivityWithMembers(
   fireGitmeshWebhooks: boolean = true,
 ): Promise<any> {
   const activityService = new ActivityService(options)
+  const activities = []
 
   while (records.length > 0) {
     const record = records.shift()
-    await activityService.createWithMember(record, fireGitmeshWebhooks)
+    const activity = await activityService.createWithMember(record, fireGitmeshWebhooks)
+    activities.push({
+      memberId: activity.memberId,
+      timestamp: activity.timestamp,
+      score: activity.score,
+      platform: activity.platform,
+      sourceId: activity.sourceId,
+    })
+  }
+
+  // The python worker updates the online members scores with them
+  if (KUBE_MODE && activities.length > 0) {
+    try {
+      await sendPythonWorkerMessage(options.currentTenant.id, {
+        type: PythonWorkerMessageType.MEMBERS_SCORE_ONLINE,
+        tenant: options.currentTenant.id,
+        records: activities,
+      })
+    } catch (err) {
+      // The next members score batch run scores them anyway
+      options.log.error(err, 'Error while sending the activities to the python worker!')
+    }
   }
 }
 
@@ -0,0 +1,67 @@
+"""
+Benchmark of the nested JSONB filters of the Repository.
+
+For every JsonbOperators value, runs EXPLAIN ANALYZE of the team member query
+before and after creating the matching index, and prints the plan change.
+The indexes are created on the given database and dropped afterwards, so never point it to production.
+
+Usage:
+    python benchmarks/jsonb_filters.py <tenant_id> <db_url>
+"""
+import sys
+import time
+
+from sqlalchemy import text
+
+from gitmesh.backend.enums import JsonbOperators
+from gitmesh.backend.models import Member
+from gitmesh.backend.repository import Repository
+
+QUERY = {"attributes.isTeamMember.default": True}
+
+
+def explain(repository, jsonb_operator):
+    """
+    EXPLAIN ANALYZE the find_all query for the given operator
+
+    Returns:
+        (list, float): the plan lines and the execution time in ms
+    """
+    with repository.Session() as session:
+        search_query = repository._filter(
+            session.query(Member), Member, {**QUERY, "tenantId": repository.tenant_id}, jsonb_operator
+        )
+        compiled = search_query.statement.compile(dialect=repository.engine.dialect)
+        params = {
+            key: compiled._bind_processors[key](value) if key in compiled._bind_processors else value
+            for key, value in compiled.params.items()
+        }
+        with repository.engine.connect() as con:
+            start = time.time()
+            plan = [row[0] for row in con.exec_driver_sql("EXPLAIN ANALYZE " + compiled.string, params)]
+            return plan, (time.time() - start) * 1000
+
+
+def main(tenant_id, db_url):
+    repository = Repository(tenant_id, db_url)
+
+    for jsonb_operator in JsonbOperators:
+        before, before_ms = explain(repository, jsonb_operator)
+        name = f"bench_{jsonb_operator.name.lower()}"
+        repository.create_jsonb_index(Member, "attributes.isTeamMember.default", jsonb_operator, name=name)
+        with repository.engine.connect().execution_options(postgresql_readonly=False) as con:
+            con.execute(text("ANALYZE members"))
+        after, after_ms = explain(repository, jsonb_operator)
+
+        print(f"{jsonb_operator.name}: {before_ms:.1f}ms -> {after_ms:.1f}ms")
+        print(f"  before: {before[0]}")
+        print(f"  after:  {after[0]}")
+
+        with repository.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT", postgresql_readonly=False
+        ) as con:
+            con.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
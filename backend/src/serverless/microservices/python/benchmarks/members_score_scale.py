@@ -0,0 +1,202 @@
+"""
+Scale benchmark of MembersScore.
+
+For every tenant size, bulk loads a synthetic tenant with synthetic_data.copy_tenant, runs MembersScore.main
+without sending the scores, and times its phases separately: fetch_scores, _member_scores_, normalise and
+publishing (building the update messages of the changed scores). The peak memory allocated during every phase
+is traced with tracemalloc, which slows the Python heavy phases down, --no-memory times them without it.
+The results are written as JSON, and compared with the results of a previous run, e.g. of another commit.
+The tenants are created on the given database and dropped afterwards, so never point it to production.
+
+Usage:
+    python benchmarks/members_score_scale.py <db_url> [--sizes 1000,10000,100000,1000000]
+        [--activities-per-member 10] [--output members_score_scale.json] [--compare previous.json]
+        [--no-memory] [--keep]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from unittest import mock
+
+from gitmesh.backend.repository import Repository
+from gitmesh.members_score import members_score as members_score_module
+from gitmesh.members_score.members_score import MembersScore
+
+from synthetic_data import copy_tenant, drop_tenants
+
+PHASES = ["fetch_scores", "_member_scores_", "normalise", "publish"]
+
+
+class Profiler(object):
+    """
+    Seconds and peak traced memory of named phases.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            result = self.phases.setdefault(name, {"seconds": 0.0})
+            result["seconds"] = round(result["seconds"] + time.perf_counter() - start, 4)
+            if self.memory:
+                peak_mb = (tracemalloc.get_traced_memory()[1] - before) / 2**20
+                result["peak_mb"] = round(max(result.get("peak_mb", 0.0), peak_mb), 2)
+
+
+class ProfiledMembersScore(MembersScore):
+    """
+    MembersScore timing its phases with a Profiler.
+    """
+
+    def __init__(self, *args, profiler, **kwargs):
+        self.profiler = profiler
+        super().__init__(*args, **kwargs)
+
+    def fetch_scores(self):
+        with self.profiler.phase("fetch_scores"):
+            super().fetch_scores()
+
+    def _member_scores_(self, members):
+        with self.profiler.phase("_member_scores_"):
+            return super()._member_scores_(members)
+
+    def normalise(self, scores):
+        with self.profiler.phase("normalise"):
+            return super().normalise(scores)
+
+
+def benchmark(db_url, members, activities_per_member, memory=True, keep=False):
+    """
+    Load a synthetic tenant and benchmark MembersScore on it
+
+    Args:
+        db_url (str): the database url
+        members (int): members of the tenant
+        activities_per_member (int): mean activities per member
+        memory (bool, optional): trace the peak memory of the phases. Defaults to True.
+        keep (bool, optional): keep the tenant in the database. Defaults to False.
+
+    Returns:
+        dict: {"members", "activities", "load_seconds", "phases": {phase: {"seconds", "peak_mb"}}}
+    """
+    repository = Repository(db_url=db_url)
+    start = time.perf_counter()
+    tenant_id, activities = copy_tenant(repository.engine, members, activities_per_member)
+    result = {"members": members, "activities": activities, "load_seconds": round(time.perf_counter() - start, 2)}
+
+    profiler = Profiler(memory)
+    publish = members_score_module.publish_with_checkpoint
+
+    @wraps(publish)
+    def profiled_publish(*args, **kwargs):
+        with profiler.phase("publish"):
+            return publish(*args, **kwargs)
+
+    repository.set_tenant_id(tenant_id)
+    if memory:
+        tracemalloc.start()
+    try:
+        with mock.patch.object(members_score_module, "publish_with_checkpoint", profiled_publish):
+            with profiler.phase("main"):
+                ProfiledMembersScore(tenant_id, repository, send=False, profiler=profiler).main()
+    finally:
+        if memory:
+            tracemalloc.stop()
+        if not keep:
+            drop_tenants(repository.engine, [tenant_id])
+
+    result["phases"] = {name: profiler.phases[name] for name in PHASES + ["main"] if name in profiler.phases}
+    return result
+
+
+def compare(results, previous):
+    """
+    Lines comparing the phase times of two runs
+
+    Args:
+        results (dict): the results of this run
+        previous (dict): the results of a previous run
+
+    Returns:
+        [str]: one line per size and phase they both have
+    """
+    lines = []
+    for size, result in results["sizes"].items():
+        before = previous.get("sizes", {}).get(size)
+        if before is None:
+            continue
+        for name, phase in result["phases"].items():
+            if name not in before["phases"]:
+                continue
+            seconds = before["phases"][name]["seconds"]
+            ratio = phase["seconds"] / seconds if seconds else float("inf")
+            lines.append(f"{size:>8} {name:<16} {seconds:>10.3f}s -> {phase['seconds']:>10.3f}s  x{ratio:.2f}")
+    return lines
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Scale benchmark of MembersScore")
+    parser.add_argument("db_url")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--activities-per-member", type=int, default=10)
+    parser.add_argument("--output", default="members_score_scale.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--keep", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = {
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "memory": not args.no_memory,
+        "sizes": {},
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        result = benchmark(args.db_url, size, args.activities_per_member, not args.no_memory, args.keep)
+        results["sizes"][str(size)] = result
+        print(
+            f"{size} members: " + ", ".join(f"{name} {phase['seconds']}s" for name, phase in result["phases"].items())
+        )
+
+    # Peak resident memory of the whole run, in MB on Linux where ru_maxrss is in KB
+    results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,222 @@
+"""
+Query plan regression harness.
+
+Records the SQL a piece of code sends through a Repository engine, runs EXPLAIN (ANALYZE, BUFFERS)
+on every recorded statement and compares the plans with a stored baseline.
+
+A plan is a regression when it sequentially scans a large table, or when its execution time grew past
+the tolerance. Plan shape changes alone are reported but do not fail, the planner is allowed to pick
+another index.
+"""
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from gitmesh.backend.repository.instrumentation import fingerprint
+
+# Tables with at least this many rows must not be scanned sequentially
+LARGE_TABLE_ROWS = int(os.environ.get("PLAN_LARGE_TABLE_ROWS", 10000))
+# A statement may be this much slower than its baseline (0.5 is 50%)...
+TIME_TOLERANCE = float(os.environ.get("PLAN_TIME_TOLERANCE", 0.5))
+# ...and always this many milliseconds, so that sub-millisecond statements do not fail on noise
+TIME_SLACK_MS = float(os.environ.get("PLAN_TIME_SLACK_MS", 5))
+# Each statement is explained this many times and the fastest run is kept
+EXPLAIN_RUNS = int(os.environ.get("PLAN_EXPLAIN_RUNS", 3))
+
+# Statements that read data. Connection setup queries like select pg_catalog.version() have no from clause.
+EXPLAINABLE = re.compile(r"^\s*(?:execute\b|(?:select|with)\b.*\bfrom\b)", re.IGNORECASE | re.DOTALL)
+PREPARED_NAME = re.compile(r"^\s*execute\s+(\w+)", re.IGNORECASE)
+
+
+class PlanRecorder(object):
+    """
+    Records the statements executed by an engine while recording() is active.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self._recording = False
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._recording and not executemany and EXPLAINABLE.match(statement):
+            self.statements.append((statement, parameters))
+
+    @contextmanager
+    def recording(self):
+        self.statements = []
+        self._recording = True
+        try:
+            yield self
+        finally:
+            self._recording = False
+
+    def close(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+
+
+def explain(engine, statement, parameters, runs=EXPLAIN_RUNS):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) a statement recorded at the cursor level
+
+    Args:
+        engine (Engine): the engine the statement was recorded on
+        statement (str): the DBAPI statement
+        parameters (dict|tuple): its DBAPI parameters
+        runs (int, optional): number of runs, the fastest one is returned. Defaults to EXPLAIN_RUNS.
+
+    Returns:
+        dict: the JSON plan, with "Plan" and "Execution Time"
+    """
+    from gitmesh.backend.repository.queries import QUERIES
+
+    best = None
+    with engine.connect() as con, con.begin():
+        # EXECUTE of a named query needs the statement to be prepared on this connection
+        prepared = PREPARED_NAME.match(statement)
+        if prepared and prepared.group(1) in QUERIES:
+            names = con.connection.info.setdefault("prepared_statements", set())
+            if prepared.group(1) not in names:
+                con.exec_driver_sql(QUERIES[prepared.group(1)].prepare_sql)
+                names.add(prepared.group(1))
+
+        for _ in range(runs):
+            plan = con.exec_driver_sql(
+                "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters or None
+            ).scalar()[0]
+            if best is None or plan["Execution Time"] < best["Execution Time"]:
+                best = plan
+    return best
+
+
+def nodes(plan):
+    """
+    All the nodes of a plan, depth first
+
+    Args:
+        plan (dict): a plan node, like explain(...)["Plan"]
+
+    Returns:
+        [dict]: the nodes
+    """
+    found = [plan]
+    for child in plan.get("Plans", []):
+        found.extend(nodes(child))
+    return found
+
+
+def plan_fingerprint(plan):
+    """
+    The shape of a plan: node types, with the relations and indexes they read, but no costs or row counts.
+
+    Args:
+        plan (dict): a plan node
+
+    Returns:
+        str: the fingerprint. Example: Aggregate(Index Scan using ix_members_score on members)
+    """
+    label = plan["Node Type"]
+    if plan.get("Index Name"):
+        label += f" using {plan['Index Name']}"
+    if plan.get("Relation Name"):
+        label += f" on {plan['Relation Name']}"
+    children = [plan_fingerprint(child) for child in plan.get("Plans", [])]
+    return f"{label}({', '.join(children)})" if children else label
+
+
+def table_sizes(engine):
+    """
+    Estimated number of rows of every table
+
+    Returns:
+        dict: {table: rows}
+    """
+    with engine.connect() as con:
+        rows = con.exec_driver_sql("select relname, reltuples from pg_class where relkind in ('r', 'm', 'p')")
+        return {name: int(tuples) for name, tuples in rows}
+
+
+def summarise(engine, statements):
+    """
+    Explain recorded statements, grouping those with the same SQL fingerprint
+
+    Args:
+        engine (Engine): the engine the statements were recorded on
+        statements ([(str, dict)]): statements and parameters, as recorded by a PlanRecorder
+
+    Returns:
+        dict: {sql fingerprint: {"plan", "execution_ms", "buffers", "seq_scans"}}.
+              Statements executed more than once add up their execution times.
+    """
+    summary = {}
+    for statement, parameters in statements:
+        plan = explain(engine, statement, parameters)
+        root = plan["Plan"]
+        key = fingerprint(statement)
+        entry = summary.setdefault(
+            key,
+            {
+                "plan": plan_fingerprint(root),
+                "execution_ms": 0.0,
+                "buffers": 0,
+                "seq_scans": sorted({node["Relation Name"] for node in nodes(root) if node["Node Type"] == "Seq Scan"}),
+            },
+        )
+        entry["execution_ms"] = round(entry["execution_ms"] + plan["Execution Time"], 3)
+        entry["buffers"] += root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+    return summary
+
+
+def regressions(summary, baseline, sizes, allow_seq_scan=()):
+    """
+    Compare the summary of a case with its baseline
+
+    Args:
+        summary (dict): the output of summarise
+        baseline (dict): a previous output of summarise, or {} if there is none
+        sizes (dict): the output of table_sizes
+        allow_seq_scan (iterable, optional): tables this case may scan sequentially
+
+    Returns:
+        ([str], [str]): the regressions, that must fail the harness, and the plan changes, that are only reported
+    """
+    failures, changes = [], []
+    for key, entry in summary.items():
+        for table in entry["seq_scans"]:
+            if sizes.get(table, 0) >= LARGE_TABLE_ROWS and table not in allow_seq_scan:
+                failures.append(f"Sequential scan on {table} ({sizes[table]} rows): {key}\n  {entry['plan']}")
+
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+
+        limit = max(previous["execution_ms"] * (1 + TIME_TOLERANCE), previous["execution_ms"] + TIME_SLACK_MS)
+        if entry["execution_ms"] > limit:
+            failures.append(
+                f"Slower: {previous['execution_ms']}ms -> {entry['execution_ms']}ms (limit {limit:.1f}ms): {key}"
+            )
+        if entry["plan"] != previous["plan"]:
+            changes.append(f"Plan changed: {key}\n  before: {previous['plan']}\n  after:  {entry['plan']}")
+    return failures, changes
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, baseline):
+    baseline = {
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        **{case: summary for case, summary in sorted(baseline.items()) if case != "generatedAt"},
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
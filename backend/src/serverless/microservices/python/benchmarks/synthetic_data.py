@@ -0,0 +1,271 @@
+"""
+Synthetic tenants for the query plan harness and the benchmarks.
+
+seed_tenants generates the rows in Postgres itself (generate_series), so seeding does not ship them over the network.
+copy_tenant generates them in NumPy and bulk loads them with COPY, for the tenants of millions of members and
+activities of the scale benchmarks, with more realistic activity dates and types.
+Activity counts per member are skewed like in real communities: most members have a few activities,
+a handful have most of them.
+"""
+import io
+import json
+import uuid
+
+import numpy as np
+from sqlalchemy import text
+
+# Share of the activities of every type, and their score, in the tenants of copy_tenant
+ACTIVITY_TYPES = {
+    "issue-comment": (0.45, 6),
+    "pull_request-opened": (0.2, 10),
+    "issues-opened": (0.15, 8),
+    "star": (0.15, 2),
+    "fork": (0.05, 4),
+}
+
+
+def write_connection(engine):
+    """
+    A connection that can write, the repository engines default to read only transactions
+
+    Args:
+        engine (Engine): the engine
+
+    Returns:
+        Connection: the connection, to be used as a context manager
+    """
+    return engine.connect().execution_options(
+        isolation_level="READ COMMITTED", postgresql_readonly=False, postgresql_deferrable=False
+    )
+
+
+def seed_tenants(engine, tenants=1, members=1000, activities_per_member=10, days=400, seed=0.42):
+    """
+    Create synthetic tenants, with their members, activities and a members score microservice
+
+    Args:
+        engine (Engine): the engine
+        tenants (int, optional): number of tenants. Defaults to 1.
+        members (int, optional): members per tenant. Defaults to 1000.
+        activities_per_member (int, optional): mean activities per member. Defaults to 10.
+        days (int, optional): activities are spread over this many past days. Defaults to 400.
+        seed (float, optional): seed of random(), between -1 and 1, so that runs get the same data. Defaults to 0.42.
+
+    Returns:
+        [str]: the ids of the tenants
+    """
+    tenant_ids = [str(uuid.uuid4()) for _ in range(tenants)]
+
+    with write_connection(engine) as con, con.begin():
+        con.execute(text("select setseed(:seed)"), {"seed": seed})
+        for tenant_id in tenant_ids:
+            params = {
+                "tenant_id": tenant_id,
+                "members": members,
+                "activities_per_member": activities_per_member,
+                "days": days,
+            }
+            con.execute(
+                text(
+                    """insert into tenants (id, name, url, plan, "createdAt", "updatedAt")
+                    values (:tenant_id, 'synthetic', left(:tenant_id, 50), 'Essential', now(), now())"""
+                ),
+                params,
+            )
+            con.execute(
+                text(
+                    """insert into microservices (id, init, running, type, variant, "tenantId", "createdAt", "updatedAt")
+                    values (gen_random_uuid(), false, false, 'members_score', 'default', :tenant_id, now(), now())"""
+                ),
+                params,
+            )
+            # One in twenty members is a team member
+            con.execute(
+                text(
+                    """insert into members (id, "displayName", attributes, emails, score, "joinedAt", "createdAt",
+                        "updatedAt", "tenantId")
+                    select gen_random_uuid(), 'member ' || i,
+                        jsonb_build_object('isTeamMember', jsonb_build_object('default', i % 20 = 0)),
+                        case when i % 3 = 0 then array['member' || i || '@example.com'] else array[]::text[] end,
+                        -1, now() - random() * make_interval(days => :days),
+                        now() - random() * make_interval(days => :days), now(), :tenant_id
+                    from generate_series(1, :members) i"""
+                ),
+                params,
+            )
+            # Pareto-like activity counts: floor(mean * 0.5 / u^0.5) has the requested mean on average
+            con.execute(
+                text(
+                    """insert into activities (id, type, "timestamp", platform, score, "sourceId", "importHash",
+                        username, "createdAt", "updatedAt", "memberId", "tenantId")
+                    select gen_random_uuid(),
+                        (array['star', 'fork', 'issues-opened', 'issue-comment', 'pull_request-opened'])[1 + (n % 5)],
+                        now() - random() * make_interval(days => :days), 'github',
+                        (array[2, 4, 8, 6, 10])[1 + (n % 5)], gen_random_uuid()::text, 'synthetic',
+                        m."displayName", now(), now(), m.id, m."tenantId"
+                    from members m
+                    cross join lateral generate_series(
+                        1, least(floor(:activities_per_member * 0.5 / sqrt(random() + 1e-6)), 1000)::int
+                    ) n
+                    where m."tenantId" = :tenant_id"""
+                ),
+                params,
+            )
+
+    with write_connection(engine) as con, con.begin():
+        if con.execute(text("""select to_regclass('"memberActivityAggregatesMVs"')""")).scalar():
+            con.execute(text('refresh materialized view "memberActivityAggregatesMVs"'))
+        con.execute(text("analyze tenants, members, activities, microservices"))
+
+    return tenant_ids
+
+
+def drop_tenants(engine, tenant_ids):
+    """
+    Delete synthetic tenants and everything they own
+
+    Args:
+        engine (Engine): the engine
+        tenant_ids ([str]): the ids of the tenants
+    """
+    with write_connection(engine) as con, con.begin():
+        # Skip the foreign key triggers, activities.parentId has no index they could use so every deleted
+        # activity would scan the table. Everything the tenants own is deleted, so nothing can dangle.
+        con.execute(text("set local session_replication_role = replica"))
+        for table in ("activities", "members", "microservices", "tenants"):
+            column = "id" if table == "tenants" else '"tenantId"'
+            con.execute(text(f"delete from {table} where {column} = any(cast(:ids as uuid[]))"), {"ids": tenant_ids})
+
+
+def _uuids(rng, n):
+    """
+    n random uuids, as the 32 hex digits Postgres accepts
+    """
+    digits = rng.bytes(16 * n).hex()
+    return [digits[i : i + 32] for i in range(0, 32 * n, 32)]
+
+
+def _copy(con, table, columns, lines):
+    """
+    COPY CSV lines into a table, on the connection and in the transaction of con
+    """
+    names = ", ".join(f'"{column}"' for column in columns)
+    with con.connection.cursor() as cursor:
+        cursor.copy_expert(f"copy {table} ({names}) from stdin with (format csv)", io.StringIO("\n".join(lines) + "\n"))
+
+
+def copy_tenant(engine, members=1000, activities_per_member=10, days=400, seed=42, batch_members=100000):
+    """
+    Create a synthetic tenant with its members, activities and a members score microservice, loaded with COPY.
+
+    Activity counts per member are 1 + a Lomax (Pareto II) draw with shape 1.5, capped at 5000. Members are active
+    in bursts: their last activity is exponentially distributed in the past, with a mean of a quarter of the days,
+    and their activities spread back from it with a mean of 60 days. One in twenty members is a team member.
+
+    Args:
+        engine (Engine): the engine
+        members (int, optional): members of the tenant. Defaults to 1000.
+        activities_per_member (int, optional): mean activities per member, at least 2. Defaults to 10.
+        days (int, optional): activities are spread over this many past days. Defaults to 400.
+        seed (int, optional): seed of the generator, so that runs get the same data. Defaults to 42.
+        batch_members (int, optional): members generated and copied at a time, which bounds memory.
+                                       Defaults to 100000.
+
+    Returns:
+        (str, int): the id of the tenant and its number of activities
+    """
+    rng = np.random.default_rng(seed)
+    tenant_id = str(uuid.uuid4())
+    types = list(ACTIVITY_TYPES)
+    shares = np.array([share for share, _ in ACTIVITY_TYPES.values()])
+    scores = np.array([score for _, score in ACTIVITY_TYPES.values()])
+    now = np.datetime64("now", "s")
+    day = np.timedelta64(86400, "s")
+    activities = 0
+
+    with write_connection(engine) as con, con.begin():
+        params = {"tenant_id": tenant_id}
+        con.execute(
+            text(
+                """insert into tenants (id, name, url, plan, "createdAt", "updatedAt")
+                values (:tenant_id, 'synthetic', left(:tenant_id, 50), 'Essential', now(), now())"""
+            ),
+            params,
+        )
+        con.execute(
+            text(
+                """insert into microservices (id, init, running, type, variant, "tenantId", "createdAt", "updatedAt")
+                values (gen_random_uuid(), false, false, 'members_score', 'default', :tenant_id, now(), now())"""
+            ),
+            params,
+        )
+
+        for first in range(0, members, batch_members):
+            n = min(batch_members, members - first)
+            member_ids = _uuids(rng, n)
+            joined = np.datetime_as_string(now - (rng.random(n) * days * day).astype("timedelta64[s]"))
+            team = rng.random(n) < 0.05
+            _copy(
+                con,
+                "members",
+                [
+                    "id",
+                    "displayName",
+                    "attributes",
+                    "emails",
+                    "score",
+                    "joinedAt",
+                    "createdAt",
+                    "updatedAt",
+                    "tenantId",
+                ],
+                [
+                    f"{member_id},member {first + i},"
+                    f'"{{""isTeamMember"": {{""default"": {json.dumps(bool(team[i]))}}}}}",'
+                    + (f"{{member{first + i}@example.com}}," if (first + i) % 3 == 0 else "{},")
+                    + f"-1,{joined[i]},{joined[i]},{joined[i]},{tenant_id}"
+                    for i, member_id in enumerate(member_ids)
+                ],
+            )
+
+            counts = np.minimum(1 + np.floor(rng.pareto(1.5, n) * (activities_per_member - 1) * 0.5), 5000).astype(int)
+            total = int(counts.sum())
+            last_active = rng.exponential(days / 4, n)
+            ages = np.minimum(np.repeat(last_active, counts) + rng.exponential(60, total), days)
+            timestamps = np.datetime_as_string(now - (ages * day).astype("timedelta64[s]"))
+            kinds = rng.choice(len(types), size=total, p=shares)
+            owners = np.repeat(np.arange(n), counts)
+            activity_ids = _uuids(rng, total)
+            _copy(
+                con,
+                "activities",
+                [
+                    "id",
+                    "type",
+                    "timestamp",
+                    "platform",
+                    "score",
+                    "sourceId",
+                    "importHash",
+                    "username",
+                    "createdAt",
+                    "updatedAt",
+                    "memberId",
+                    "tenantId",
+                ],
+                [
+                    f"{activity_id},{types[kind]},{timestamp},github,{scores[kind]},{activity_id},synthetic,"
+                    f"member{first + owner},{timestamp},{timestamp},{member_ids[owner]},{tenant_id}"
+                    for activity_id, kind, timestamp, owner in zip(
+                        activity_ids, kinds.tolist(), timestamps.tolist(), owners.tolist()
+                    )
+                ],
+            )
+            activities += total
+
+    with write_connection(engine) as con, con.begin():
+        if con.execute(text("""select to_regclass('"memberActivityAggregatesMVs"')""")).scalar():
+            con.execute(text('refresh materialized view "memberActivityAggregatesMVs"'))
+        con.execute(text("analyze tenants, members, activities, microservices"))
+
+    return tenant_id, activities
@@ -0,0 +1,155 @@
+"""
+Query plan regression tests of the Repository and the members score SQL.
+
+Seeds synthetic tenants in the test database, runs every case, explains the statements it sent and
+compares them with query_plans_baseline.json. The baseline is written when it does not exist yet, or
+when UPDATE_PLAN_BASELINES=1. Timings depend on the machine, so the baseline is not committed,
+keep it between runs of the same machine (or CI cache) instead.
+
+The size of the synthetic data can be changed with PLAN_TENANTS, PLAN_MEMBERS and PLAN_ACTIVITIES_PER_MEMBER.
+Baselines are only comparable with data of the same size.
+"""
+import os
+import warnings
+
+import pytest
+from sqlalchemy import text
+
+from gitmesh.backend.enums import JsonbOperators
+from gitmesh.backend.models import Activity, Member, Microservice
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.cache import LRUCache
+from gitmesh.members_score.members_score import MembersScore
+
+from plan_harness import PlanRecorder, load_baseline, regressions, save_baseline, summarise, table_sizes
+from synthetic_data import drop_tenants, seed_tenants
+
+BASELINE = os.path.join(os.path.dirname(__file__), "query_plans_baseline.json")
+UPDATE_BASELINES = os.environ.get("UPDATE_PLAN_BASELINES") == "1"
+
+TEAM_MEMBER = {"attributes.isTeamMember.default": True}
+
+# name: (function(repository, context), tables it may scan sequentially)
+CASES = {
+    "find_by_id": (lambda repository, context: repository.find_by_id(Member, context["member_id"]), ()),
+    "find_in_table": (
+        lambda repository, context: repository.find_in_table(Member, {"displayName": "member 10"}),
+        # displayName has no index, members of all tenants are scanned
+        ("members",),
+    ),
+    "find_all_equals": (
+        lambda repository, context: repository.find_all(Member, query=TEAM_MEMBER),
+        (),
+    ),
+    "find_all_contains": (
+        lambda repository, context: repository.find_all(
+            Member, query=TEAM_MEMBER, jsonb_operator=JsonbOperators.CONTAINS
+        ),
+        (),
+    ),
+    "find_all_path_exists": (
+        lambda repository, context: repository.find_all(
+            Member, query=TEAM_MEMBER, jsonb_operator=JsonbOperators.PATH_EXISTS
+        ),
+        (),
+    ),
+    "find_all_usernames": (
+        lambda repository, context: repository.find_all_usernames(),
+        # The view has no tenant column, it is hash joined with the members of the tenant
+        ("memberActivityAggregatesMVs",),
+    ),
+    "find_activities": (
+        lambda repository, context: repository.find_activities({"type": "star"}),
+        # find_in_table does not filter by tenant, activities of all tenants are scanned
+        ("activities",),
+    ),
+    "find_page": (
+        lambda repository, context: repository.find_page(Member, 100, repository.find_page(Member, 100).next_cursor),
+        (),
+    ),
+    "count": (lambda repository, context: repository.count(Member, TEAM_MEMBER), ()),
+    "count_activities": (lambda repository, context: repository.count(Activity, {"type": "star"}), ()),
+    "count_by_tenant": (
+        lambda repository, context: repository.count_by_tenant(Member, context["batch"]),
+        (),
+    ),
+    "find_latest_activity_by_tenant": (
+        lambda repository, context: repository.find_latest_activity_by_tenant(context["batch"]),
+        (),
+    ),
+    "find_team_members_by_tenant": (
+        lambda repository, context: repository.find_team_members_by_tenant(context["batch"]),
+        (),
+    ),
+    "find_available_microservices": (
+        lambda repository, context: repository.find_available_microservices("members_score"),
+        (),
+    ),
+    "find_new_members": (
+        lambda repository, context: repository.find_new_members(context["microservice"]),
+        (),
+    ),
+    "find_new_members_page": (
+        lambda repository, context: repository.find_new_members_page(context["microservice"], 100),
+        (),
+    ),
+    "members_score_fetch_scores": (
+        lambda repository, context: MembersScore(
+            repository.tenant_id, repository=repository, test=True, send=False
+        ).fetch_scores(),
+        (),
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def plans(api):
+    """Seed the synthetic tenants, and yield the repository, recorder and baseline of the cases"""
+    tenant_ids = seed_tenants(
+        api.engine,
+        tenants=int(os.environ.get("PLAN_TENANTS", 20)),
+        members=int(os.environ.get("PLAN_MEMBERS", 500)),
+        activities_per_member=int(os.environ.get("PLAN_ACTIVITIES_PER_MEMBER", 10)),
+    )
+    repository = Repository(tenant_ids[0], str(api.engine.url), cache=LRUCache())
+    recorder = PlanRecorder(repository.engine)
+
+    with repository.engine.connect() as con:
+        member_id = con.execute(
+            text('select id from members where "tenantId" = :tenant_id limit 1'), {"tenant_id": tenant_ids[0]}
+        ).scalar()
+    microservice = repository.find_in_table(Microservice, {"tenantId": tenant_ids[0]})
+
+    # Batched lookups get a few tenants, like a worker cycle, not all of them
+    context = {"batch": tenant_ids[:3], "member_id": str(member_id), "microservice": microservice}
+    baseline = load_baseline(BASELINE)
+    results = {}
+    try:
+        yield repository, recorder, context, baseline, results
+    finally:
+        recorder.close()
+        drop_tenants(api.engine, tenant_ids)
+        if UPDATE_BASELINES or not baseline:
+            save_baseline(BASELINE, {**baseline, **results})
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_query_plan(plans, case):
+    """Tests that the statements of a case do not scan large tables sequentially or regress past the tolerance"""
+    repository, recorder, context, baseline, results = plans
+    function, allow_seq_scan = CASES[case]
+
+    repository.cache.clear()
+    with recorder.recording():
+        function(repository, context)
+    assert recorder.statements, f"{case} did not execute any statement"
+
+    summary = summarise(repository.engine, recorder.statements)
+    results[case] = summary
+
+    failures, changes = regressions(
+        summary, {} if UPDATE_BASELINES else baseline.get(case, {}), table_sizes(repository.engine), allow_seq_scan
+    )
+    for change in changes:
+        warnings.warn(change)
+    assert not failures, "\n".join(failures)
@@ -1,2 +1,3 @@
 from .operations import Operations  # noqa
 from .services import Services  # noqs
+from .jsonb_operators import JsonbOperators  # noqa
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class JsonbOperators(Enum):
+    EQUALS: str = "equals"
+    CONTAINS: str = "@>"
+    PATH_EXISTS: str = "@?"
@@ -3,3 +3,5 @@ from enum import Enum
 
 class Services(Enum):
     MEMBERS_SCORE = "members_score"
+    # Activities upserted by the Node.js operations worker, forwarded for the online members score
+    MEMBERS_SCORE_ONLINE = "members_score_online"
@@ -9,3 +9,4 @@ if not KUBE_MODE:
 from .sqs import SQS  # noqa
 from .db_operations_sqs import DbOperationsSQS  # noqa
 from .services_sqs import ServicesSQS  # noqa
+from .s3 import S3  # noqa
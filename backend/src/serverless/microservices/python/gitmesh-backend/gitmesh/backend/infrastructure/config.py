@@ -1,3 +1,4 @@
+import json
 import os
 
 # TODO-kube
@@ -30,6 +31,15 @@ SQS_ACCESS_KEY_ID = os.environ.get("SQS_AWS_ACCESS_KEY_ID")
 SQS_SECRET_ACCESS_KEY = os.environ.get("SQS_AWS_SECRET_ACCESS_KEY")
 SQS_REGION = os.environ.get("SQS_AWS_REGION")
 
+# S3 Settings, the bucket of the microservices assets keeps the shared state of the workers
+S3_HOST = os.environ.get("S3_HOST")
+S3_PORT = os.environ.get("S3_PORT")
+S3_ENDPOINT_URL = (S3_HOST if "://" in S3_HOST else f"http://{S3_HOST}:{S3_PORT}") if S3_HOST else None
+S3_ACCESS_KEY_ID = os.environ.get("S3_AWS_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.environ.get("S3_AWS_SECRET_ACCESS_KEY")
+S3_REGION = os.environ.get("S3_AWS_REGION")
+S3_MICROSERVICES_ASSETS_BUCKET = os.environ.get("S3_MICROSERVICES_ASSETS_BUCKET")
+
 # DB Settings
 
 if "DB_PYTHON_WORKER_USERNAME" in os.environ:
@@ -45,3 +55,77 @@ DB_DATABASE = os.environ.get("DB_DATABASE")
 DB_HOST = os.environ.get("DB_READ_HOST")
 DB_PORT = os.environ.get("DB_PORT")
 DB_URL = f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}'
+
+# Execute the named queries of the repository as server-side prepared statements.
+# Disable it when connecting through a transaction pooler that does not support them.
+DB_PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "true").lower() != "false"
+
+# Statements slower than this (in milliseconds) are logged by the repository
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 1000))
+
+# Isolation profile of the heavy aggregate queries: snapshot, serializable_deferrable or read_committed
+DB_AGGREGATE_ISOLATION = os.environ.get("DB_AGGREGATE_ISOLATION", "snapshot")
+
+# Waits for a safe snapshot longer than this (in milliseconds) are counted as snapshot waits
+DB_SNAPSHOT_WAIT_MS = float(os.environ.get("DB_SNAPSHOT_WAIT_MS", 50))
+
+# Approximate counts below this planner estimate are replaced by an exact count
+DB_APPROXIMATE_COUNT_THRESHOLD = int(os.environ.get("DB_APPROXIMATE_COUNT_THRESHOLD", 10000))
+
+# Seconds a count refreshed with Repository.refresh_count is served to approximate counts
+DB_COUNT_CACHE_TTL = float(os.environ.get("DB_COUNT_CACHE_TTL", 3600))
+
+# Tenant sharding. DB_SHARDS is a JSON object {shard name: database url}, the "default" shard is DB_URL unless set.
+# Tenants are mapped to shards with DB_TENANT_SHARDS, a JSON object {tenant id: shard name},
+# or with the tenantShards table of the default shard when DB_SHARD_LOOKUP is true.
+DB_SHARDS = json.loads(os.environ.get("DB_SHARDS") or "{}")
+DB_TENANT_SHARDS = json.loads(os.environ.get("DB_TENANT_SHARDS") or "{}")
+DB_SHARD_LOOKUP = os.environ.get("DB_SHARD_LOOKUP", "false").lower() == "true"
+# Seconds a tenantShards lookup is cached
+DB_SHARD_LOOKUP_TTL = float(os.environ.get("DB_SHARD_LOOKUP_TTL", 300))
+
+# Where the members score keeps its state between runs, see members_score.states: file, in the local directories
+# of the MEMBERS_SCORE_*_DIR settings, or s3, under them as key prefixes in S3_MICROSERVICES_ASSETS_BUCKET.
+# The file state is only seen by the worker that wrote it, it is rejected with more than one PYTHON_WORKER_REPLICAS.
+MEMBERS_SCORE_STATE_BACKEND = os.environ.get("MEMBERS_SCORE_STATE_BACKEND", "file")
+# Python workers consuming the python worker queue
+PYTHON_WORKER_REPLICAS = int(os.environ.get("PYTHON_WORKER_REPLICAS", 1))
+# Directory, or key prefix with the s3 state backend, of the incremental members score aggregates, one per tenant.
+# Unset disables the incremental mode.
+MEMBERS_SCORE_AGGREGATES_DIR = os.environ.get("MEMBERS_SCORE_AGGREGATES_DIR")
+# Seconds an online members scorer serves the calibration of the last batch run of its tenant, it skips the
+# activities once it is older, until the next batch run
+MEMBERS_SCORE_ONLINE_RECALIBRATE = float(os.environ.get("MEMBERS_SCORE_ONLINE_RECALIBRATE", 86400))
+# Tenants an online members scorer is kept for, per process, the least recently used are dropped
+MEMBERS_SCORE_ONLINE_SCORERS = int(os.environ.get("MEMBERS_SCORE_ONLINE_SCORERS", 32))
+# Directory, or key prefix with the s3 state backend, of the calibrations the members score runs save for the online
+# scorers of every tenant. Unset only calibrates the online scorers of the worker that ran the batch.
+MEMBERS_SCORE_CALIBRATIONS_DIR = os.environ.get("MEMBERS_SCORE_CALIBRATIONS_DIR")
+# Seconds an online members scorer waits before looking for a newer calibration of its tenant
+MEMBERS_SCORE_ONLINE_REFRESH = float(os.environ.get("MEMBERS_SCORE_ONLINE_REFRESH", 3600))
+# Normaliser of the raw members scores into levels: kmeans (sklearn), optimal (exact 1-D k-means) or quantile.
+# kmeans gives the levels the members scores were tested with, optimal can move members between levels.
+MEMBERS_SCORE_NORMALISER = os.environ.get("MEMBERS_SCORE_NORMALISER", "kmeans")
+# Directory, or key prefix with the s3 state backend, of the cluster centres of the last members score run of every
+# tenant, that warm start the next one. Unset disables the warm start.
+MEMBERS_SCORE_CENTRES_DIR = os.environ.get("MEMBERS_SCORE_CENTRES_DIR")
+# Tenants with at least this many members are scored in chunks of MEMBERS_SCORE_CHUNK_SIZE rows, with bounded memory.
+# 0 disables the streaming mode.
+MEMBERS_SCORE_STREAMING_MEMBERS = int(os.environ.get("MEMBERS_SCORE_STREAMING_MEMBERS", 200000))
+MEMBERS_SCORE_CHUNK_SIZE = int(os.environ.get("MEMBERS_SCORE_CHUNK_SIZE", 10000))
+# Processes of the batch members score of all the tenants. 0 uses one per core.
+MEMBERS_SCORE_BATCH_PROCESSES = int(os.environ.get("MEMBERS_SCORE_BATCH_PROCESSES", 0))
+# Score all the tenants in a batch job started by the python worker when the members score coordinator runs,
+# instead of queueing them
+MEMBERS_SCORE_BATCH = os.environ.get("MEMBERS_SCORE_BATCH", "false").lower() == "true"
+# Directory, or key prefix with the s3 state backend, of the checkpoints of the members scores left to publish when a
+# run spends its time budget, one per tenant. Unset drops the scores left until the next run.
+MEMBERS_SCORE_CHECKPOINTS_DIR = os.environ.get("MEMBERS_SCORE_CHECKPOINTS_DIR")
+# Compute the raw members scores in the database, one row per member, instead of from the monthly rows in Python
+MEMBERS_SCORE_IN_DATABASE = os.environ.get("MEMBERS_SCORE_IN_DATABASE", "false").lower() == "true"
+# Share of the traces (worker messages, jobs) whose spans are recorded, see tracing. 0 disables tracing.
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", 0))
+# Where the spans go: jsonl (appended to TRACING_FILE) or otlp (posted to the OTLP/HTTP TRACING_OTLP_ENDPOINT)
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "jsonl")
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+TRACING_OTLP_ENDPOINT = os.environ.get("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
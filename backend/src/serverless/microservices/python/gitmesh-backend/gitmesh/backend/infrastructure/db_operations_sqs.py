@@ -1,5 +1,6 @@
 from gitmesh.backend.infrastructure import SQS
 from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import current_span, traced
 from gitmesh.backend.enums import Operations
 import os
 from uuid import uuid1 as uuid
@@ -33,6 +34,7 @@ class DbOperationsSQS(SQS):
 
         return out
 
+    @traced("sqs.db_operations")
     def send_message(self, tenant_id, operation, records, send=True):
         """
         Send a message to the SQS queue that will trigger Write operations
@@ -43,6 +45,7 @@ class DbOperationsSQS(SQS):
             records ([dict]): list of records to be added or updated
         """
         tenant_id = str(tenant_id)
+        current_span().set_attributes(tenant=tenant_id, operation=operation.value, rows=len(records or []))
 
         if records:
             message_id = f"{tenant_id}-{operation.value}-"
@@ -0,0 +1,77 @@
+import boto3
+from botocore.exceptions import ClientError
+
+from gitmesh.backend.infrastructure.config import (
+    S3_ACCESS_KEY_ID,
+    S3_ENDPOINT_URL,
+    S3_REGION,
+    S3_SECRET_ACCESS_KEY,
+)
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import span
+
+logger = get_logger(__name__)
+
+
+class S3:
+    """
+    Class to read and write the objects of an S3 bucket.
+    """
+
+    def __init__(self, bucket, client=None):
+        """
+        Initialise class to handle S3 requests.
+
+        Args:
+            bucket (str): name of the bucket
+            client (optional): the boto3 S3 client. Defaults to one built from the S3 settings.
+        """
+        self.bucket = bucket
+        self.s3 = client or boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            aws_access_key_id=S3_ACCESS_KEY_ID,
+        )
+
+    def get(self, key):
+        """
+        Read an object
+
+        Args:
+            key (str): the key of the object
+
+        Returns:
+            bytes: its content, None if there is no such object
+        """
+        with span("s3.get_object", bucket=self.bucket) as current:
+            try:
+                body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                    return None
+                raise
+            current.set_attribute("bytes", len(body))
+            return body
+
+    def put(self, key, body):
+        """
+        Write an object, replacing the previous one
+
+        Args:
+            key (str): the key of the object
+            body (bytes): its content
+        """
+        with span("s3.put_object", bucket=self.bucket, bytes=len(body)):
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def delete(self, key):
+        """
+        Delete an object, if it exists
+
+        Args:
+            key (str): the key of the object
+        """
+        with span("s3.delete_object", bucket=self.bucket):
+            self.s3.delete_object(Bucket=self.bucket, Key=key)
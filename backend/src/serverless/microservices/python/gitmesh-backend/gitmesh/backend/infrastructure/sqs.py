@@ -3,6 +3,7 @@ import os
 from uuid import uuid1 as uuid
 import json
 from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import span
 
 from gitmesh.backend.infrastructure.config import KUBE_MODE, IS_DEV_ENV, SQS_ENDPOINT_URL, SQS_REGION, \
     SQS_SECRET_ACCESS_KEY, SQS_ACCESS_KEY_ID
@@ -81,13 +82,14 @@ class SQS:
 
         if type(body) is not str:
             body = json.dumps(body, default=string_converter)
-        return self.sqs.send_message(
-            QueueUrl=self.sqs_url,
-            MessageAttributes=attributes,
-            MessageBody=body,
-            MessageGroupId=id,
-            MessageDeduplicationId=deduplicationId,
-        )
+        with span("sqs.send_message", queue=self.sqs_url, bytes=len(body)):
+            return self.sqs.send_message(
+                QueueUrl=self.sqs_url,
+                MessageAttributes=attributes,
+                MessageBody=body,
+                MessageGroupId=id,
+                MessageDeduplicationId=deduplicationId,
+            )
 
     def receive_message(self, delete=True, wait_time_seconds=0, visibility_timeout=60):
         """
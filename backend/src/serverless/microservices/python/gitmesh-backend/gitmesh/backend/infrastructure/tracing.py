@@ -0,0 +1,332 @@
+"""
+Lightweight tracing of the phases of the jobs.
+
+A span times a block of code, with attributes like the tenant, the service or a number of rows. Spans opened inside
+another span are its children, so a trace shows where the time of a job went: its queries, scoring phases and
+SQS sends. Whether a trace is recorded is decided once, when its root span starts, with TRACING_SAMPLE_RATE:
+the spans of the other traces, and all spans when tracing is off, are a shared no-op span.
+
+Finished spans are handed to an exporter: JsonlExporter appends them to a file, one JSON object per line, and
+OtlpExporter posts the spans of every finished trace to an OTLP/HTTP collector, as JSON.
+
+Usage:
+    with span("members_score.main", tenant=tenant_id) as current:
+        current.set_attribute("rows", len(rows))
+
+    @traced("members_score.normalise")
+    def normalise(self, scores):
+        ...
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from gitmesh.backend.infrastructure.config import (
+    SERVICE,
+    TRACING_EXPORTER,
+    TRACING_FILE,
+    TRACING_OTLP_ENDPOINT,
+    TRACING_SAMPLE_RATE,
+)
+from gitmesh.backend.infrastructure.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class Span(object):
+    """
+    A timed operation of a trace.
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    recording = True
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64).to_bytes(8, "big").hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class NoopSpan(object):
+    """
+    The span of the traces that are not recorded, it ignores everything.
+    """
+
+    recording = False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Exporter(object):
+    """
+    Interface of the destinations of the finished spans.
+    """
+
+    def export(self, span):
+        """
+        Args:
+            span (Span): a finished span. Root spans, without parent_id, finish their trace.
+        """
+        raise NotImplementedError
+
+
+class JsonlExporter(Exporter):
+    """
+    Appends the spans to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            # Forked worker processes open their own file handle
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.path, "a", buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line)
+
+
+class OtlpExporter(Exporter):
+    """
+    Posts the spans of every finished trace to an OTLP/HTTP collector, in the OTLP JSON encoding.
+    """
+
+    def __init__(self, endpoint, timeout=2):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self._traces = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _otlp_span(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            # SPAN_KIND_INTERNAL
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": self._value(value)} for key, value in span.attributes.items()],
+            # STATUS_CODE_OK or STATUS_CODE_ERROR
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, span):
+        with self._lock:
+            spans = self._traces.setdefault(span.trace_id, [])
+            spans.append(span)
+            if span.parent_id is not None:
+                return
+            del self._traces[span.trace_id]
+
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": str(SERVICE)}}]},
+                    "scopeSpans": [{"scope": {"name": "gitmesh"}, "spans": [self._otlp_span(s) for s in spans]}],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}
+        )
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except OSError as e:
+            # Tracing must never fail a job
+            logger.warning(f"Could not export trace {span.trace_id} to {self.endpoint}: {e}")
+
+
+EXPORTERS = {
+    "jsonl": lambda: JsonlExporter(TRACING_FILE),
+    "otlp": lambda: OtlpExporter(TRACING_OTLP_ENDPOINT),
+}
+
+# The span of the current context, None outside of any trace
+_current = contextvars.ContextVar("gitmesh_span", default=None)
+
+_sample_rate = TRACING_SAMPLE_RATE
+_exporter = None
+
+
+def configure(sample_rate=None, exporter=None):
+    """
+    Change the sampling and the exporter of the process, e.g. in tests or scripts
+
+    Args:
+        sample_rate (float, optional): share of the traces to record. Defaults to TRACING_SAMPLE_RATE.
+        exporter (Exporter, optional): where the spans go. Defaults to the TRACING_EXPORTER one.
+    """
+    global _sample_rate, _exporter
+    _sample_rate = TRACING_SAMPLE_RATE if sample_rate is None else sample_rate
+    _exporter = exporter
+
+
+def _get_exporter():
+    global _exporter
+    if _exporter is None:
+        if TRACING_EXPORTER not in EXPORTERS:
+            raise ValueError(f"Unknown tracing exporter {TRACING_EXPORTER}, expected one of {list(EXPORTERS)}")
+        _exporter = EXPORTERS[TRACING_EXPORTER]()
+    return _exporter
+
+
+def current_span():
+    """
+    The span of the current context, NOOP_SPAN outside of a recorded trace
+    """
+    return _current.get() or NOOP_SPAN
+
+
+def start_span(name, **attributes):
+    """
+    Start a span that does not become the current one, for operations timed by callbacks, like the queries.
+    It must be ended with end_span.
+
+    Returns:
+        Span: the span, NOOP_SPAN outside of a recorded trace. Leaf spans do not start traces.
+    """
+    parent = _current.get()
+    if parent is None or not parent.recording:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def end_span(span, error=None):
+    """
+    End a span and export it
+
+    Args:
+        span (Span): the span
+        error (Exception, optional): the error it failed with
+    """
+    if not span.recording:
+        return
+    if error is not None:
+        span.record_error(error)
+    span.end_ns = time.time_ns()
+    try:
+        _get_exporter().export(span)
+    except Exception as e:
+        logger.warning(f"Could not export span {span.name}: {e}")
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block as a child of the current span, or as the root of a new trace, sampled with the sample rate
+
+    Args:
+        name (str): name of the operation. Example: members_score.normalise
+        **attributes: attributes of the span. Example: tenant=tenant_id
+
+    Yields:
+        Span: the span, to set attributes on. NOOP_SPAN when the trace is not recorded.
+    """
+    parent = _current.get()
+    if parent is None:
+        if _sample_rate > 0 and random.random() < _sample_rate:
+            current = Span(name, random.getrandbits(128).to_bytes(16, "big").hex(), None, attributes)
+        else:
+            current = NOOP_SPAN
+    elif parent.recording:
+        current = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        current = NOOP_SPAN
+
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        _current.reset(token)
+        end_span(current, e)
+        raise
+    _current.reset(token)
+    end_span(current)
+
+
+def traced(name=None, **attributes):
+    """
+    Decorator running a function in a span
+
+    Args:
+        name (str, optional): name of the span. Defaults to the qualified name of the function.
+        **attributes: attributes of the span
+    """
+
+    def decorator(function):
+        span_name = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
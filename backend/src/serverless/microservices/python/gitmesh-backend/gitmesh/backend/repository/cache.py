@@ -0,0 +1,134 @@
+import time
+import threading
+from collections import OrderedDict
+
+from gitmesh.backend.infrastructure.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class CacheBackend(object):
+    """
+    Interface for the read-through cache used by the Repository.
+    A shared backend (e.g. Redis) can be plugged in by implementing these methods.
+    Keys are tuples of (namespace, id), where the namespace is the table name.
+    """
+
+    def get(self, key):
+        """
+        Get a value from the cache
+
+        Args:
+            key (tuple): (namespace, id)
+
+        Returns:
+            the cached value, or None if it is missing or expired
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """
+        Store a value in the cache
+
+        Args:
+            key (tuple): (namespace, id)
+            value: the value to store
+            ttl (float): time to live in seconds
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """
+        Remove a single key from the cache
+
+        Args:
+            key (tuple): (namespace, id)
+        """
+        raise NotImplementedError
+
+    def clear(self, namespace=None):
+        """
+        Remove all keys of a namespace, or everything if no namespace is given
+
+        Args:
+            namespace (str, optional): the namespace to clear. Defaults to None.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Hit and miss counters per namespace
+
+        Returns:
+            dict: {namespace: {"hits": int, "misses": int}}
+        """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process LRU cache with a time to live for each entry.
+    """
+
+    def __init__(self, max_size=1024, clock=time.monotonic):
+        """
+        Initialise the cache.
+
+        Args:
+            max_size (int, optional): maximum number of entries. Defaults to 1024.
+            clock (callable, optional): function returning the current time in seconds.
+                                        Defaults to time.monotonic.
+        """
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _count(self, namespace, counter):
+        counters = self._counters.setdefault(namespace, {"hits": 0, "misses": 0})
+        counters[counter] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self._count(key[0], "hits")
+                    return value
+                del self._entries[key]
+            self._count(key[0], "misses")
+            return None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == namespace]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {namespace: dict(counters) for namespace, counters in self._counters.items()}
+
+
+# Process-wide cache shared by every Repository, so that the worker and the coordinator
+# reuse lookups across the Repository instances they create during a cycle.
+default_cache = LRUCache()
+
+# Process-wide cache of the counts of refresh_count(s), apart so that lookups do not evict them.
+default_count_cache = LRUCache()
@@ -0,0 +1,24 @@
+# SQLSTATE of a statement cancelled by statement_timeout or by a cancel request
+QUERY_CANCELED = "57014"
+
+
+class RepositoryTimeoutError(Exception):
+    """
+    Raised when a repository call exceeds its statement timeout or the deadline of the job.
+    """
+
+    def __init__(self, tenant_id, statement=None, timeout_ms=None):
+        """
+        Args:
+            tenant_id (str): the tenant the statement was executed for
+            statement (str, optional): the statement that was cancelled. None if the deadline had already passed.
+            timeout_ms (int, optional): the statement timeout that was applied
+        """
+        self.tenant_id = tenant_id
+        self.statement = statement
+        self.timeout_ms = timeout_ms
+        if statement is None:
+            message = f"Deadline passed before executing a statement for tenant {tenant_id}"
+        else:
+            message = f"Statement cancelled after {timeout_ms}ms for tenant {tenant_id}"
+        super().__init__(message)
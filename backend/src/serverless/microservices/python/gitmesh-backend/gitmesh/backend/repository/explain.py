@@ -0,0 +1,49 @@
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a statement, with its parameters bound like the statement itself.
+
+    Example:
+        con.execute(Explain(session.query(Member).statement, analyze=True)).scalar()
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement, analyze=False, buffers=False):
+        """
+        Args:
+            statement (Select): the statement to explain
+            analyze (bool, optional): execute the statement and report actual times and rows. Defaults to False.
+            buffers (bool, optional): report buffer usage, requires analyze. Defaults to False.
+        """
+        self.statement = statement
+        self.analyze = analyze
+        self.buffers = buffers
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    options = ["FORMAT JSON"]
+    if element.analyze:
+        options.append("ANALYZE")
+    if element.buffers:
+        options.append("BUFFERS")
+    return f"EXPLAIN ({', '.join(options)}) {compiler.process(element.statement, **kw)}"
+
+
+def plan_rows(con, statement):
+    """
+    The planner estimate of the number of rows of a statement, without executing it
+
+    Args:
+        con (Connection): the connection
+        statement (Select): the statement
+
+    Returns:
+        int: the estimated number of rows
+    """
+    plan = con.execute(Explain(statement)).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
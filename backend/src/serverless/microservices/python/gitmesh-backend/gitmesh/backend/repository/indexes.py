@@ -0,0 +1,51 @@
+import json
+
+from gitmesh.backend.enums import JsonbOperators
+
+
+def jsonpath_match(path, value):
+    """
+    Build a jsonpath predicate matching documents where path equals value. Used with the @? operator.
+
+    Args:
+        path (tuple): keys inside the JSONB document. Example: ('isTeamMember', 'default')
+        value: a JSON scalar (str, int, float, bool or None)
+
+    Returns:
+        str: the jsonpath. Example: '$."isTeamMember"."default" ? (@ == true)'
+    """
+    if isinstance(value, (dict, list, tuple)):
+        raise ValueError(f"Only scalar values can be matched with a jsonpath, got {value}")
+    keys = "".join(f".{json.dumps(key)}" for key in path)
+    return f"${keys} ? (@ == {json.dumps(value)})"
+
+
+def jsonb_index_ddl(table, attr, jsonb_operator=JsonbOperators.CONTAINS, name=None):
+    """
+    DDL of the index serving nested filters on attr.
+    CONTAINS and PATH_EXISTS are served by a GIN jsonb_path_ops index on the whole column,
+    EQUALS by a btree expression index on the extracted path.
+
+    Args:
+        table (Base): class of the entity
+        attr (str): nested key, as used in queries. Example: 'attributes.isTeamMember.default'
+        jsonb_operator (JsonbOperators): the operator the index should serve. Defaults to JsonbOperators.CONTAINS.
+        name (str, optional): name of the index. Defaults to one derived from the table and the key.
+
+    Returns:
+        str: CREATE INDEX statement
+    """
+    attributes = attr.split(".")
+    column = attributes[0]
+    tablename = table.__tablename__
+
+    if jsonb_operator == JsonbOperators.EQUALS:
+        if len(attributes) < 2:
+            raise ValueError(f"An expression index needs a nested key, got {attr}")
+        name = name or f"ix_{tablename}_{'_'.join(attributes)}"
+        path = ",".join(attributes[1:])
+        expression = f"(\"{column}\" #> '{{{path}}}')"
+        return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{tablename}" ({expression})'
+
+    name = name or f"ix_{tablename}_{column}_path_ops"
+    return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{tablename}" USING gin ("{column}" jsonb_path_ops)'
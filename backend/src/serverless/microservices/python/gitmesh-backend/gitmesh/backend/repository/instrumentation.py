@@ -0,0 +1,169 @@
+import re
+import time
+import threading
+
+from sqlalchemy import event
+
+from gitmesh.backend.infrastructure.config import DB_SLOW_QUERY_MS, DB_SNAPSHOT_WAIT_MS
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import end_span, start_span
+
+logger = get_logger(__name__)
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PARAMETER = re.compile(r"%\(\w+\)s|%s|\$\d+")
+VALUES_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """
+    Normalise a statement so that executions differing only by their parameters or literals are grouped together.
+
+    Args:
+        statement (str): the SQL statement
+
+    Returns:
+        str: the fingerprint. Example: SELECT * FROM members WHERE "tenantId" = ? LIMIT ?
+    """
+    statement = STRING_LITERAL.sub("?", statement)
+    statement = PARAMETER.sub("?", statement)
+    statement = NUMBER_LITERAL.sub("?", statement)
+    statement = VALUES_LIST.sub("(?)", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryStats(object):
+    """
+    Per fingerprint aggregated timings and row counts of the statements executed by an engine.
+    """
+
+    def __init__(self, slow_query_ms=DB_SLOW_QUERY_MS, snapshot_wait_ms=DB_SNAPSHOT_WAIT_MS):
+        """
+        Initialise the stats.
+
+        Args:
+            slow_query_ms (float, optional): statements slower than this are logged. Defaults to DB_SLOW_QUERY_MS.
+            snapshot_wait_ms (float, optional): waits for a safe snapshot longer than this are counted.
+                                                Defaults to DB_SNAPSHOT_WAIT_MS.
+        """
+        self.slow_query_ms = slow_query_ms
+        self.snapshot_wait_ms = snapshot_wait_ms
+        self._stats = {}
+        self._snapshot_waits = {"waits": 0, "total_ms": 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, statement, duration_ms, rows, tenant_id):
+        """
+        Record an execution
+
+        Args:
+            statement (str): the SQL statement
+            duration_ms (float): execution time in milliseconds
+            rows (int): number of rows returned or affected, -1 if unknown
+            tenant_id (str): the tenant the statement was executed for
+        """
+        key = fingerprint(statement)
+        with self._lock:
+            stats = self._stats.setdefault(key, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0})
+            stats["calls"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["rows"] += max(rows, 0)
+
+        if duration_ms >= self.slow_query_ms:
+            logger.warning(
+                "Slow query",
+                extra={"fingerprint": key, "duration_ms": round(duration_ms, 2), "rows": rows, "tenant": tenant_id},
+            )
+
+    def record_snapshot_wait(self, duration_ms, tenant_id):
+        """
+        Record the time a deferrable transaction waited for a safe snapshot
+
+        Args:
+            duration_ms (float): wait in milliseconds
+            tenant_id (str): the tenant the transaction was started for
+        """
+        if duration_ms < self.snapshot_wait_ms:
+            return
+
+        with self._lock:
+            self._snapshot_waits["waits"] += 1
+            self._snapshot_waits["total_ms"] += duration_ms
+
+        logger.warning("Snapshot wait", extra={"duration_ms": round(duration_ms, 2), "tenant": tenant_id})
+
+    def snapshot_waits(self):
+        """
+        Number of transactions that waited for a safe snapshot, and the total wait
+
+        Returns:
+            dict: {"waits": int, "total_ms": float}
+        """
+        with self._lock:
+            return dict(self._snapshot_waits)
+
+    def summary(self, limit=None):
+        """
+        The aggregated stats, slowest fingerprints first
+
+        Args:
+            limit (int, optional): maximum number of fingerprints to return. Defaults to all.
+
+        Returns:
+            [dict]: fingerprint, calls, total_ms, max_ms, mean_ms and rows of each fingerprint
+        """
+        with self._lock:
+            summary = [
+                {**stats, "fingerprint": key, "mean_ms": stats["total_ms"] / stats["calls"]}
+                for key, stats in self._stats.items()
+            ]
+        summary.sort(key=lambda stats: stats["total_ms"], reverse=True)
+        return summary[:limit] if limit else summary
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._snapshot_waits = {"waits": 0, "total_ms": 0.0}
+
+
+def instrument(engine, stats, get_tenant_id):
+    """
+    Record every statement executed by the engine in stats, and as a db.query span of the current trace
+
+    Args:
+        engine (Engine): the SQLAlchemy engine
+        stats (QueryStats): where to record the executions
+        get_tenant_id (callable): returns the tenant the statements are currently executed for
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+        conn.info.setdefault("query_span", []).append(start_span("db.query"))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+        stats.record(statement, duration_ms, cursor.rowcount, get_tenant_id())
+
+        span = conn.info["query_span"].pop()
+        if span.recording:
+            span.set_attributes(statement=fingerprint(statement), rows=cursor.rowcount, tenant=str(get_tenant_id()))
+            end_span(span)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # The statement failed, so after_cursor_execute will not pop its start time
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            conn.info["query_start_time"].pop()
+        if conn is not None and conn.info.get("query_span"):
+            span = conn.info["query_span"].pop()
+            if span.recording:
+                span.set_attributes(
+                    statement=fingerprint(exception_context.statement or ""), tenant=str(get_tenant_id())
+                )
+                end_span(span, exception_context.original_exception)
@@ -0,0 +1,41 @@
+from gitmesh.backend.infrastructure.config import DB_AGGREGATE_ISOLATION
+
+
+class QueryClasses:
+    # Point lookups, filtered finds and counts
+    LOOKUP = "lookup"
+    # Heavy aggregates that read many rows and need a consistent snapshot, like the members score
+    AGGREGATE = "aggregate"
+
+
+class IsolationProfiles:
+    READ_COMMITTED = "read_committed"
+    # One consistent snapshot for the whole transaction, without waiting for it
+    SNAPSHOT = "snapshot"
+    # Serializable, but may block until a safe snapshot is available
+    SERIALIZABLE_DEFERRABLE = "serializable_deferrable"
+
+
+# Execution options of every profile. All of them are read only.
+ISOLATION_PROFILES = {
+    IsolationProfiles.READ_COMMITTED: {
+        "isolation_level": "READ COMMITTED",
+        "postgresql_readonly": True,
+        "postgresql_deferrable": False,
+    },
+    IsolationProfiles.SNAPSHOT: {
+        "isolation_level": "REPEATABLE READ",
+        "postgresql_readonly": True,
+        "postgresql_deferrable": False,
+    },
+    IsolationProfiles.SERIALIZABLE_DEFERRABLE: {
+        "isolation_level": "SERIALIZABLE",
+        "postgresql_readonly": True,
+        "postgresql_deferrable": True,
+    },
+}
+
+DEFAULT_ISOLATION = {
+    QueryClasses.LOOKUP: IsolationProfiles.READ_COMMITTED,
+    QueryClasses.AGGREGATE: DB_AGGREGATE_ISOLATION,
+}
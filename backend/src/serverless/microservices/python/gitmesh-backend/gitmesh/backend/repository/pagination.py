@@ -0,0 +1,44 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+
+# A page of results of a keyset paginated query.
+# next_cursor is None when there are no more pages.
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def encode_cursor(value, id):
+    """
+    Encode the position after a row into an opaque cursor
+
+    Args:
+        value: value of the order column of the last row of the page
+        id (str): id of the last row of the page
+
+    Returns:
+        str: the cursor
+    """
+    if isinstance(value, datetime):
+        value = {"datetime": value.isoformat()}
+    payload = json.dumps([value, str(id)])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created with encode_cursor
+
+    Args:
+        cursor (str): the cursor
+
+    Returns:
+        (value, id): value of the order column and id of the last row of the previous page
+    """
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if isinstance(value, dict) and "datetime" in value:
+        value = datetime.fromisoformat(value["datetime"])
+    return value, id
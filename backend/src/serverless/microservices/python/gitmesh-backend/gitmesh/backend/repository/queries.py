@@ -0,0 +1,125 @@
+import re
+
+from sqlalchemy import text
+
+from gitmesh.backend.infrastructure.config import DB_PREPARED_STATEMENTS
+from gitmesh.backend.repository.isolation import QueryClasses
+
+# :name parameters, but not ::type casts
+PARAMETER = re.compile(r"(?<![:\w]):(\w+)")
+
+# Registry of the named queries, filled with register_query
+QUERIES = {}
+
+
+class NamedQuery(object):
+    """
+    A parameterised raw SQL statement that is executed as a server-side prepared statement,
+    so that Postgres parses and plans it once per connection instead of once per tenant.
+    """
+
+    def __init__(self, name, sql, types=None, query_class=QueryClasses.LOOKUP):
+        """
+        Initialise the query.
+
+        Args:
+            name (str): unique name of the query, also used as the name of the prepared statement
+            sql (str): the statement, with :name parameters. Example: 'select * from members where "tenantId" = :tenant_id'
+            types (dict, optional): {parameter: Postgres type} for parameters whose type Postgres can not infer.
+            query_class (str, optional): a QueryClasses value, selects the isolation profile.
+                                         Defaults to QueryClasses.LOOKUP.
+        """
+        self.name = name
+        self.query_class = query_class
+        self.sql = sql
+        self.statement = text(sql)
+
+        # The order in which the parameters appear, each one becomes $1, $2...
+        self.parameters = []
+        for parameter in PARAMETER.findall(sql):
+            if parameter not in self.parameters:
+                self.parameters.append(parameter)
+
+        types = types or {}
+        positional = PARAMETER.sub(lambda match: f"${self.parameters.index(match.group(1)) + 1}", sql)
+        signature = ", ".join(types.get(parameter, "unknown") for parameter in self.parameters)
+        self.prepare_sql = (
+            f"PREPARE {name}({signature}) AS {positional}" if self.parameters else f"PREPARE {name} AS {positional}"
+        )
+
+        arguments = ", ".join(f"%({parameter})s" for parameter in self.parameters)
+        self.execute_sql = f"EXECUTE {name}({arguments})" if self.parameters else f"EXECUTE {name}"
+
+    def execute(self, con, params):
+        """
+        Execute the query on a connection, preparing it first if the connection has not seen it yet.
+
+        Args:
+            con (Connection): the SQLAlchemy connection
+            params (dict): {parameter: value}
+
+        Returns:
+            CursorResult: the result
+        """
+        missing = [parameter for parameter in self.parameters if parameter not in params]
+        if missing:
+            raise ValueError(f"Missing parameters {missing} for query {self.name}")
+
+        if not DB_PREPARED_STATEMENTS:
+            return con.execute(self.statement, params)
+
+        # Prepared statements live as long as the DBAPI connection, which is pooled
+        prepared = con.connection.info.setdefault("prepared_statements", set())
+        if self.name not in prepared:
+            con.exec_driver_sql(self.prepare_sql)
+            prepared.add(self.name)
+
+        return con.exec_driver_sql(self.execute_sql, {parameter: params[parameter] for parameter in self.parameters})
+
+
+def register_query(name, sql, types=None, query_class=QueryClasses.LOOKUP):
+    """
+    Register a named query
+
+    Args:
+        name (str): unique name of the query
+        sql (str): the statement, with :name parameters
+        types (dict, optional): {parameter: Postgres type} for parameters whose type Postgres can not infer.
+        query_class (str, optional): a QueryClasses value, selects the isolation profile.
+                                     Defaults to QueryClasses.LOOKUP.
+
+    Returns:
+        str: the name of the query, to be passed to Repository.execute_query
+    """
+    if name in QUERIES and QUERIES[name].sql != sql:
+        raise ValueError(f"Query {name} is already registered with a different statement")
+    QUERIES[name] = NamedQuery(name, sql, types, query_class)
+    return name
+
+
+FIND_ALL_USERNAMES = register_query(
+    "find_all_usernames",
+    """select m."id", mw."username", m."displayName", m."emails"
+    from "members" m
+            inner join "memberActivityAggregatesMVs" mw on m.id = mw.id
+    where m."tenantId" = :tenant_id""",
+    types={"tenant_id": "uuid"},
+)
+
+LATEST_ACTIVITY_BY_TENANT = register_query(
+    "latest_activity_by_tenant",
+    """select "tenantId", max("timestamp")
+    from activities
+    where "tenantId" = ANY(:tenant_ids)
+    group by "tenantId\"""",
+    types={"tenant_ids": "uuid[]"},
+)
+
+TEAM_MEMBERS_BY_TENANT = register_query(
+    "team_members_by_tenant",
+    """select "tenantId", id
+    from members
+    where "tenantId" = ANY(:tenant_ids)
+        and attributes @> '{"isTeamMember": {"default": true}}'""",
+    types={"tenant_ids": "uuid[]"},
+)
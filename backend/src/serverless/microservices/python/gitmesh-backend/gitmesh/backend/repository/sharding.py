@@ -0,0 +1,182 @@
+import threading
+
+from sqlalchemy import create_engine, text
+
+from gitmesh.backend.infrastructure.config import DB_SHARDS, DB_TENANT_SHARDS, DB_SHARD_LOOKUP, DB_SHARD_LOOKUP_TTL
+from gitmesh.backend.models.base import Base
+from gitmesh.backend.repository.cache import LRUCache
+
+# Name of the shard of the tenants the shard map does not know, and of the directory database
+DEFAULT_SHARD = "default"
+
+# Process-wide engines, one per database url, so that every Repository of a shard shares its connection pool
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def shard_engine(url):
+    """
+    The shared engine of a database, created on first use
+
+    Args:
+        url (str): the database url
+
+    Returns:
+        Engine: the engine. Repositories derive their own engines from it with execution_options,
+                which share its pool but not its event listeners.
+    """
+    with _engines_lock:
+        if url not in _engines:
+            engine = create_engine(
+                url,
+                pool_pre_ping=True,
+                echo=False,
+                connect_args={
+                    "keepalives": 1,
+                    "keepalives_idle": 30,
+                    "keepalives_interval": 10,
+                    "keepalives_count": 5,
+                },
+            )
+            Base.metadata.create_all(engine, checkfirst=True)
+            _engines[url] = engine
+        return _engines[url]
+
+
+def dispose_engines(close=True):
+    """
+    Close the pools of all the shared engines, e.g. in a forked worker process
+
+    Args:
+        close (bool, optional): whether the pooled connections are closed. A forked process does not close the ones it
+            inherited, which the parent process still uses. Defaults to True.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=close)
+        _engines.clear()
+
+
+class ShardMap(object):
+    """
+    Maps tenants to the database they live in.
+    """
+
+    def __init__(self, shards, default=DEFAULT_SHARD):
+        """
+        Initialise the shard map.
+
+        Args:
+            shards (dict): {shard name: database url}
+            default (str, optional): shard of the tenants the map does not know. Defaults to DEFAULT_SHARD.
+        """
+        if default not in shards:
+            raise ValueError(f"Default shard {default} is not one of the shards {list(shards)}")
+        self.shards = dict(shards)
+        self.default = default
+
+    def shard_for(self, tenant_id):
+        """
+        The shard of a tenant
+
+        Args:
+            tenant_id (str): the tenant ID, or a falsy value for coordinator style repositories
+
+        Returns:
+            str: the name of the shard
+        """
+        raise NotImplementedError
+
+    def group(self, tenant_ids):
+        """
+        Group tenants by shard
+
+        Args:
+            tenant_ids ([str]): the tenant IDs
+
+        Returns:
+            dict: {shard name: [tenant id]}, in the order of tenant_ids
+        """
+        groups = {}
+        for tenant_id in tenant_ids:
+            groups.setdefault(self.shard_for(tenant_id), []).append(tenant_id)
+        return groups
+
+
+class StaticShardMap(ShardMap):
+    """
+    Shard map from configuration.
+    """
+
+    def __init__(self, shards, tenants=None, default=DEFAULT_SHARD):
+        """
+        Initialise the shard map.
+
+        Args:
+            shards (dict): {shard name: database url}
+            tenants (dict, optional): {tenant id: shard name}. Defaults to every tenant in the default shard.
+            default (str, optional): shard of the tenants not in tenants. Defaults to DEFAULT_SHARD.
+        """
+        super().__init__(shards, default)
+        self.tenants = {str(tenant_id): shard for tenant_id, shard in (tenants or {}).items()}
+        unknown = set(self.tenants.values()) - set(self.shards)
+        if unknown:
+            raise ValueError(f"Tenants are mapped to unknown shards {sorted(unknown)}")
+
+    def shard_for(self, tenant_id):
+        return self.tenants.get(str(tenant_id), self.default) if tenant_id else self.default
+
+
+class LookupShardMap(ShardMap):
+    """
+    Shard map read from the tenantShards table of the default shard, so that tenants can be moved without a deploy.
+    Lookups are cached, a moved tenant is routed to its new shard once its entry expires.
+    """
+
+    def __init__(self, shards, default=DEFAULT_SHARD, ttl=DB_SHARD_LOOKUP_TTL, cache=None):
+        """
+        Initialise the shard map.
+
+        Args:
+            shards (dict): {shard name: database url}
+            default (str, optional): shard holding the tenantShards table, and of the tenants it does not list.
+                                     Defaults to DEFAULT_SHARD.
+            ttl (float, optional): seconds a lookup is cached. Defaults to DB_SHARD_LOOKUP_TTL.
+            cache (CacheBackend, optional): cache of the lookups. Defaults to a new LRU cache.
+        """
+        super().__init__(shards, default)
+        self.ttl = ttl
+        self.cache = cache if cache is not None else LRUCache(max_size=10000)
+
+    def shard_for(self, tenant_id):
+        if not tenant_id:
+            return self.default
+
+        key = ("tenantShards", str(tenant_id))
+        shard = self.cache.get(key)
+        if shard is None:
+            with shard_engine(self.shards[self.default]).connect() as con:
+                shard = con.execute(
+                    text('select shard from "tenantShards" where "tenantId" = cast(:tenant_id as uuid)'),
+                    {"tenant_id": str(tenant_id)},
+                ).scalar()
+            if shard not in self.shards:
+                shard = self.default
+            self.cache.set(key, shard, self.ttl)
+        return shard
+
+
+def shard_map_from_config(default_url):
+    """
+    The shard map configured with DB_SHARDS, DB_TENANT_SHARDS and DB_SHARD_LOOKUP
+
+    Args:
+        default_url (str): url of the default shard, unless DB_SHARDS sets one
+
+    Returns:
+        ShardMap: the shard map. A single shard when sharding is not configured.
+    """
+    shards = {DEFAULT_SHARD: default_url, **DB_SHARDS}
+    if DB_SHARD_LOOKUP:
+        return LookupShardMap(shards)
+    return StaticShardMap(shards, DB_TENANT_SHARDS)
@@ -2,7 +2,20 @@ from gitmesh.backend.models.integration import Integration
 from gitmesh.backend.repository import Repository
 from gitmesh.backend.models.activity import Activity
 from gitmesh.backend.models.member import Member
+from gitmesh.backend.models.tenant import Tenant
+from gitmesh.backend.models.microservice import Microservice
+from gitmesh.backend.repository.cache import LRUCache
+from gitmesh.backend.repository.queries import NamedQuery, FIND_ALL_USERNAMES
+from gitmesh.backend.repository.instrumentation import fingerprint
+from gitmesh.backend.repository.isolation import QueryClasses, IsolationProfiles
+from gitmesh.backend.repository.errors import RepositoryTimeoutError
+from gitmesh.backend.repository.sharding import StaticShardMap
+from gitmesh.backend.enums import JsonbOperators
+from gitmesh.backend.infrastructure import tracing
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
 import uuid
+import pytest
 
 
 def test_find_in_table(api: "Repository"):
@@ -95,3 +108,375 @@ def test_find_community_member_order_by_createdAt(api: "Repository"):
     members = api.find_all(Member, query={"type": "member"}, order={Member.createdAt: False})
 
     assert members[0].createdAt >= members[len(members) - 1].createdAt
+
+
+def test_find_by_id_cached(api: "Repository"):
+    """Tests that a second find_by_id on a cached model is served from the cache"""
+    api.invalidate(Tenant)
+    before = api.cache_stats().get(Tenant.__tablename__, {"hits": 0, "misses": 0})
+
+    first = api.find_by_id(Tenant, api.tenant_id)
+    second = api.find_by_id(Tenant, api.tenant_id)
+
+    after = api.cache_stats()[Tenant.__tablename__]
+    assert first is not second
+    assert second.id == first.id and second.name == first.name
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+    # A cached document changed by a caller does not leak into the others
+    second.name = "changed"
+    assert api.find_by_id(Tenant, api.tenant_id).name == first.name
+
+    # Inside a unit of work the cache is bypassed for the document of the session
+    with api.unit_of_work() as session:
+        tenant = api.find_by_id(Tenant, api.tenant_id)
+        assert tenant in session
+        assert api.find_by_id(Tenant, api.tenant_id) is tenant
+
+
+def test_find_available_microservices_primes_the_cache(api: "Repository"):
+    """Tests that the workers find the microservices of a coordinator cycle in the cache"""
+    api.invalidate(Microservice)
+    microservices = api.find_available_microservices("members_score")
+    assert microservices
+    before = api.cache_stats().get(Microservice.__tablename__, {"hits": 0, "misses": 0})
+
+    for microservice in microservices:
+        cached = api.find_by_id(Microservice, microservice.id)
+        assert cached is not microservice
+        assert cached.id == microservice.id and cached.tenantId == microservice.tenantId
+
+    after = api.cache_stats()[Microservice.__tablename__]
+    assert after["hits"] == before["hits"] + len(microservices)
+    assert after["misses"] == before["misses"]
+
+
+def test_lru_cache_expires_and_evicts():
+    """Tests the TTL expiry and the LRU eviction of the in-process cache"""
+    now = [0]
+    cache = LRUCache(max_size=2, clock=lambda: now[0])
+    cache.set(("tenants", "a"), "a", ttl=10)
+    cache.set(("tenants", "b"), "b", ttl=10)
+    assert cache.get(("tenants", "a")) == "a"
+
+    # b is the least recently used entry
+    cache.set(("tenants", "c"), "c", ttl=10)
+    assert cache.get(("tenants", "b")) is None
+
+    now[0] = 11
+    assert cache.get(("tenants", "a")) is None
+    assert cache.stats()["tenants"] == {"hits": 1, "misses": 2}
+
+
+def test_jsonb_operators_match(api: "Repository"):
+    """Tests that the index-friendly JSONB operators return the same members as the path equality"""
+    query = {"attributes.isTeamMember.default": True}
+    expected = {member.id for member in api.find_all(Member, query=query)}
+
+    for jsonb_operator in (JsonbOperators.CONTAINS, JsonbOperators.PATH_EXISTS):
+        result = {member.id for member in api.find_all(Member, query=query, jsonb_operator=jsonb_operator)}
+        assert result == expected
+        assert api.count(Member, dict(query), jsonb_operator=jsonb_operator) == len(expected)
+
+
+def test_find_page_walks_all_members(api: "Repository"):
+    """Tests that following the cursors of find_page returns every member once, in createdAt order"""
+    expected = api.find_all(Member, order={Member.createdAt: False})
+
+    members = []
+    page = api.find_page(Member, page_size=7)
+    members.extend(page.items)
+    while page.next_cursor:
+        page = api.find_page(Member, page_size=7, cursor=page.next_cursor)
+        assert len(page.items) <= 7
+        members.extend(page.items)
+
+    expected = sorted(expected, key=lambda member: (member.createdAt, str(member.id)), reverse=True)
+    assert [member.id for member in members] == [member.id for member in expected]
+
+
+def test_named_query_is_prepared_once(api: "Repository"):
+    """Tests that a named query is prepared once per connection and reused across tenants"""
+    first = api.find_all_usernames()
+    second = api.find_all_usernames()
+    assert len(first) == len(second) > 0
+
+    with api.engine.connect() as con:
+        prepared = con.connection.info.get("prepared_statements", set())
+    assert FIND_ALL_USERNAMES in prepared
+
+
+def test_named_query_positional_parameters():
+    """Tests the conversion of :name parameters into prepared statement placeholders"""
+    query = NamedQuery("test_query", "select :a::int + :b + :a", types={"a": "int"})
+    assert query.prepare_sql == "PREPARE test_query(int, unknown) AS select $1::int + $2 + $1"
+    assert query.execute_sql == "EXECUTE test_query(%(a)s, %(b)s)"
+
+
+def test_stream_query(api: "Repository"):
+    """Tests that a streamed named query returns the rows of the executed one, in chunks"""
+    chunks = list(api.stream_query(FIND_ALL_USERNAMES, chunk_size=10, tenant_id=api.tenant_id))
+
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert sorted(row for chunk in chunks for row in chunk) == sorted(api.find_all_usernames())
+
+
+def test_count_by_tenant(api: "Repository"):
+    """Tests that the batched count matches the per tenant count"""
+    unknown = "123e4567-e89b-12d3-a456-426614174000"
+    result = api.count_by_tenant(Member, [api.tenant_id, unknown])
+
+    assert result == {api.tenant_id: api.count(Member), unknown: 0}
+
+
+def test_find_team_members_by_tenant(api: "Repository"):
+    """Tests that the batched team members match the per tenant query"""
+    result = api.find_team_members_by_tenant([api.tenant_id])
+    expected = api.find_all(Member, query={"attributes.isTeamMember.default": True})
+
+    assert sorted(result[api.tenant_id]) == sorted(member.id for member in expected)
+
+
+def test_query_stats(api: "Repository"):
+    """Tests that executions of the same statement with different parameters are aggregated together"""
+    api.query_stats.reset()
+    api.find_by_id(Member, "26f6d9ed-cf73-4dad-80f2-7f6e23a38370")
+    api.find_by_id(Member, "123e4567-e89b-12d3-a456-426614174000")
+
+    summary = api.log_query_stats()
+    assert len(summary) == 1
+    assert summary[0]["calls"] == 2
+    assert "members.id = ?" in summary[0]["fingerprint"]
+    assert api.query_stats.summary() == []
+
+
+def test_fingerprint():
+    """Tests that literals and parameters are removed from fingerprints"""
+    statement = "SELECT *  FROM members\n WHERE id IN (%(id_1)s, %(id_2)s) AND name = 'it''s' LIMIT 10"
+    assert fingerprint(statement) == "SELECT * FROM members WHERE id IN (?) AND name = ? LIMIT ?"
+
+
+class ListExporter(tracing.Exporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+def test_tracing_spans():
+    """Tests that spans nest, record errors, and that the traces are sampled at their root"""
+    exporter = ListExporter()
+
+    @tracing.traced("inner")
+    def inner():
+        tracing.current_span().set_attribute("rows", 3)
+        raise ValueError("failed")
+
+    tracing.configure(sample_rate=1, exporter=exporter)
+    try:
+        with tracing.span("root", tenant="tenant") as root:
+            with pytest.raises(ValueError):
+                inner()
+        tracing.configure(sample_rate=0, exporter=exporter)
+        with tracing.span("unsampled") as unsampled:
+            with tracing.span("child") as child:
+                assert tracing.start_span("leaf") is tracing.NOOP_SPAN
+    finally:
+        tracing.configure()
+
+    assert [span.name for span in exporter.spans] == ["inner", "root"]
+    inner_span, root_span = exporter.spans
+    assert inner_span.parent_id == root.span_id and inner_span.trace_id == root.trace_id
+    assert inner_span.attributes == {"rows": 3} and inner_span.error == "ValueError: failed"
+    assert root_span.parent_id is None and root_span.attributes == {"tenant": "tenant"} and root_span.error is None
+    assert unsampled is tracing.NOOP_SPAN and child is tracing.NOOP_SPAN
+
+
+def test_query_spans(api: "Repository"):
+    """Tests that the statements of a traced block are recorded as its children"""
+    exporter = ListExporter()
+    tracing.configure(sample_rate=1, exporter=exporter)
+    try:
+        api.find_all_usernames()
+        with tracing.span("job") as job:
+            usernames = api.find_all_usernames()
+    finally:
+        tracing.configure()
+
+    queries = [span for span in exporter.spans if span.name == "db.query"]
+    assert queries and all(span.parent_id == job.span_id for span in queries)
+    assert queries[-1].attributes["rows"] == len(usernames)
+    assert queries[-1].attributes["tenant"] == str(api.tenant_id)
+    assert exporter.spans[-1] is job
+
+
+def test_isolation_profiles(api: "Repository"):
+    """Tests that lookups run in read committed and aggregates in a read only snapshot"""
+    with api.connect(QueryClasses.LOOKUP) as con:
+        assert con.exec_driver_sql("show transaction_isolation").scalar() == "read committed"
+        assert con.exec_driver_sql("show transaction_read_only").scalar() == "on"
+
+    with api.connect(QueryClasses.AGGREGATE) as con:
+        assert con.exec_driver_sql("show transaction_isolation").scalar() == "repeatable read"
+        assert con.exec_driver_sql("show transaction_deferrable").scalar() == "off"
+
+
+def test_snapshot_wait_is_bounded(api: "Repository"):
+    """Tests that the statement timeout is applied before waiting for a safe snapshot"""
+    repository = Repository(
+        api.tenant_id, api.db_url, isolation={QueryClasses.AGGREGATE: IsolationProfiles.SERIALIZABLE_DEFERRABLE}
+    )
+    statements = []
+    event.listen(
+        repository.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    with repository.connect(QueryClasses.AGGREGATE, timeout=5):
+        pass
+
+    assert statements[0].startswith("SET LOCAL statement_timeout") and statements[1] == "SELECT 1"
+
+
+def test_statement_timeout(api: "Repository"):
+    """Tests that a statement running past its timeout is cancelled with a structured error"""
+    with pytest.raises(RepositoryTimeoutError) as e:
+        with api.connect(timeout=0.1) as con:
+            con.exec_driver_sql("select pg_sleep(1)")
+
+    assert e.value.tenant_id == api.tenant_id
+    assert e.value.timeout_ms == 100
+
+
+def test_statement_timeout_is_per_transaction(api: "Repository"):
+    """Tests that a cancellation in a transaction without a timeout is not reported with the timeout of a previous one"""
+    with api.connect(timeout=5):
+        pass
+
+    with pytest.raises(OperationalError):
+        with api.connect() as con:
+            con.exec_driver_sql("SET LOCAL statement_timeout = 50")
+            con.exec_driver_sql("select pg_sleep(1)")
+
+
+def test_deadline_passed(api: "Repository"):
+    """Tests that no statement is executed once the deadline has passed"""
+    with api.budget(0):
+        with pytest.raises(RepositoryTimeoutError):
+            api.find_all(Member)
+
+    assert api.deadline is None
+
+
+def test_count_approximate(api: "Repository"):
+    """Tests the approximate count, its exact fallback and the refreshed cached count"""
+    exact = api.count(Activity)
+    api.invalidate(Activity)
+
+    # Below the threshold the count is exact
+    assert api.count(Activity, approximate=True, threshold=exact + 1) == exact
+    # Above it the planner estimate is returned
+    assert api.count(Activity, approximate=True, threshold=0) > 0
+
+    assert api.refresh_count(Activity) == exact
+    assert api.count(Activity, approximate=True, threshold=0) == exact
+
+    # The counts of the coordinators have their own cache, lookups do not evict them
+    api.invalidate(Activity)
+    assert api.refresh_counts(Activity, [api.tenant_id]) == {api.tenant_id: exact}
+    assert api.count(Activity, approximate=True, threshold=0) == exact
+    assert api.count_cache is not api.cache
+
+
+def test_unit_of_work(api: "Repository"):
+    """Tests that the calls of a unit of work share one session and keep documents attached"""
+    with api.unit_of_work() as session:
+        member = api.find_all(Member)[0]
+        same = api.find_in_table(Member, {"id": member.id})
+        activities = member.activities.all()
+
+        assert same is member
+        assert api.find_all_usernames() is not None
+        assert session.is_active
+
+    assert all(activity.memberId == member.id for activity in activities)
+
+
+def test_eager_loading(api: "Repository"):
+    """Tests that eagerly loaded relationships are available once the documents are detached"""
+    activities = api.find_all(Activity, eager={"parentMember": "selectin"})
+
+    assert all(activity.parentMember.id == activity.memberId for activity in activities)
+
+
+def test_static_shard_map():
+    """Tests the routing of tenants to shards, and the default shard of the unknown ones"""
+    shard_map = StaticShardMap({"default": "postgresql://a", "large": "postgresql://b"}, {"t1": "large"})
+
+    assert shard_map.shard_for("t1") == "large"
+    assert shard_map.shard_for("t2") == "default"
+    assert shard_map.shard_for("") == "default"
+    assert shard_map.group(["t1", "t2", "t3"]) == {"large": ["t1"], "default": ["t2", "t3"]}
+
+    with pytest.raises(ValueError):
+        StaticShardMap({"default": "postgresql://a"}, {"t1": "missing"})
+
+
+def sharded(api, tenant_id):
+    # Two shards on the test database, different urls so that they get different pools
+    url = api.engine.url
+    other = url.update_query_dict({"application_name": "other"})
+    shard_map = StaticShardMap(
+        {"default": url.render_as_string(hide_password=False), "other": other.render_as_string(hide_password=False)},
+        {api.tenant_id: "other"},
+    )
+    return Repository(tenant_id, shard_map=shard_map)
+
+
+def test_shard_routing(api: "Repository"):
+    """Tests that a tenant is served by its shard, with one pool per shard shared by the repositories"""
+    repository = sharded(api, api.tenant_id)
+    assert repository.shard == "other"
+    assert repository.engine.url.query["application_name"] == "other"
+    assert repository.count(Member) == api.count(Member)
+
+    assert sharded(api, api.tenant_id).engine.pool is repository.engine.pool
+    assert sharded(api, "").engine.pool is not repository.engine.pool
+
+    with repository.on_shard("default"):
+        assert repository.shard == "default"
+    assert repository.shard == "other"
+
+
+def test_fan_out(api: "Repository"):
+    """Tests that coordinator and batched queries span all the shards"""
+    repository = sharded(api, "")
+    unknown = "123e4567-e89b-12d3-a456-426614174000"
+
+    # Both shards are the test database, so every microservice is found twice
+    microservices = repository.find_available_microservices("members_score")
+    assert len(microservices) == 2 * len(api.find_available_microservices("members_score"))
+
+    assert repository.count_by_tenant(Member, [api.tenant_id, unknown]) == api.count_by_tenant(
+        Member, [api.tenant_id, unknown]
+    )
+    assert repository.fan_out(lambda shard: repository.shard) == {"default": "default", "other": "other"}
+
+    # The queries of the shards are children of the span of the caller
+    def select_one(shard):
+        with repository.engine.connect() as con:
+            return con.execute(text("SELECT 1")).scalar()
+
+    exporter = ListExporter()
+    tracing.configure(sample_rate=1, exporter=exporter)
+    try:
+        with tracing.span("coordinator") as coordinator:
+            assert repository.fan_out(select_one) == {"default": 1, "other": 1}
+    finally:
+        tracing.configure()
+    queries = [span for span in exporter.spans if span.name == "db.query"]
+    assert len(queries) >= 2
+    assert all(span.parent_id == coordinator.span_id for span in queries)
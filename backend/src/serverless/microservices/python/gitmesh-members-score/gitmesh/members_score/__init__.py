@@ -1,2 +1,3 @@
+from .batch import members_score_batch  # noqa
 from .members_score import MembersScore  # noqa
-from .worker import members_score_worker  # noqa
\ No newline at end of file
+from .worker import members_score_worker, online_score_worker  # noqa
\ No newline at end of file
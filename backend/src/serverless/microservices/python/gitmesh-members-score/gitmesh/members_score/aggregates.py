@@ -0,0 +1,345 @@
+"""
+Incremental monthly engagement aggregates.
+
+The mean scores of a tenant only change for the members with new or updated activities, and through the
+sliding window. Instead of aggregating a full year of activities on every run, the per member monthly
+count, sum and sum of squares of the daily activities are persisted with a watermark, and each run only:
+  - re-aggregates the months of the members whose activities changed since the watermark, or who were updated,
+  - drops the months of the members deleted since, like the members merged into another one,
+  - aggregates the first month of the window, which is the only one losing days as the window slides.
+A merge moves the activities of the merged member to the kept one without updating them, the kept member is
+updated and the merged one deleted, so both are caught.
+The mean and standard deviation of every month, zero days included, are then derived in closed form,
+exactly like the MEAN_SCORES query does. The aggregates live in a state backend shared by the workers, see states.
+"""
+import io
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.repository.isolation import QueryClasses
+from gitmesh.backend.repository.queries import register_query
+from gitmesh.members_score.states import FileStateBackend
+
+logger = get_logger(__name__)
+
+# Stored aggregates older than this are rebuilt from scratch, to pick up hard deleted activities of remaining members
+REBUILD_DAYS = 7
+
+WINDOW = register_query(
+    "members_score_window",
+    """select (now() - make_interval(days => :days))::timestamp::date as first_day,
+        now()::timestamp::date as last_day,
+        now() - interval '5 minutes' as watermark""",
+    types={"days": "int"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+MONTHLY_AGGREGATES_SQL = """select "memberId", date_trunc('month', day)::date as month, sum(e), sum(e::numeric * e),
+        sum(s), sum(s::numeric * s)
+    from (
+        select "memberId", date("timestamp") as day, count(*) as e, sum(score) as s
+        from activities
+        where "tenantId" = CAST(:tenant_id as uuid)
+            and "timestamp" >= CAST(:start as date) and "timestamp" < CAST(:end as date){members}
+        group by "memberId", date("timestamp")
+    ) daily
+    group by "memberId", date_trunc('month', day)"""
+
+MONTHLY_AGGREGATES = register_query(
+    "members_score_monthly_aggregates",
+    MONTHLY_AGGREGATES_SQL.format(members=""),
+    types={"tenant_id": "uuid", "start": "date", "end": "date"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+MEMBERS_MONTHLY_AGGREGATES = register_query(
+    "members_score_members_monthly_aggregates",
+    MONTHLY_AGGREGATES_SQL.format(members='\n            and "memberId" = ANY(:member_ids)'),
+    types={"tenant_id": "uuid", "start": "date", "end": "date", "member_ids": "uuid[]"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+ACTIVE_MEMBERS = register_query(
+    "members_score_active_members",
+    """select distinct "memberId" from activities where "tenantId" = CAST(:tenant_id as uuid)""",
+    types={"tenant_id": "uuid"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+# Activities are inserted and updated with their updatedAt set, so it catches new and rescored activities.
+# Merges move activities without updating them, but update the member they are merged into.
+CHANGED_MEMBERS = register_query(
+    "members_score_changed_members",
+    """select "memberId" from activities
+    where "tenantId" = CAST(:tenant_id as uuid) and "updatedAt" > :watermark
+    union
+    select id from members
+    where "tenantId" = CAST(:tenant_id as uuid) and "updatedAt" > :watermark""",
+    types={"tenant_id": "uuid", "watermark": "timestamptz"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+MEMBERS_WITH_ACTIVITIES = register_query(
+    "members_score_members_with_activities",
+    """select distinct "memberId" from activities
+    where "tenantId" = CAST(:tenant_id as uuid) and "memberId" = ANY(:member_ids)""",
+    types={"tenant_id": "uuid", "member_ids": "uuid[]"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+TENANT_MEMBERS = register_query(
+    "members_score_tenant_members",
+    """select id from members where "tenantId" = CAST(:tenant_id as uuid)""",
+    types={"tenant_id": "uuid"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+
+def month_ordinal(day):
+    return day.year * 12 + day.month - 1
+
+
+class MonthlyAggregates(object):
+    """
+    Per member monthly aggregates of the daily activities of a tenant: count (e), sum of squared daily counts (e2),
+    score (s) and sum of squared daily scores (s2), keyed by member and month.
+    """
+
+    def __init__(self, watermark, built_at, days, members, rows):
+        """
+        Initialise the aggregates.
+
+        Args:
+            watermark (datetime): activities updated after it are not aggregated yet
+            built_at (datetime): when the aggregates were last built from scratch
+            days (int): length of the window they were aggregated for
+            members (set): ids of the members with activities, in or out of the window
+            rows (dict): {(member id, month ordinal): (e, e2, s, s2)}
+        """
+        self.watermark = watermark
+        self.built_at = built_at
+        self.days = days
+        self.members = members
+        self.rows = rows
+
+    def replace_members(self, member_ids, rows, active=None):
+        """
+        Replace all the months of some members
+
+        Args:
+            member_ids (iterable): the ids of the members
+            rows (dict): their new months, {(member id, month ordinal): (e, e2, s, s2)}
+            active (iterable, optional): those of them with activities, in or out of the window. Defaults to all.
+        """
+        member_ids = set(member_ids)
+        self.rows = {key: value for key, value in self.rows.items() if key[0] not in member_ids}
+        self.rows.update(rows)
+        self.members = (self.members - member_ids) | (member_ids if active is None else set(active))
+
+    def prune(self, first_month):
+        """
+        Drop the months before first_month, they left the window
+        """
+        self.rows = {key: value for key, value in self.rows.items() if key[1] >= first_month}
+
+
+class AggregateStore(object):
+    """
+    Interface of the persistence of the monthly aggregates of every tenant.
+    """
+
+    def load(self, tenant_id):
+        """
+        Returns:
+            MonthlyAggregates: the aggregates of the tenant, None if there are none
+        """
+        raise NotImplementedError
+
+    def save(self, tenant_id, aggregates):
+        raise NotImplementedError
+
+
+class StateAggregateStore(AggregateStore):
+    """
+    Aggregates stored as one compressed NumPy archive per tenant in a state backend, see states.
+    """
+
+    name = "npz"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, tenant_id):
+        data = self.backend.load(tenant_id, self.name)
+        if data is None:
+            return None
+
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            members = [uuid.UUID(member_id) for member_id in archive["members"]]
+            row_members = archive["row_members"]
+            months = archive["months"].tolist()
+            values = archive["values"].tolist()
+            watermark, built_at = (datetime.fromisoformat(str(time)) for time in archive["times"])
+            days = int(archive["days"])
+
+        rows = {(members[index], month): tuple(value) for index, month, value in zip(row_members, months, values)}
+        return MonthlyAggregates(watermark, built_at, days, set(members), rows)
+
+    def save(self, tenant_id, aggregates):
+        members = sorted(aggregates.members, key=str)
+        index = {member_id: i for i, member_id in enumerate(members)}
+        keys = list(aggregates.rows)
+
+        data = io.BytesIO()
+        np.savez_compressed(
+            data,
+            members=np.array([str(member_id) for member_id in members], dtype="U36"),
+            row_members=np.array([index[member_id] for member_id, _ in keys], dtype=np.int64),
+            months=np.array([month for _, month in keys], dtype=np.int64),
+            values=np.array([aggregates.rows[key] for key in keys], dtype=float).reshape(-1, 4),
+            times=np.array([aggregates.watermark.isoformat(), aggregates.built_at.isoformat()]),
+            days=np.array(aggregates.days),
+        )
+        self.backend.save(tenant_id, self.name, data.getvalue())
+
+
+class FileAggregateStore(StateAggregateStore):
+    """
+    Aggregates stored as one compressed NumPy archive per tenant in a local directory, for a single worker.
+    """
+
+    def __init__(self, directory):
+        super().__init__(FileStateBackend(directory))
+
+
+def _monthly_rows(result):
+    return {
+        (member_id, month_ordinal(month)): (float(e), float(e2), float(s), float(s2))
+        for member_id, month, e, e2, s, s2 in result
+    }
+
+
+def update_aggregates(repository, store, days):
+    """
+    Bring the stored aggregates of the repository's tenant up to date, building them on first use
+
+    Args:
+        repository (Repository): the repository of the tenant
+        store (AggregateStore): where the aggregates are persisted
+        days (int): length of the window, in days
+
+    Returns:
+        (MonthlyAggregates, dict, date, date): the cached months, the first month of the window
+            ({(member id, month ordinal): (e, e2, s, s2)}), and the first and last day of the window
+    """
+    tenant_id = repository.tenant_id
+    first_day, last_day, watermark = repository.execute_query(WINDOW, days=days)[0]
+    # The first month of the window loses days as it slides, it is never cached
+    cached_start = (first_day.replace(day=1) + timedelta(days=32)).replace(day=1)
+    end = last_day + timedelta(days=1)
+
+    aggregates = store.load(tenant_id)
+    now = datetime.now(timezone.utc)
+    if aggregates is None or aggregates.days != days or now - aggregates.built_at > timedelta(days=REBUILD_DAYS):
+        members = {row[0] for row in repository.execute_query(ACTIVE_MEMBERS, tenant_id=tenant_id)}
+        rows = _monthly_rows(
+            repository.execute_query(MONTHLY_AGGREGATES, tenant_id=tenant_id, start=cached_start, end=end)
+        )
+        aggregates = MonthlyAggregates(watermark, now, days, members, rows)
+        logger.info(f"Built the monthly aggregates of tenant {tenant_id}: {len(rows)} member-months")
+    else:
+        changed = [
+            row[0]
+            for row in repository.execute_query(CHANGED_MEMBERS, tenant_id=tenant_id, watermark=aggregates.watermark)
+        ]
+        if changed:
+            aggregates.replace_members(
+                changed,
+                _monthly_rows(
+                    repository.execute_query(
+                        MEMBERS_MONTHLY_AGGREGATES, tenant_id=tenant_id, start=cached_start, end=end, member_ids=changed
+                    )
+                ),
+                [
+                    row[0]
+                    for row in repository.execute_query(
+                        MEMBERS_WITH_ACTIVITIES, tenant_id=tenant_id, member_ids=changed
+                    )
+                ],
+            )
+
+        # The members deleted since, e.g. merged into another one, have no activities left
+        existing = {row[0] for row in repository.execute_query(TENANT_MEMBERS, tenant_id=tenant_id)}
+        deleted = aggregates.members - existing
+        if deleted:
+            aggregates.replace_members(deleted, {}, [])
+
+        aggregates.watermark = watermark
+        aggregates.prune(month_ordinal(cached_start))
+        logger.info(
+            f"Updated the monthly aggregates of tenant {tenant_id}: "
+            f"{len(changed)} members changed, {len(deleted)} deleted"
+        )
+
+    store.save(tenant_id, aggregates)
+
+    first_month = _monthly_rows(
+        repository.execute_query(MONTHLY_AGGREGATES, tenant_id=tenant_id, start=first_day, end=cached_start)
+    )
+    return aggregates, first_month, first_day, last_day
+
+
+def mean_scores(aggregates, first_month, first_day, last_day):
+    """
+    Rows of the mean scores, like the MEAN_SCORES query returns them, from monthly aggregates
+
+    Args:
+        aggregates (MonthlyAggregates): the cached months
+        first_month (dict): the aggregates of the first month of the window
+        first_day (date): the first day of the window
+        last_day (date): the last day of the window
+
+    Returns:
+        list: (member id, mean daily count, mean daily score, stddev of the daily count,
+               stddev of the daily score, month, year) rows, ordered by member, month and year
+    """
+    first_ordinal = month_ordinal(first_day)
+    rows = {**{key: value for key, value in aggregates.rows.items() if key[1] > first_ordinal}, **first_month}
+    if not rows:
+        keys, values = [], np.zeros((0, 4))
+    else:
+        keys = list(rows)
+        values = np.array([rows[key] for key in keys], dtype=float)
+    months = np.array([month for _, month in keys], dtype=np.int64)
+
+    # Days of every month inside the window
+    month_start = (months - 1970 * 12).astype("datetime64[M]")
+    starts = np.maximum(month_start.astype("datetime64[D]"), np.datetime64(first_day, "D"))
+    ends = np.minimum((month_start + 1).astype("datetime64[D]"), np.datetime64(last_day, "D") + 1)
+    days = (ends - starts).astype(np.int64).astype(float)
+
+    e, e2, s, s2 = values.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stddev_e = np.where(days > 1, np.sqrt(np.maximum(e2 - e * e / days, 0) / (days - 1)), 0)
+        stddev_s = np.where(days > 1, np.sqrt(np.maximum(s2 - s * s / days, 0) / (days - 1)), 0)
+
+    result = [
+        (member_id, mean_e, mean_s, sd_e, sd_s, month % 12 + 1, month // 12)
+        for (member_id, month), mean_e, mean_s, sd_e, sd_s in zip(
+            keys, (e / days).tolist(), (s / days).tolist(), stddev_e.tolist(), stddev_s.tolist()
+        )
+    ]
+
+    # Members without activities in the window get a single zero row, so that they are scored 0
+    active = {member_id for member_id, _ in keys}
+    result.extend(
+        (member_id, 0.0, 0.0, 0.0, 0.0, last_day.month, last_day.year)
+        for member_id in aggregates.members
+        if member_id not in active
+    )
+
+    result.sort(key=lambda row: (str(row[0]), row[5], row[6]))
+    return result
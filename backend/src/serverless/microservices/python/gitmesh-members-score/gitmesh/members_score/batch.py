@@ -0,0 +1,101 @@
+"""
+Batch members score of all the tenants, in one job instead of one queue message per tenant.
+
+The tenants of the coordinator query are scored by a pool of processes, one per core, every tenant with
+members_score_worker as if its message was received, so the results are the ones of MembersScore(tenant).main().
+The job does not requeue the tenants: a timeout is reported as the error of its tenant, which the next job scores.
+The tenants are handed out one at a time, so a large tenant does not hold back the ones partitioned after it.
+The python worker runs it as a job of its own, see members_score_batch.py, not in its message loop.
+"""
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from gitmesh.backend.enums import Services
+from gitmesh.backend.infrastructure.config import MEMBERS_SCORE_BATCH_PROCESSES
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.sharding import dispose_engines
+from gitmesh.members_score.worker import members_score_worker
+
+logger = get_logger(__name__)
+
+
+def _score_tenant(tenant_id, microservice_id, db_url, send):
+    """
+    Score a tenant in a pool process, and report how it went
+
+    Returns:
+        dict: {"tenant_id", "microservice_id", "seconds", "members": scored members or None, "error": None or traceback}
+    """
+    start = time.time()
+    members, error = None, None
+    try:
+        members = members_score_worker(tenant_id, microservice_id, db_url=db_url, send=send, requeue=False)
+    except Exception:
+        error = traceback.format_exc()
+        logger.error(f"members_score failed for tenant {tenant_id}: {error}")
+    return {
+        "tenant_id": tenant_id,
+        "microservice_id": microservice_id,
+        "seconds": time.time() - start,
+        "members": members,
+        "error": error,
+    }
+
+
+def members_score_batch(tenants=None, processes=None, db_url=False, send=True):
+    """
+    Score the tenants of the available members score microservices, in parallel
+
+    Args:
+        tenants ([str], optional): score these tenants only. Defaults to all the tenants of the coordinator query.
+        processes (int, optional): size of the pool. Defaults to MEMBERS_SCORE_BATCH_PROCESSES, or the number of cores.
+        db_url (str, optional): the database url. Defaults to the configured one.
+        send (bool, optional): whether the changed scores are sent. Defaults to True.
+
+    Returns:
+        [dict]: the report of every tenant, see _score_tenant, in the order of the coordinator query
+    """
+    start = time.time()
+    repository = Repository(db_url=db_url)
+    microservices = repository.find_available_microservices(Services.MEMBERS_SCORE.value)
+    if tenants is not None:
+        tenants = {str(tenant_id) for tenant_id in tenants}
+        microservices = [microservice for microservice in microservices if str(microservice.tenantId) in tenants]
+    tasks = [(str(microservice.tenantId), str(microservice.id)) for microservice in microservices]
+    if not tasks:
+        return []
+
+    processes = min(processes or MEMBERS_SCORE_BATCH_PROCESSES or os.cpu_count() or 1, len(tasks))
+
+    reports = {}
+    # Forked processes would share the pooled connections of this one, every process builds its own engines
+    with ProcessPoolExecutor(max_workers=processes, initializer=dispose_engines, initargs=(False,)) as pool:
+        futures = {
+            pool.submit(_score_tenant, tenant_id, microservice_id, db_url, send): (tenant_id, microservice_id)
+            for tenant_id, microservice_id in tasks
+        }
+        for future in as_completed(futures):
+            tenant_id, microservice_id = futures[future]
+            try:
+                reports[tenant_id] = future.result()
+            except Exception:
+                # The process died, e.g. out of memory
+                error = traceback.format_exc()
+                logger.error(f"members_score process failed for tenant {tenant_id}: {error}")
+                reports[tenant_id] = {
+                    "tenant_id": tenant_id,
+                    "microservice_id": microservice_id,
+                    "seconds": None,
+                    "members": None,
+                    "error": error,
+                }
+
+    failed = [tenant_id for tenant_id, report in reports.items() if report["error"] is not None]
+    logger.info(
+        f"Scored {len(tasks) - len(failed)} of {len(tasks)} tenants with {processes} processes "
+        f"in {time.time() - start:.1f}s" + (f", failed: {failed}" if failed else "")
+    )
+    return [reports[tenant_id] for tenant_id, _ in tasks]
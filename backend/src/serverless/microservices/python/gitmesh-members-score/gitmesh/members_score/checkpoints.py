@@ -0,0 +1,198 @@
+"""
+Checkpointed publishing of the members scores.
+
+A run that reaches the time budget before all the changed scores are published saves the ones left, and the
+position reached, in a checkpoint. The worker requeues the tenant with the token of the checkpoint, and the next
+run publishes the rest of the diff from there instead of scoring the tenant again. The member ids are kept as
+16 bytes each, and the checkpoints in a state backend that every worker sees, see states.
+"""
+import io
+import time
+import uuid
+
+import numpy as np
+
+from gitmesh.backend.controllers import MembersController
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.keys import DBKeys as dbk
+from gitmesh.members_score.scoring import bytes_id, id_bytes
+from gitmesh.members_score.states import FileStateBackend
+
+logger = get_logger(__name__)
+
+
+class PublishCheckpoint(object):
+    """
+    The changed scores of a run, and how many of them are published.
+    """
+
+    def __init__(self, member_ids, levels, position=0, members=None, token=None):
+        """
+        Args:
+            member_ids (iterable): the members whose score changed, kept as 16 bytes each, see id_bytes
+            levels ([int]): their new score
+            position (int, optional): number of scores published so far. Defaults to 0.
+            members (int, optional): number of members the run scored. Defaults to the number of changed scores.
+            token (str, optional): identifies the checkpoint in the resume messages. Defaults to a new one.
+        """
+        self.member_ids = id_bytes(member_ids)
+        self.levels = np.asarray(levels, dtype=np.int64)
+        self.position = position
+        self.members = len(self.member_ids) if members is None else members
+        self.token = token or uuid.uuid4().hex
+
+    @property
+    def done(self):
+        return self.position >= len(self.member_ids)
+
+    def publish(self, members_controller, deadline, send=True, chunk_size=1):
+        """
+        Publish the scores left, until the deadline
+
+        Args:
+            members_controller (MembersController): the controller of the tenant
+            deadline (float): time.time() after which no more scores are published
+            send (bool, optional): whether the scores are sent. Defaults to True.
+            chunk_size (int, optional): scores sent per message. Defaults to 1.
+
+        Returns:
+            int: the number of scores published by this call
+        """
+        first = self.position
+        while not self.done and time.time() <= deadline:
+            end = min(self.position + chunk_size, len(self.member_ids))
+            members_controller.update(
+                [
+                    {"id": str(bytes_id(member_id)), "update": {dbk.SCORE: level}}
+                    for member_id, level in zip(
+                        self.member_ids[self.position : end].tolist(), self.levels[self.position : end].tolist()
+                    )
+                ],
+                send=send,
+            )
+            self.position = end
+        return self.position - first
+
+
+class CheckpointStore(object):
+    """
+    Interface of the persistence of the unfinished publishing of every tenant, one checkpoint per tenant.
+    """
+
+    def load(self, tenant_id, token):
+        """
+        Returns:
+            PublishCheckpoint: the checkpoint of the tenant, None if there is none or it has another token
+        """
+        raise NotImplementedError
+
+    def save(self, tenant_id, checkpoint):
+        raise NotImplementedError
+
+    def delete(self, tenant_id):
+        raise NotImplementedError
+
+
+class StateCheckpointStore(CheckpointStore):
+    """
+    Checkpoints stored as one NumPy archive per tenant in a state backend, see states. With a shared backend, any
+    worker resumes the publishing of the others.
+    """
+
+    name = "checkpoint.npz"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, tenant_id, token):
+        data = self.backend.load(tenant_id, self.name)
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            if str(archive["token"]) != token:
+                return None
+            return PublishCheckpoint(
+                archive["member_ids"], archive["levels"], int(archive["position"]), int(archive["members"]), token
+            )
+
+    def save(self, tenant_id, checkpoint):
+        data = io.BytesIO()
+        np.savez(
+            data,
+            token=np.array(checkpoint.token),
+            member_ids=checkpoint.member_ids,
+            levels=checkpoint.levels,
+            position=np.array(checkpoint.position),
+            members=np.array(checkpoint.members),
+        )
+        self.backend.save(tenant_id, self.name, data.getvalue())
+
+    def delete(self, tenant_id):
+        self.backend.delete(tenant_id, self.name)
+
+
+class FileCheckpointStore(StateCheckpointStore):
+    """
+    Checkpoints stored as one NumPy archive per tenant in a local directory, for a single worker.
+    """
+
+    def __init__(self, directory):
+        super().__init__(FileStateBackend(directory))
+
+
+def publish_with_checkpoint(tenant_id, checkpoint, store, repository, deadline, send=True, chunk_size=1):
+    """
+    Publish the scores left in a checkpoint, and save it if the deadline is reached before the end
+
+    Args:
+        tenant_id (str): the tenant ID
+        checkpoint (PublishCheckpoint): the scores to publish
+        store (CheckpointStore): where the unfinished checkpoint is saved. None drops the scores left.
+        repository (Repository): the repository of the tenant
+        deadline (float): time.time() after which no more scores are published
+        send (bool, optional): whether the scores are sent. Defaults to True.
+        chunk_size (int, optional): scores sent per message. Defaults to 1.
+
+    Returns:
+        str: the token of the saved checkpoint, None when every score is published or there is no store
+    """
+    published = checkpoint.publish(MembersController(tenant_id, repository=repository), deadline, send, chunk_size)
+    if checkpoint.done:
+        if store is not None:
+            store.delete(tenant_id)
+        return None
+
+    left = len(checkpoint.member_ids) - checkpoint.position
+    if store is None:
+        logger.warning(f"Time budget spent for tenant {tenant_id}, {left} changed scores are not published")
+        return None
+
+    store.save(tenant_id, checkpoint)
+    logger.info(
+        f"Time budget spent for tenant {tenant_id} after publishing {published} scores, "
+        f"checkpoint {checkpoint.token} keeps the {left} left"
+    )
+    return checkpoint.token
+
+
+def resume_publishing(tenant_id, token, store, deadline, repository=False, send=True):
+    """
+    Publish the scores left by a previous run
+
+    Args:
+        tenant_id (str): the tenant ID
+        token (str): the token of the checkpoint
+        store (CheckpointStore): the checkpoints
+        deadline (float): time.time() after which no more scores are published
+        repository (Repository, optional): the repository of the tenant. Defaults to a new one.
+        send (bool, optional): whether the scores are sent. Defaults to True.
+
+    Returns:
+        (PublishCheckpoint, str): the checkpoint, None if it is gone, and the token to resume with, None once done
+    """
+    checkpoint = store.load(tenant_id, token)
+    if checkpoint is None:
+        return None, None
+    repository = repository if repository else Repository(tenant_id=tenant_id)
+    return checkpoint, publish_with_checkpoint(tenant_id, checkpoint, store, repository, deadline, send)
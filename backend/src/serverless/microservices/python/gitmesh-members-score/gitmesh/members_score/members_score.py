@@ -1,23 +1,133 @@
 import decimal
+from gitmesh.backend.infrastructure.config import MEMBERS_SCORE_IN_DATABASE
 from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import current_span, span, traced
 from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.queries import register_query
+from gitmesh.backend.repository.isolation import QueryClasses
 from gitmesh.backend.repository.keys import DBKeys as dbk
 from datetime import datetime
-from dateutil import parser
-from gitmesh.backend.controllers import MembersController
 from gitmesh.backend.models import Member, Tenant
+from gitmesh.backend.enums import JsonbOperators
 import time
 from gitmesh.backend.utils.datetime import GitmeshDateTime as gdt
-from sklearn.cluster import KMeans
+from gitmesh.members_score.aggregates import mean_scores, update_aggregates
+from gitmesh.members_score.checkpoints import PublishCheckpoint, publish_with_checkpoint
+from gitmesh.members_score.normalisers import WarmStartNormaliser, normaliser_from_config
+from gitmesh.members_score.scoring import DECAY, K, M, lookalike_scores, member_scores
 import numpy as np
 
 logger = get_logger(__name__)
 
+# Seconds a members score job may run, including the publishing of the scores
+TIME_BUDGET = 800
+
+# Days of activity taken into account
+DAYS = 364
+# Days of activity taken into account by the degraded plan, used when the full plan timed out
+DEGRADED_DAYS = 91
+
+# Monthly mean and sample standard deviation of the daily activity count and score of every member,
+# zero days included. Only the member-days with activities are read, the zero days are accounted for in closed
+# form from the count, sum and sum of squares of the month and its number of days in the window:
+#   mean = sum / days, stddev = sqrt((sum_sq - sum^2 / days) / (days - 1))
+# Members without activities in the window, but with older (or future) ones, get a single zero row
+# so that they are scored 0. The rows are ordered by member, the order in which normalise gets the scores.
+MEAN_SCORES_SQL = """with bounds as (
+        select (now() - make_interval(days => :days))::timestamp::date as first_day, now()::timestamp::date as last_day
+    ),
+    months as (
+        select month::date as month,
+            least((month + interval '1 month')::date, last_day + 1) - greatest(month::date, first_day) as days
+        from bounds,
+            generate_series(date_trunc('month', first_day::timestamp), last_day::timestamp, interval '1 month') month
+    ),
+    daily as (
+        select "memberId", date("timestamp") as day, count(*) as e, sum(score) as s
+        from activities, bounds
+        where "tenantId" = CAST(:tenant_id as uuid)
+            and "timestamp" >= first_day::timestamptz and "timestamp" < (last_day + 1)::timestamptz
+        group by "memberId", date("timestamp")
+    ),
+    monthly as (
+        select "memberId", date_trunc('month', day)::date as month, sum(e) as e, sum(e::numeric * e) as e2,
+            sum(s) as s, sum(s::numeric * s) as s2
+        from daily
+        group by "memberId", date_trunc('month', day)
+    ),
+    dormant as (
+        select "memberId" from activities where "tenantId" = CAST(:tenant_id as uuid)
+        except
+        select "memberId" from daily
+    )
+    select "memberId", e / days as average_daily_activities, s / days as summed_daily_score,
+        case when days > 1 then sqrt(greatest(e2 - e * e / days, 0) / (days - 1)) else 0 end,
+        case when days > 1 then sqrt(greatest(s2 - s * s / days, 0) / (days - 1)) else 0 end,
+        extract(month from month) as month, extract(year from month) as year
+    from monthly join months using (month)
+    union all
+    select "memberId", 0::numeric, 0::numeric, 0::numeric, 0::numeric, extract(month from last_day),
+        extract(year from last_day)
+    from dormant, bounds
+    order by "memberId", month, year"""
+
+MEAN_SCORES = register_query(
+    "members_score_mean_scores",
+    MEAN_SCORES_SQL,
+    types={"tenant_id": "uuid", "days": "int"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+# Raw score of every member, computed in the database like scoring.member_scores computes it from the MEAN_SCORES
+# rows, so that one row per member is sent instead of one per member-month. :now is the current time of the worker,
+# the decay and the scaling of the current month use its date. Team members are not set to -1.
+RAW_SCORES = register_query(
+    "members_score_raw_scores",
+    f"""with mean_scores ("memberId", e, s, sd_e, sd_s, month, year) as (
+        {MEAN_SCORES_SQL}
+    )
+    select "memberId",
+        sum(
+            power({DECAY}::float8, (CAST(:now as date) - make_date(year::int, month::int, 1)) / 30.0::float8)
+            * case when month = extract(month from :now) then s::float8 * (extract(day from :now)::float8 / 30)
+                else s::float8 end
+            / (1 + sd_s::float8) * ({K}::float8 / {M})
+        )
+    from mean_scores
+    group by "memberId"
+    order by 1""",
+    types={"tenant_id": "uuid", "days": "int", "now": "timestamp"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
 
 class MembersScore:
-    def __init__(self, tenant_id, repository=False, test=False, send=True):
+    def __init__(
+        self,
+        tenant_id,
+        repository=False,
+        test=False,
+        send=True,
+        degraded=False,
+        store=None,
+        normaliser=None,
+        centre_store=None,
+        checkpoint_store=None,
+        in_database=None,
+    ):
 
         self.tenant_id = tenant_id
+        self.degraded = degraded
+        # Monthly aggregates of the incremental mode, the degraded plan always aggregates its window from scratch
+        self.store = store
+        # The degraded plan only aggregates the most recent activities, which weigh the most in the score
+        self.days = DEGRADED_DAYS if degraded else DAYS
+        # Compute the raw scores in the database, see RAW_SCORES. The incremental mode computes them from its aggregates.
+        self.in_database = (MEMBERS_SCORE_IN_DATABASE if in_database is None else in_database) and (
+            store is None or degraded
+        )
+        # Raw score of every member of the in database plan
+        self.raw_scores = None
 
         if not repository:
             self.repository = Repository(tenant_id=self.tenant_id, test=test)
@@ -26,53 +136,60 @@ class MembersScore:
 
         self.fetch_scores()
         self.team_members = [
-            member.id for member in self.repository.find_all(Member, query={"attributes.isTeamMember.default": True})
+            member.id
+            for member in self.repository.find_all(
+                Member, query={"attributes.isTeamMember.default": True}, jsonb_operator=JsonbOperators.CONTAINS
+            )
         ]
 
         self.send = send
 
         self.original_scores = {}
         self.scores = {}
-
+        # Groups the raw scores into levels, see normalisers
+        self.normaliser = normaliser if normaliser is not None else normaliser_from_config()
+        # Sorted cluster centres of the last normalise, the raw score of every level
+        self.centres = None
+        # Centres of the previous runs, that warm start normalise. The degraded plan scores on another scale.
+        self.centre_store = centre_store if not degraded else None
+        # Keeps the changed scores left when the time budget is spent, see checkpoints
+        self.checkpoint_store = checkpoint_store
+        # Token of the checkpoint of the scores left to publish by the last main, None if it published them all
+        self.resume_token = None
+
+    @traced("members_score.fetch_scores")
     def fetch_scores(self):
         """
         This function accesses the database and fetches the mean scores for each member for the last year
 
-        The sql query selects all members for a tenant,
-        and joins it with a table containing every single day for the past year.
-        This resulting table is then used to calculate the monthly mean score of
-        engagement for each member for the past year.
+        The sql query aggregates the activities of the tenant per member and day, and then per member and month.
+        The monthly mean and standard deviation of the daily engagement, days without activities included,
+        are computed from the monthly count, sum and sum of squares.
         The results of this query should be a table where each row contains a member and his/her engagement
-        for each month of the past year.
+        for a month of the past year in which he/she was active.
+
+        With an aggregate store, the monthly aggregates are persisted and only the months of the members with
+        activities updated since the last run are aggregated again, see aggregates.update_aggregates.
+
+        The in database plan fetches the raw score of every member instead, and leaves mean_scores to None.
         """
-        with self.repository.engine.connect() as con:
-
-            id = self.repository.tenant_id
-
-            self.mean_scores = con.execute(
-                f'select "memberId", avg(number_daily_activities) as average_daily_activities, avg(summed_daily_score) as summed_daily_score, coalesce(stddev(number_daily_activities),0), coalesce(stddev(summed_daily_score),0)  ,extract(month from MyJoinDate) as month, extract(year from MyJoinDate) as year\
-                from (\
-                select FullDates."memberId", FullDates.MyJoinDate, coalesce(sum(e), 0) as number_daily_activities, coalesce(sum(s), 0) as summed_daily_score from \
-                (\
-                select "memberId", AllDays.MyJoinDate, coalesce(sum(e), 0) as number_daily_activities, coalesce(sum(s), 0) as summed_daily_score\
-                from\
-                (SELECT date_trunc(\'day\', dd):: date as MyJoinDate\
-                FROM generate_series\
-                    ( (now() - INTERVAL \'364 DAY\')::timestamp\
-                    , (now())::timestamp\
-                    , \'1 day\'::interval) dd\
-                    ) AllDays\
-                cross join ( select "memberId", count(*) as e, sum(score) as s, date("timestamp") as "timestamp"  \
-                from public.activities where "activities"."tenantId" = CAST(\'{id}\' as uuid) \
-                group by "memberId", date("timestamp") ) U\
-                group by "memberId", Alldays.MyJoinDate order by Alldays.MyJoinDate ASC\
-                ) FullDates \
-                left join (select "memberId" as cm_id, count(*) as e, sum(score) as s, date("timestamp") as "timestamp"  \
-                from public.activities where "activities"."tenantId" = CAST(\'{id}\' as uuid) \
-                group by "memberId", date("timestamp")) T on T."cm_id"=FullDates."memberId" and T."timestamp" = FullDates.MyJoinDate\
-                group by FullDates."memberId", FullDates.MyJoinDate order by FullDates.MyJoinDate asc\
-                ) Daily group by "memberId", extract(month from MyJoinDate), extract(year from MyJoinDate)'
-            ).fetchall()
+        if self.in_database:
+            self.mean_scores = None
+            self.raw_scores = self.repository.execute_query(
+                RAW_SCORES, tenant_id=self.repository.tenant_id, days=self.days, now=datetime.now()
+            )
+            current_span().set_attributes(plan="in_database", rows=len(self.raw_scores))
+            return
+
+        if self.store is not None and not self.degraded:
+            self.mean_scores = mean_scores(*update_aggregates(self.repository, self.store, self.days))
+            current_span().set_attributes(plan="aggregates", rows=len(self.mean_scores))
+            return
+
+        self.mean_scores = self.repository.execute_query(
+            MEAN_SCORES, tenant_id=self.repository.tenant_id, days=self.days
+        )
+        current_span().set_attributes(plan="mean_scores", rows=len(self.mean_scores))
 
     def _calculate_months(self, date):
         """
@@ -87,6 +204,9 @@ class MembersScore:
         return (diff.days) / 30
 
     def calculate_member_score(self, i, row):
+        """
+        Score of one mean scores row. _member_scores_ computes the same scores with scoring.member_scores.
+        """
 
         result = 0
 
@@ -114,53 +234,53 @@ class MembersScore:
         return result
 
     def _member_lookalike_score(self, lookalikes):
-        out = {}
-        for member in lookalikes:
-            score = 0
-            if dbk.ACTIONS in member.gitmeshInfo.get("github", {}):
-                for action in member.gitmeshInfo["github"][dbk.ACTIONS]:
-                    timestamp = timestamp = parser.parse(action["timestamp"])
-                    timestamp = timestamp.replace(tzinfo=None)
-                    score += (0.9 ** self._calculate_months(timestamp)) * action["score"]
-
-            twitter = "twitter" in member.username
-            email = member.email
-            if email and twitter:
-                score *= 4
-            elif email or twitter:
-                score *= 2.5
-            out[member.id] = round(score, 2)
-        return out
-
-    def _member_scores_(self, members):
-        """
-        Calculate the raw score for all members based on the activities they performed.
-        Loop through the list of all activities and add the score of the activity weighted by the time since the activity
-        to the score of the member.
         """
+        Lookalike score of members: their GitHub actions decayed by age, with a bonus for the members with an email
+        and a twitter username. The actions of all the members are scored at once, see scoring.lookalike_scores.
 
-        mean_scores = self.mean_scores
-
-        scores = {}
-        for i, row in enumerate(mean_scores):
+        Args:
+            lookalikes (list): the members, as objects or dicts with id, emails, username and gitmeshInfo
 
-            member_id = row[0]
+        Returns:
+            dict: {member id: lookalike score rounded to 2 decimals}
+        """
 
-            # Checking that member is not team member
-            # if "team" not in member.gitmeshInfo:
-            if member_id not in self.team_members:
-                if member_id not in scores:
-                    scores[member_id] = 0
+        def field(member, name):
+            return member.get(name) if isinstance(member, dict) else getattr(member, name, None)
 
-                scores[member_id] += self.calculate_member_score(i, row)
-            else:
-                scores[member_id] = -1
+        member_ids, emails, usernames = [], [], []
+        action_members, timestamps, action_scores = [], [], []
+        for n, member in enumerate(lookalikes):
+            member_ids.append(field(member, "id"))
+            emails.append(field(member, "emails"))
+            usernames.append(field(member, "username"))
+            for action in ((field(member, "gitmeshInfo") or {}).get("github") or {}).get(dbk.ACTIONS, []):
+                action_members.append(n)
+                timestamps.append(action["timestamp"])
+                action_scores.append(action["score"])
 
-        return scores
+        return lookalike_scores(member_ids, action_members, timestamps, action_scores, emails, usernames)
 
+    @traced("members_score.member_scores")
+    def _member_scores_(self, members):
+        """
+        Calculate the raw score for all members based on the activities they performed.
+        Sum the monthly scores of calculate_member_score per member, vectorised over all the mean scores rows.
+        Team members get -1.
+        """
+        if self.raw_scores is not None:
+            team_members = set(self.team_members)
+            return {
+                member_id: -1 if member_id in team_members else float(score) for member_id, score in self.raw_scores
+            }
+        return member_scores(self.mean_scores, self.team_members)
+
+    @traced("members_score.normalise")
     def normalise(self, scores):
         """
         Normalise the scores of all members based on the median raw score of all members.
+        The raw scores of the active members are grouped in up to 10 levels by self.normaliser,
+        or from the centres of the previous run when there is a centre store.
         """
 
         # Getting a list of members who have 0 engagement
@@ -174,22 +294,17 @@ class MembersScore:
         if len(active_members_scores) == 0:
             return active_members_scores
 
-        # Initialize the k means cluster
+        # Number of levels
         if len(active_members_raw_scores) < 10:
             k = len(active_members_raw_scores)
         else:
             k = 10
-        kmeans = KMeans(n_clusters=k, random_state=0)
-        # Fit predict on our scores
-        normalized_scores = kmeans.fit_predict(np.array(active_members_raw_scores).reshape(-1, 1))
-
-        ord_idx = np.argsort(kmeans.cluster_centers_.flatten())
-
-        cntrs = np.zeros_like(normalized_scores) - 1
-        for i in np.arange(k):
-            cntrs[normalized_scores == ord_idx[i]] = i
-
-        normalized_scores = cntrs
+        normaliser = self.normaliser
+        if self.centre_store is not None:
+            normaliser = WarmStartNormaliser(self.centre_store.load(self.tenant_id), fallback=self.normaliser)
+        normalized_scores, self.centres = normaliser.fit(np.array(active_members_raw_scores, dtype=float), k)
+        if self.centre_store is not None:
+            self.centre_store.save(self.tenant_id, self.centres)
 
         # Assigning inactive member engagement level
         for key in inactive_members:
@@ -202,10 +317,14 @@ class MembersScore:
             i += 1
         return scores
 
+    @traced("members_score.main")
     def main(self):
         # Keeping track of time for lambda timeout
         start = time.time()
-        members = self.repository.find_all(Member, query={})
+        current_span().set_attributes(tenant=str(self.tenant_id), service="members_score")
+        with span("members_score.find_members") as find_span:
+            members = self.repository.find_all(Member, query={})
+            find_span.set_attribute("rows", len(members))
 
         for member in members:
             self.original_scores[member.id] = member.score
@@ -218,18 +337,20 @@ class MembersScore:
 
         scores_to_update = self.normalise(self.scores)
 
-        changed = 0
-
-        members_controller = MembersController(self.tenant_id, repository=self.repository)
-
-        for n, member_id in enumerate(scores_to_update):
-            if time.time() - start > 800:
-                break
-            # We only update the score if it has changed
-            if scores_to_update[member_id] != self.original_scores.get(member_id, -2):
-                changed += 1
-                members_controller.update(
-                    [{"id": str(member_id), "update": {dbk.SCORE: scores_to_update[member_id]}}], send=self.send
-                )
+        # We only update the score if it has changed
+        changed = [
+            member_id
+            for member_id in scores_to_update
+            if scores_to_update[member_id] != self.original_scores.get(member_id, -2)
+        ]
+        checkpoint = PublishCheckpoint(
+            changed,
+            [scores_to_update[member_id] for member_id in changed],
+            members=len(scores_to_update),
+        )
+        with span("members_score.publish", rows=len(changed)):
+            self.resume_token = publish_with_checkpoint(
+                self.tenant_id, checkpoint, self.checkpoint_store, self.repository, start + TIME_BUDGET, self.send
+            )
 
         return scores_to_update
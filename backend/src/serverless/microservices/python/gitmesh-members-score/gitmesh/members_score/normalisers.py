@@ -0,0 +1,461 @@
+"""
+Normalisers of the raw members scores into engagement levels.
+
+A normaliser splits the raw scores of the active members in at most k groups, ordered by score.
+MembersScore.normalise turns the groups into the levels 1 to k.
+"""
+import io
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from gitmesh.backend.infrastructure.config import MEMBERS_SCORE_NORMALISER
+from gitmesh.members_score.states import FileStateBackend
+
+
+class Normaliser(object):
+    """
+    Interface of the normalisers.
+    """
+
+    def fit(self, values, k):
+        """
+        Group values
+
+        Args:
+            values (np.ndarray): the raw scores, 1-D
+            k (int): the maximum number of groups
+
+        Returns:
+            (np.ndarray, np.ndarray): the group of every value, 0 for the lowest scores, and the sorted centre
+                                      (mean score) of every group
+        """
+        raise NotImplementedError
+
+
+def _centres(values, labels):
+    return np.bincount(labels, weights=values) / np.bincount(labels)
+
+
+class KMeansNormaliser(Normaliser):
+    """
+    sklearn k-means, a local optimum that depends on the random initialisation of the centres.
+    """
+
+    def __init__(self, random_state=0):
+        self.random_state = random_state
+
+    def fit(self, values, k):
+        kmeans = KMeans(n_clusters=k, random_state=self.random_state)
+        labels = kmeans.fit_predict(values.reshape(-1, 1))
+
+        # Relabel the clusters in the order of their centres
+        order = np.argsort(kmeans.cluster_centers_.flatten())
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        return ranks[labels], kmeans.cluster_centers_.flatten()[order]
+
+
+def _prefix_sums(values):
+    """
+    Prefix sums of the sorted distinct values, centred for precision
+
+    Returns:
+        (np.ndarray, np.ndarray, float, np.ndarray, np.ndarray, np.ndarray): index of every value in the distinct values,
+            the centred distinct values, their offset, and the prefix sums of their counts, sums and sums of squares,
+            with a leading 0
+    """
+    distinct, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    offset = distinct.mean()
+    x = distinct - offset
+    weights = np.concatenate(([0], np.cumsum(counts, dtype=float)))
+    sums = np.concatenate(([0], np.cumsum(counts * x)))
+    squares = np.concatenate(([0], np.cumsum(counts * x * x)))
+    return inverse.reshape(-1), x, offset, weights, sums, squares
+
+
+def _labels(starts, n, inverse):
+    """
+    Cluster of every value, from the index of the first distinct value of every cluster
+    """
+    distinct_labels = np.zeros(n, dtype=np.int64)
+    distinct_labels[starts[1:]] = 1
+    return np.cumsum(distinct_labels)[inverse]
+
+
+def _group_starts(x, weights, size):
+    """
+    Split sorted points in up to 2 * size groups of consecutive points, both by weight, for the dense low scores,
+    and by width, for the sparse high ones.
+
+    Args:
+        x (np.ndarray): the sorted points
+        weights (np.ndarray): prefix sums of their weights, with a leading 0
+        size (int): the number of groups of each split
+
+    Returns:
+        np.ndarray: the index of the first point of every group
+    """
+    return np.union1d(
+        np.searchsorted(weights[1:], np.arange(size) * weights[-1] / size, side="right"),
+        np.searchsorted(x, np.linspace(x[0], x[-1], size + 1)[1:-1]),
+    )
+
+
+def _lloyd(x, weights, sums, starts, max_iterations, tolerance=0):
+    """
+    Lloyd iterations on sorted values: every boundary moves to the midpoint of the centres around it
+
+    Args:
+        x (np.ndarray): the sorted distinct values
+        weights (np.ndarray): prefix sums of their counts
+        sums (np.ndarray): prefix sums of the values
+        starts (np.ndarray): index of the first distinct value of every cluster
+        max_iterations (int): maximum number of iterations
+        tolerance (float, optional): the iterations stop once no centre moves by more. Defaults to 0.
+
+    Returns:
+        (np.ndarray, int): the starts of the clusters and the number of iterations
+    """
+    centres = None
+    for iteration in range(1, max_iterations + 1):
+        bounds = np.append(starts, len(x))
+        moved_centres = (sums[bounds[1:]] - sums[bounds[:-1]]) / (weights[bounds[1:]] - weights[bounds[:-1]])
+        if centres is not None and np.abs(moved_centres - centres).max() <= tolerance:
+            break
+        centres = moved_centres
+        moved = np.concatenate(([0], np.searchsorted(x, (centres[:-1] + centres[1:]) / 2, side="right")))
+        if np.array_equal(moved, starts):
+            break
+        if np.any(np.diff(np.append(moved, len(x))) <= 0):
+            # A cluster would be emptied, keep the last partition
+            break
+        starts = moved
+    return starts, iteration
+
+
+def _optimal_starts(weights, sums, squares, k):
+    """
+    Optimal partition of weighted sorted points in k contiguous clusters, by dynamic programming.
+    The optimal start of the last cluster is monotone in its end, which lets every row of the programme be solved
+    by divide and conquer, vectorised over all the sub-problems of a level.
+
+    Args:
+        weights (np.ndarray): prefix sums of the weights of the points, with a leading 0
+        sums (np.ndarray): prefix sums of the weighted values
+        squares (np.ndarray): prefix sums of the weighted squared values
+        k (int): the number of clusters, at most the number of points
+
+    Returns:
+        np.ndarray: the index of the first point of every cluster
+    """
+    n = len(weights) - 1
+
+    def cost(start, end):
+        """Sum of squares of the cluster of the points start to end, inclusive"""
+        w = weights[end + 1] - weights[start]
+        s = sums[end + 1] - sums[start]
+        return np.maximum(squares[end + 1] - squares[start] - s * s / w, 0)
+
+    previous = cost(np.zeros(n, dtype=np.int64), np.arange(n))
+    starts = np.zeros((k, n), dtype=np.int64)
+
+    for cluster in range(1, k):
+        current = np.full(n, np.inf)
+        # Sub-problems: ends lo to hi, whose best starts are between start_lo and start_hi
+        lo, hi = np.array([cluster]), np.array([n - 1])
+        start_lo, start_hi = np.array([cluster]), np.array([n - 1])
+        while len(lo):
+            mid = (lo + hi) // 2
+            lengths = np.minimum(start_hi, mid) - start_lo + 1
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            problem = np.repeat(np.arange(len(mid)), lengths)
+            candidate = start_lo[problem] + np.arange(len(problem)) - offsets[problem]
+            scores = previous[candidate - 1] + cost(candidate, mid[problem])
+
+            # Smallest score of every sub-problem, ties go to the smallest start
+            best = np.minimum.reduceat(scores, offsets)
+            ties = np.flatnonzero(scores == best[problem])
+            best_start = candidate[ties[np.searchsorted(ties, offsets)]]
+            current[mid] = best
+            starts[cluster, mid] = best_start
+
+            left, right = lo <= mid - 1, mid + 1 <= hi
+            lo, hi, start_lo, start_hi = (
+                np.concatenate((lo[left], mid[right] + 1)),
+                np.concatenate((mid[left] - 1, hi[right])),
+                np.concatenate((start_lo[left], best_start[right])),
+                np.concatenate((best_start[left], start_hi[right])),
+            )
+        previous = current
+
+    # Walk the clusters back from the last one
+    result = np.empty(k, dtype=np.int64)
+    end = n - 1
+    for cluster in range(k - 1, -1, -1):
+        result[cluster] = starts[cluster, end]
+        end = result[cluster] - 1
+    return result
+
+
+class OptimalKMeansNormaliser(Normaliser):
+    """
+    Optimal 1-D k-means, like Ckmeans.1d.dp: in one dimension the optimal clusters are contiguous in the sorted
+    values, so dynamic programming over the sorted distinct values finds the partition with the smallest
+    within-cluster sum of squares.
+
+    Up to max_exact distinct values the partition is exact. Above, the programme runs on up to 2 * max_exact groups
+    of consecutive distinct values, and the partition is then refined with Lloyd iterations on the sorted values,
+    which only move the boundaries between clusters. Deterministic: equal values always share a cluster.
+    """
+
+    def __init__(self, max_exact=1024, max_iterations=100):
+        self.max_exact = max_exact
+        self.max_iterations = max_iterations
+
+    def fit(self, values, k):
+        inverse, x, _, weights, sums, squares = _prefix_sums(values)
+        n = len(x)
+        k = min(k, n)
+
+        if n <= self.max_exact:
+            starts = _optimal_starts(weights, sums, squares, k)
+        else:
+            # Groups of consecutive distinct values, their prefix sums are a subset of the prefix sums of the values
+            group_starts = _group_starts(x, np.arange(n + 1), self.max_exact)
+            bounds = np.append(group_starts, n)
+            starts = group_starts[_optimal_starts(weights[bounds], sums[bounds], squares[bounds], k)]
+            starts, _ = _lloyd(x, weights, sums, starts, self.max_iterations)
+
+        labels = _labels(starts, n, inverse)
+        return labels, _centres(values, labels)
+
+
+class WarmStartNormaliser(Normaliser):
+    """
+    k-means started from the centres of the previous run, so that the levels only move as much as the scores did.
+    Lloyd iterations stop once no centre moves by more than tolerance times the range of the scores.
+    Without usable previous centres, e.g. when the number of levels changed, the fallback normaliser is used.
+    """
+
+    def __init__(self, previous, fallback=None, tolerance=1e-4, max_iterations=100):
+        """
+        Initialise the normaliser.
+
+        Args:
+            previous (np.ndarray): the sorted centres of the previous run, or None
+            fallback (Normaliser, optional): normaliser of the cold starts. Defaults to OptimalKMeansNormaliser.
+            tolerance (float, optional): relative movement of the centres under which the iterations stop.
+            max_iterations (int, optional): maximum number of Lloyd iterations.
+        """
+        self.previous = previous
+        self.fallback = fallback if fallback is not None else OptimalKMeansNormaliser()
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        # Lloyd iterations of the last fit, None when it fell back to a cold start
+        self.iterations = None
+
+    def fit(self, values, k):
+        self.iterations = None
+        inverse, x, offset, weights, sums, _ = _prefix_sums(values)
+        n = len(x)
+        if self.previous is None or len(self.previous) != min(k, n):
+            return self.fallback.fit(values, k)
+
+        previous = np.asarray(self.previous, dtype=float) - offset
+        starts = np.concatenate(([0], np.searchsorted(x, (previous[:-1] + previous[1:]) / 2, side="right")))
+        if np.any(np.diff(np.append(starts, n)) <= 0):
+            # A previous cluster has no scores left
+            return self.fallback.fit(values, k)
+
+        starts, self.iterations = _lloyd(x, weights, sums, starts, self.max_iterations, self.tolerance * (x[-1] - x[0]))
+        labels = _labels(starts, n, inverse)
+        return labels, _centres(values, labels)
+
+
+class QuantileNormaliser(Normaliser):
+    """
+    Equal frequency bins: every level gets about the same number of members. Equal values always share a bin.
+    """
+
+    def fit(self, values, k):
+        edges = np.quantile(values, np.linspace(0, 1, k + 1)[1:-1])
+        _, labels = np.unique(np.searchsorted(edges, values, side="right"), return_inverse=True)
+        labels = labels.reshape(-1)
+        return labels, _centres(values, labels)
+
+
+class ScoreSketch(object):
+    """
+    Bounded summary of a stream of scores for the optimal normaliser: the count, sum and sum of squares of up to
+    size groups of consecutive scores. The moments of merged groups are exact, so the sum of squares of a partition
+    of the groups is exact too, and as long as the stream has at most size distinct scores the fit is the exact one.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.count = np.zeros(0)
+        self.sum = np.zeros(0)
+        self.squares = np.zeros(0)
+        self._buffer = []
+        self._buffered = 0
+
+    def update(self, values):
+        """
+        Add scores to the sketch
+
+        Args:
+            values (np.ndarray): the scores
+        """
+        values = np.asarray(values, dtype=float)
+        if len(values):
+            self._buffer.append(values)
+            self._buffered += len(values)
+            if self._buffered >= self.size:
+                self._compress()
+
+    def _compress(self):
+        values = np.concatenate(self._buffer) if self._buffer else np.zeros(0)
+        self._buffer, self._buffered = [], 0
+        if len(values) == 0:
+            return
+        distinct, counts = np.unique(values, return_counts=True)
+
+        count = np.concatenate((self.count, counts.astype(float)))
+        total = np.concatenate((self.sum, distinct * counts))
+        squares = np.concatenate((self.squares, distinct * distinct * counts))
+        means = total / count
+        order = np.argsort(means, kind="stable")
+        count, total, squares, means = count[order], total[order], squares[order], means[order]
+
+        # Merge the groups of equal means, then groups of consecutive means down to the size of the sketch
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(means)) + 1))
+        if len(starts) > self.size:
+            weights = np.concatenate(([0], np.cumsum(count[starts])))
+            starts = starts[_group_starts(means[starts], weights, self.size // 2)]
+        self.count = np.add.reduceat(count, starts)
+        self.sum = np.add.reduceat(total, starts)
+        self.squares = np.add.reduceat(squares, starts)
+
+    def fit(self, k, max_exact=1024, max_iterations=100):
+        """
+        Centres of the optimal partition of the scores in k clusters
+
+        Args:
+            k (int): the maximum number of clusters
+            max_exact (int, optional): groups of the sketch over which the partition is exact, see
+                                       OptimalKMeansNormaliser. Defaults to 1024.
+            max_iterations (int, optional): Lloyd iterations over the groups of the sketch. Defaults to 100.
+
+        Returns:
+            np.ndarray: the sorted centres, empty without scores
+        """
+        self._compress()
+        n = len(self.count)
+        if n == 0:
+            return np.zeros(0)
+        k = min(k, n)
+
+        # Prefix sums of the groups, centred for precision
+        offset = self.sum.sum() / self.count.sum()
+        x = self.sum / self.count - offset
+        weights = np.concatenate(([0], np.cumsum(self.count)))
+        sums = np.concatenate(([0], np.cumsum(self.sum - offset * self.count)))
+        squares = np.concatenate(([0], np.cumsum(self.squares - 2 * offset * self.sum + offset * offset * self.count)))
+
+        if n <= max_exact:
+            starts = _optimal_starts(weights, sums, squares, k)
+        else:
+            group_starts = _group_starts(x, weights, max_exact)
+            bounds = np.append(group_starts, n)
+            starts = group_starts[_optimal_starts(weights[bounds], sums[bounds], squares[bounds], k)]
+            starts, _ = _lloyd(x, weights, sums, starts, max_iterations)
+
+        bounds = np.append(starts, n)
+        return (sums[bounds[1:]] - sums[bounds[:-1]]) / (weights[bounds[1:]] - weights[bounds[:-1]]) + offset
+
+
+def nearest_levels(values, centres):
+    """
+    Level of every score: 0 for the scores of 0, else 1 + the index of the closest centre
+
+    Args:
+        values (np.ndarray): the raw scores
+        centres (np.ndarray): the sorted centres
+
+    Returns:
+        np.ndarray: the levels
+    """
+    if len(centres) == 0:
+        return np.zeros(len(values), dtype=np.int64)
+    # Scores above the midpoint of two centres are closer to the higher one
+    levels = np.searchsorted((centres[:-1] + centres[1:]) / 2, values, side="right") + 1
+    return np.where(values == 0, 0, levels)
+
+
+class CentreStore(object):
+    """
+    Interface of the persistence of the cluster centres of every tenant, that warm start the next run.
+    """
+
+    def load(self, tenant_id):
+        """
+        Returns:
+            np.ndarray: the sorted centres of the last run of the tenant, None if there are none
+        """
+        raise NotImplementedError
+
+    def save(self, tenant_id, centres):
+        raise NotImplementedError
+
+
+class StateCentreStore(CentreStore):
+    """
+    Centres stored as one NumPy array per tenant in a state backend, see states.
+    """
+
+    name = "centres.npy"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, tenant_id):
+        data = self.backend.load(tenant_id, self.name)
+        if data is None:
+            return None
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def save(self, tenant_id, centres):
+        data = io.BytesIO()
+        np.save(data, np.asarray(centres, dtype=float))
+        self.backend.save(tenant_id, self.name, data.getvalue())
+
+
+class FileCentreStore(StateCentreStore):
+    """
+    Centres stored as one NumPy file per tenant in a local directory, for a single worker.
+    """
+
+    def __init__(self, directory):
+        super().__init__(FileStateBackend(directory))
+
+
+NORMALISERS = {
+    "optimal": OptimalKMeansNormaliser,
+    "kmeans": KMeansNormaliser,
+    "quantile": QuantileNormaliser,
+}
+
+
+def normaliser_from_config():
+    """
+    The normaliser selected with MEMBERS_SCORE_NORMALISER
+
+    Returns:
+        Normaliser: the normaliser
+    """
+    if MEMBERS_SCORE_NORMALISER not in NORMALISERS:
+        raise ValueError(
+            f"Unknown members score normaliser {MEMBERS_SCORE_NORMALISER}, expected one of {list(NORMALISERS)}"
+        )
+    return NORMALISERS[MEMBERS_SCORE_NORMALISER]()
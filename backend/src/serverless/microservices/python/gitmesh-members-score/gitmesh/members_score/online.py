@@ -0,0 +1,521 @@
+"""
+Online members score.
+
+The monthly scores decay exponentially, by DECAY every 30 days, so the score of a member is
+    score(t) = closed * DECAY ** ((t - as_of) / 30) + open month score(t)
+where closed is the decayed sum of the scores of the months that are over. An activity only changes the
+aggregates of its month, so it is applied in O(1) and the score of the member is fresh right away.
+
+The levels are the clusters of the last batch run: a member gets the level of the closest cluster centre.
+The batch job keeps running periodically to recalibrate the centres, and the months leaving the window.
+Every batch run, streamed or not, saves a Calibration of its tenant: its centres and levels, and the closed score of
+every member. The calibrations are kept in a state backend shared by the workers, see states, so a scorer loads the
+last one of its tenant whatever the process that ran it, and seeds the open month from its activities. A scorer never
+runs a batch itself, so that the queue it consumes is not held up: until there is a calibration, or when it is older
+than MEMBERS_SCORE_ONLINE_RECALIBRATE, its activities are left to the next batch run.
+"""
+import io
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from dateutil import parser
+
+from gitmesh.backend.controllers import MembersController
+from gitmesh.backend.infrastructure.config import (
+    MEMBERS_SCORE_CALIBRATIONS_DIR,
+    MEMBERS_SCORE_ONLINE_RECALIBRATE,
+    MEMBERS_SCORE_ONLINE_REFRESH,
+    MEMBERS_SCORE_ONLINE_SCORERS,
+)
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.isolation import QueryClasses
+from gitmesh.backend.repository.keys import DBKeys as dbk
+from gitmesh.backend.repository.queries import register_query
+from gitmesh.members_score.aggregates import month_ordinal
+from gitmesh.members_score.scoring import (
+    DECAY,
+    bytes_id,
+    id_bytes,
+    mean_score_columns,
+    member_scores,
+    monthly_scores,
+)
+from gitmesh.members_score.states import state_backend_from_config
+
+logger = get_logger(__name__)
+
+# Score of the activities that do not set one, the default of the activities table
+DEFAULT_ACTIVITY_SCORE = 2
+
+# Activities of the open month, to seed its daily scores and the activities already counted
+OPEN_MONTH_ACTIVITIES = register_query(
+    "members_score_open_month_activities",
+    """select "memberId", date("timestamp"), score, platform, "sourceId"
+    from activities
+    where "tenantId" = :tenant_id and "timestamp" >= :start and "timestamp" < :end""",
+    types={"tenant_id": "uuid", "start": "date", "end": "date"},
+    query_class=QueryClasses.AGGREGATE,
+)
+
+MEMBER_IDENTITIES = register_query(
+    "members_score_member_identities",
+    """select platform, username, "memberId"
+    from "memberIdentities"
+    where "tenantId" = :tenant_id and username = ANY(:usernames)""",
+    types={"tenant_id": "uuid", "usernames": "text[]"},
+)
+
+
+class MemberState(object):
+    """
+    Decayed score of the closed months of a member, and the daily scores of their open month.
+    """
+
+    __slots__ = ("closed", "as_of", "month", "s", "s2", "daily", "seen")
+
+    def __init__(self, closed, as_of, month):
+        """
+        Initialise the state.
+
+        Args:
+            closed (float): score of the closed months on as_of
+            as_of (date): the day closed was computed
+            month (int): month ordinal (year * 12 + month - 1) of the open month
+        """
+        self.closed = closed
+        self.as_of = as_of
+        self.month = month
+        self.s = 0.0
+        self.s2 = 0.0
+        self.daily = {}
+        self.seen = set()
+
+    def add(self, day, score, key=None):
+        """
+        Add an activity of the open month
+
+        Args:
+            day (date): the day of the activity
+            score (float): its score
+            key (tuple, optional): (platform, sourceId) of the activity. Activities seen before are ignored.
+
+        Returns:
+            bool: whether the activity was added
+        """
+        if key is not None:
+            if key in self.seen:
+                return False
+            self.seen.add(key)
+
+        previous = self.daily.get(day, 0.0)
+        self.daily[day] = previous + score
+        self.s += score
+        self.s2 += 2 * previous * score + score * score
+        return True
+
+    def open_month_score(self, now):
+        """
+        Score of the open month, computed like the MEAN_SCORES rows are scored
+        """
+        if not self.daily:
+            return 0.0
+
+        month_start = date(self.month // 12, self.month % 12 + 1, 1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        days = (min(now.date() + timedelta(days=1), next_month) - month_start).days
+        mean = self.s / days
+        stddev = np.sqrt(max(self.s2 - self.s * self.s / days, 0) / (days - 1)) if days > 1 else 0.0
+        return float(
+            monthly_scores(
+                np.array([mean]), np.array([stddev]), np.array([month_start.month]), np.array([month_start.year]), now
+            )[0]
+        )
+
+    def score(self, now):
+        """
+        Raw score of the member at now
+        """
+        return self.closed * DECAY ** ((now.date() - self.as_of).days / 30) + self.open_month_score(now)
+
+    def roll(self, month, now):
+        """
+        Close the open month and open another one
+        """
+        self.closed = self.score(now)
+        self.as_of = now.date()
+        self.month = month
+        self.s = self.s2 = 0.0
+        self.daily = {}
+        self.seen = set()
+
+
+class Calibration(object):
+    """
+    What a batch run calibrates the online scorers of its tenant with: the levels it published, their centres,
+    and the decayed score of the closed months of every member. The months before the open month of as_of are closed.
+    """
+
+    def __init__(self, member_ids, closed, levels, team_members, centres, as_of, calibrated_at=None):
+        """
+        Initialise the calibration.
+
+        Args:
+            member_ids (iterable): the scored members, kept as 16 bytes each, see id_bytes
+            closed ([float]): score of the closed months of every member on as_of
+            levels ([int]): the level of every member
+            team_members (iterable): the team members, as 16 bytes each
+            centres (np.ndarray): the sorted centres of the levels, None if no member is active
+            as_of (date): the day of the batch run
+            calibrated_at (float, optional): time.time() of the batch run. Defaults to now.
+        """
+        self.member_ids = id_bytes(member_ids)
+        self.closed = np.asarray(closed, dtype=float)
+        self.levels = np.asarray(levels, dtype=np.int64)
+        self.team_members = id_bytes(team_members)
+        self.centres = np.zeros(0) if centres is None else np.asarray(centres, dtype=float)
+        self.as_of = as_of
+        self.calibrated_at = time.time() if calibrated_at is None else calibrated_at
+
+    @classmethod
+    def from_members_score(cls, members_score, levels=None, now=None):
+        """
+        The calibration of a batch run
+
+        Args:
+            members_score (MembersScore): the batch run, with its mean scores fetched
+            levels (dict, optional): {member id: level} it published. Defaults to normalising its raw scores.
+            now (datetime, optional): the current time. Defaults to datetime.now().
+
+        Returns:
+            Calibration: the calibration, None for the in database plan, which does not fetch the monthly rows
+        """
+        if members_score.mean_scores is None:
+            return None
+        now = now or datetime.now()
+        if levels is None:
+            levels = members_score.normalise(member_scores(members_score.mean_scores, members_score.team_members, now))
+
+        closed = {member_id: 0.0 for member_id in levels}
+        if members_score.mean_scores:
+            member_ids, summed_daily_score, stddev_daily_score, month, year = mean_score_columns(
+                members_score.mean_scores
+            )
+            scores = monthly_scores(summed_daily_score, stddev_daily_score, month, year, now)
+            is_closed = (year * 12 + month - 1) != month_ordinal(now.date())
+            for member_id, score, member_closed in zip(member_ids, scores.tolist(), is_closed.tolist()):
+                closed[member_id] = closed.get(member_id, 0.0) + (score if member_closed else 0.0)
+
+        return cls(
+            list(closed),
+            list(closed.values()),
+            [levels.get(member_id, 0) for member_id in closed],
+            members_score.team_members,
+            members_score.centres,
+            now.date(),
+        )
+
+
+class CalibrationStore(object):
+    """
+    The last calibration of every tenant, one NumPy archive per tenant in a state backend, see states.
+    """
+
+    name = "calibration.npz"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self, tenant_id):
+        """
+        Returns:
+            Calibration: the last calibration of the tenant, None if there is none
+        """
+        data = self.backend.load(tenant_id, self.name)
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            return Calibration(
+                archive["member_ids"],
+                archive["closed"],
+                archive["levels"],
+                archive["team_members"],
+                archive["centres"],
+                date.fromisoformat(str(archive["as_of"])),
+                float(archive["calibrated_at"]),
+            )
+
+    def save(self, tenant_id, calibration):
+        data = io.BytesIO()
+        np.savez_compressed(
+            data,
+            member_ids=calibration.member_ids,
+            closed=calibration.closed,
+            levels=calibration.levels,
+            team_members=calibration.team_members,
+            centres=calibration.centres,
+            as_of=np.array(calibration.as_of.isoformat()),
+            calibrated_at=np.array(calibration.calibrated_at),
+        )
+        self.backend.save(tenant_id, self.name, data.getvalue())
+
+
+def calibration_store_from_config():
+    """
+    The store of the calibrations in MEMBERS_SCORE_CALIBRATIONS_DIR, None if it is not set
+    """
+    backend = state_backend_from_config(MEMBERS_SCORE_CALIBRATIONS_DIR)
+    return CalibrationStore(backend) if backend is not None else None
+
+
+class OnlineScorer(object):
+    """
+    Keeps the raw scores of the members of a tenant up to date from their new activities,
+    and publishes the members whose level changed.
+    """
+
+    def __init__(self, tenant_id, repository=False, send=True, calibration_store=None):
+        self.tenant_id = tenant_id
+        self.repository = repository if repository else Repository(tenant_id=tenant_id)
+        self.send = send
+        # Where the batch runs of any process save their calibrations, see refresh
+        self.calibration_store = calibration_store
+        # time.time() of the last look at the calibration store
+        self.checked_at = None
+
+        self.states = {}
+        self.levels = {}
+        self.team_members = set()
+        self.centres = None
+        self.calibrated_at = None
+        # Activities of months before the open month of their member, left to the next recalibration
+        self.late = 0
+
+    @property
+    def calibrated(self):
+        """
+        Whether a batch run calibrated the scorer less than MEMBERS_SCORE_ONLINE_RECALIBRATE seconds ago
+        """
+        return self.calibrated_at is not None and time.time() - self.calibrated_at <= MEMBERS_SCORE_ONLINE_RECALIBRATE
+
+    def recalibrate(self, members_score, levels=None):
+        """
+        Reset the scores and levels to the ones of a batch run
+
+        Args:
+            members_score (MembersScore): the batch run, with its mean scores fetched
+            levels (dict, optional): {member id: level} it published. Defaults to normalising its raw scores.
+        """
+        self.calibrate(Calibration.from_members_score(members_score, levels))
+
+    def calibrate(self, calibration):
+        """
+        Reset the scores and levels to the ones of a calibration, and seed the open month from its activities
+
+        Args:
+            calibration (Calibration): the calibration of a batch run of the tenant
+        """
+        today = date.today()
+        open_month = month_ordinal(calibration.as_of)
+        member_ids = [bytes_id(member_id) for member_id in calibration.member_ids.tolist()]
+        self.team_members = {bytes_id(member_id) for member_id in calibration.team_members.tolist()}
+        self.levels = dict(zip(member_ids, calibration.levels.tolist()))
+        self.centres = calibration.centres
+        self.states = {
+            member_id: MemberState(closed, calibration.as_of, open_month)
+            for member_id, closed in zip(member_ids, calibration.closed.tolist())
+        }
+
+        start = calibration.as_of.replace(day=1)
+        for member_id, day, score, platform, source_id in self.repository.execute_query(
+            OPEN_MONTH_ACTIVITIES, tenant_id=self.tenant_id, start=start, end=today + timedelta(days=1)
+        ):
+            # The batch run counted every stored activity, only the upserts that follow are deduplicated
+            state = self.states.setdefault(member_id, MemberState(0.0, calibration.as_of, open_month))
+            state.add(day, float(score if score is not None else DEFAULT_ACTIVITY_SCORE))
+            state.seen.add((platform, source_id))
+
+        self.calibrated_at = calibration.calibrated_at
+        self.late = 0
+        logger.info(f"Recalibrated the online scores of tenant {self.tenant_id}: {len(self.states)} members")
+
+    def refresh(self):
+        """
+        Calibrate the scorer with the last calibration of the store, if it is newer than its own.
+        The store is read at most every MEMBERS_SCORE_ONLINE_REFRESH seconds.
+        """
+        now = time.time()
+        if self.calibration_store is None or (
+            self.checked_at is not None and now - self.checked_at < MEMBERS_SCORE_ONLINE_REFRESH
+        ):
+            return
+        self.checked_at = now
+
+        calibration = self.calibration_store.load(self.tenant_id)
+        if calibration is None or (self.calibrated_at is not None and calibration.calibrated_at <= self.calibrated_at):
+            return
+        if month_ordinal(calibration.as_of) != month_ordinal(date.today()):
+            # Its open month is over, the activities of the months since are left to the next batch run
+            logger.debug(f"The last calibration of tenant {self.tenant_id} is from another month, not loading it")
+            return
+        self.calibrate(calibration)
+
+    def level(self, raw):
+        """
+        Level of a raw score: 0 without engagement, else the level of the closest cluster centre of the last batch run
+        """
+        if raw == 0:
+            return 0
+        if self.centres is None or len(self.centres) == 0:
+            return 1
+        return int(np.argmin(np.abs(self.centres - raw))) + 1
+
+    def _member_ids(self, records):
+        """
+        Member ID of every record: its memberId, or the member of its platform username
+        """
+        usernames = {}
+        for n, record in enumerate(records):
+            member = record.get("member") or {}
+            if record.get("memberId") or member.get("id"):
+                continue
+            username = record.get("username") or member.get("username", {}).get(record.get("platform"))
+            # Member usernames are a name, a list of names or a list of identities per platform
+            if isinstance(username, list):
+                username = username[0] if username else None
+            if isinstance(username, dict):
+                username = username.get("username")
+            if username:
+                usernames[n] = (record.get("platform"), username)
+
+        identities = {}
+        if usernames:
+            identities = {
+                (platform, username): member_id
+                for platform, username, member_id in self.repository.execute_query(
+                    MEMBER_IDENTITIES,
+                    tenant_id=self.tenant_id,
+                    usernames=sorted({username for _, username in usernames.values()}),
+                )
+            }
+
+        member_ids = []
+        for n, record in enumerate(records):
+            member_id = record.get("memberId") or (record.get("member") or {}).get("id")
+            member_ids.append(member_id or identities.get(usernames.get(n)))
+        return member_ids
+
+    def consume(self, records):
+        """
+        Apply the activities of a members_score_online message, and publish the changed levels
+
+        Args:
+            records ([dict]): the activities, with timestamp, score, platform, sourceId and memberId or member
+
+        Returns:
+            dict: {member id: level} of the members whose level changed
+        """
+        self.refresh()
+        if not self.calibrated:
+            # The next batch run of the tenant scores them, and calibrates the scorer
+            logger.debug(f"Skipping {len(records)} activities of tenant {self.tenant_id}, waiting for a batch run")
+            return {}
+
+        now = datetime.now()
+        touched = set()
+        member_ids = {str(member_id): member_id for member_id in self.states}
+
+        for record, member_id in zip(records, self._member_ids(records)):
+            if member_id is None:
+                logger.debug(f"Skipping an activity of an unknown member: {record.get('sourceId')}")
+                continue
+            member_id = member_ids.get(str(member_id), member_id)
+            if member_id in self.team_members:
+                continue
+
+            timestamp = record["timestamp"]
+            if isinstance(timestamp, str):
+                timestamp = parser.parse(timestamp)
+            day = timestamp.date()
+            month = month_ordinal(day)
+            score = record.get("score")
+            score = float(score if score is not None else DEFAULT_ACTIVITY_SCORE)
+
+            state = self.states.get(member_id)
+            if state is None:
+                state = self.states[member_id] = MemberState(0.0, now.date(), month)
+            if month > state.month:
+                state.roll(month, now)
+            elif month < state.month:
+                self.late += 1
+                continue
+
+            if state.add(day, score, (record.get("platform"), record.get("sourceId"))):
+                touched.add(member_id)
+
+        changed = {}
+        for member_id in touched:
+            level = self.level(self.states[member_id].score(now))
+            if level != self.levels.get(member_id):
+                changed[member_id] = self.levels[member_id] = level
+
+        if changed:
+            MembersController(self.tenant_id, repository=self.repository).update(
+                [{"id": str(member_id), "update": {dbk.SCORE: level}} for member_id, level in changed.items()],
+                send=self.send,
+            )
+        return changed
+
+
+# Online scorers of the tenants this process received activities of, the least recently used first
+_scorers = OrderedDict()
+
+
+def online_scorer(tenant_id, repository=False, send=True):
+    """
+    The online scorer of a tenant, calibrated from the calibration store, see OnlineScorer.refresh.
+    Only the MEMBERS_SCORE_ONLINE_SCORERS most recently used scorers are kept.
+
+    Args:
+        tenant_id (str): the tenant ID
+        repository (Repository, optional): the repository of the tenant. Defaults to a new one.
+        send (bool, optional): whether level changes are sent. Defaults to True.
+
+    Returns:
+        OnlineScorer: the scorer
+    """
+    scorer = _scorers.pop(str(tenant_id), None)
+    if scorer is None:
+        scorer = OnlineScorer(tenant_id, repository, send, calibration_store_from_config())
+    _scorers[str(tenant_id)] = scorer
+    while len(_scorers) > MEMBERS_SCORE_ONLINE_SCORERS:
+        _scorers.popitem(last=False)
+    return scorer
+
+
+def has_online_scorer(tenant_id):
+    """
+    Whether this process has an online scorer for the tenant, that its batch runs calibrate
+    """
+    return str(tenant_id) in _scorers
+
+
+def calibrate_online_scorers(tenant_id, calibration, store=None):
+    """
+    Hand the calibration of a batch run to the online scorers: save it in the calibration store, where the scorers of
+    every process find it, and calibrate the scorer of this process right away, if it has one.
+
+    Args:
+        tenant_id (str): the tenant ID
+        calibration (Calibration): the calibration of the batch run. None does nothing.
+        store (CalibrationStore, optional): the calibration store
+    """
+    if calibration is None:
+        return
+    if store is not None:
+        store.save(tenant_id, calibration)
+    scorer = _scorers.get(str(tenant_id))
+    if scorer is not None:
+        scorer.calibrate(calibration)
@@ -0,0 +1,197 @@
+"""
+Vectorised members score.
+
+Computes the same scores as MembersScore.calculate_member_score summed per member,
+on column arrays of the mean scores rows instead of one row at a time.
+The lookalike scores are computed the same way, on the actions of all the members at once.
+"""
+import uuid
+from datetime import datetime
+
+import numpy as np
+from dateutil import parser
+
+# Weight of the monthly scores, see MembersScore.calculate_member_score
+K = 10
+# Number of months to take into account
+M = 13
+# Decay of a monthly score per 30 days of age
+DECAY = 0.9
+
+
+def id_bytes(member_ids):
+    """
+    Member ids as an array of 16 bytes strings, the compact form kept for many members
+
+    Args:
+        member_ids (iterable): UUIDs or their strings, or an array of id_bytes
+
+    Returns:
+        np.ndarray: the ids, dtype S16
+    """
+    if isinstance(member_ids, np.ndarray) and member_ids.dtype.kind == "S":
+        return member_ids.astype("S16", copy=False)
+    return np.array(
+        [
+            (member_id if isinstance(member_id, uuid.UUID) else uuid.UUID(str(member_id))).bytes
+            for member_id in member_ids
+        ],
+        dtype="S16",
+    )
+
+
+def bytes_id(member_id):
+    """
+    UUID of a member id of id_bytes
+    """
+    # NumPy drops the trailing null bytes of fixed size byte strings
+    return uuid.UUID(bytes=member_id.ljust(16, b"\0"))
+
+
+def mean_score_columns(mean_scores):
+    """
+    Columns of the mean scores rows
+
+    Args:
+        mean_scores (list): rows of the MEAN_SCORES query
+
+    Returns:
+        (list, np.ndarray, np.ndarray, np.ndarray, np.ndarray): member ids, mean daily score,
+            stddev of the daily score, month and year of every row
+    """
+    columns = list(zip(*mean_scores))
+    return (
+        list(columns[0]),
+        np.array(columns[2], dtype=float),
+        np.array(columns[4], dtype=float),
+        np.array(columns[5], dtype=int),
+        np.array(columns[6], dtype=int),
+    )
+
+
+def monthly_scores(summed_daily_score, stddev_daily_score, month, year, now=None):
+    """
+    Decayed score of every member-month
+
+    Args:
+        summed_daily_score (np.ndarray): mean daily score of the month
+        stddev_daily_score (np.ndarray): standard deviation of the daily score of the month
+        month (np.ndarray): month, 1 to 12
+        year (np.ndarray): year
+        now (datetime, optional): the current time. Defaults to datetime.now().
+
+    Returns:
+        np.ndarray: the scores
+    """
+    now = now or datetime.now()
+
+    # The current month is not over, its mean is scaled down by the part of it that has passed
+    summed_daily_score = np.where(month == now.month, summed_daily_score * (now.day / 30), summed_daily_score)
+    steadiness = summed_daily_score / (1 + stddev_daily_score)
+
+    # Age of the first day of the month, in 30 days months
+    month_start = ((year - 1970) * 12 + month - 1).astype("datetime64[M]").astype("datetime64[D]")
+    age = (np.datetime64(now.date(), "D") - month_start).astype(int) / 30
+
+    return (DECAY**age) * steadiness * (K / M)
+
+
+def member_scores(mean_scores, team_members, now=None):
+    """
+    Raw score of every member: the sum of their decayed monthly scores, -1 for team members
+
+    Args:
+        mean_scores (list): rows of the MEAN_SCORES query
+        team_members (iterable): ids of the team members
+        now (datetime, optional): the current time. Defaults to datetime.now().
+
+    Returns:
+        dict: {member id: raw score}, in the order the members first appear in mean_scores
+    """
+    if not mean_scores:
+        return {}
+
+    member_ids, summed_daily_score, stddev_daily_score, month, year = mean_score_columns(mean_scores)
+    scores = monthly_scores(summed_daily_score, stddev_daily_score, month, year, now)
+
+    # Intern the member ids into 0..n-1, in order of first appearance
+    index = {}
+    codes = np.fromiter(
+        (index.setdefault(member_id, len(index)) for member_id in member_ids), dtype=np.intp, count=len(member_ids)
+    )
+    totals = np.bincount(codes, weights=scores, minlength=len(index))
+
+    members = list(index)
+    team_members = set(team_members)
+    totals[np.fromiter((member_id in team_members for member_id in members), dtype=bool, count=len(members))] = -1
+
+    return dict(zip(members, totals.tolist()))
+
+
+def parse_timestamps(timestamps):
+    """
+    Parse ISO-8601 timestamps, dropping their timezone like parser.parse(timestamp).replace(tzinfo=None) does.
+    Dates and date-times with seconds, the format of the platforms, are parsed by NumPy all at once; fractions of
+    seconds are truncated. Other formats fall back to dateutil, one at a time.
+
+    Args:
+        timestamps ([str]): the timestamps
+
+    Returns:
+        np.ndarray: the timestamps as datetime64[s]
+    """
+    text = np.asarray(timestamps, dtype=str)
+    parsed = np.empty(len(text), dtype="datetime64[s]")
+    if len(text) == 0:
+        return parsed
+
+    # The first 19 characters are YYYY-MM-DDTHH:MM:SS, or YYYY-MM-DD followed by nothing
+    head = np.char.replace(text.astype("U19"), " ", "T")
+    chars = np.ascontiguousarray(head).view("U1").reshape(len(head), 19)
+    date = (chars[:, 4] == "-") & (chars[:, 7] == "-")
+    date_time = date & (chars[:, 10] == "T") & (chars[:, 13] == ":") & (chars[:, 16] == ":")
+    date_only = date & (np.char.str_len(text) == 10)
+
+    regular = date_time | date_only
+    parsed[regular] = head[regular].astype("datetime64[s]")
+    for n in np.flatnonzero(~regular):
+        parsed[n] = np.datetime64(parser.parse(text[n]).replace(tzinfo=None), "s")
+    return parsed
+
+
+def lookalike_scores(member_ids, action_members, timestamps, action_scores, emails, usernames, now=None):
+    """
+    Lookalike score of every member: the sum of the scores of their actions, decayed by DECAY every 30 full days,
+    times 4 when they have an email and a twitter username, 2.5 when they have one of them
+
+    Args:
+        member_ids (list): ids of the members
+        action_members (np.ndarray): index in member_ids of the member of every action
+        timestamps ([str] | np.ndarray): ISO-8601 timestamp of every action, or their parse_timestamps
+        action_scores (np.ndarray): score of every action
+        emails (list): emails of every member, a list or None
+        usernames (list): usernames of every member, a {platform: username} dict or None
+        now (datetime, optional): the current time. Defaults to datetime.now().
+
+    Returns:
+        dict: {member id: lookalike score rounded to 2 decimals}
+    """
+    now = np.datetime64(now or datetime.now(), "s")
+    if not isinstance(timestamps, np.ndarray) or timestamps.dtype.kind != "M":
+        timestamps = parse_timestamps(timestamps)
+
+    # Age in full days, like timedelta.days, over 30
+    age = ((now - timestamps.astype("datetime64[s]")) // np.timedelta64(1, "D")) / 30
+    totals = np.bincount(
+        np.asarray(action_members, dtype=np.intp),
+        weights=(DECAY**age) * np.asarray(action_scores, dtype=float),
+        minlength=len(member_ids),
+    )
+
+    email = np.fromiter((bool(member_emails) for member_emails in emails), dtype=bool, count=len(member_ids))
+    twitter = np.fromiter(
+        ("twitter" in (member_usernames or {}) for member_usernames in usernames), dtype=bool, count=len(member_ids)
+    )
+    totals = totals * np.where(email & twitter, 4, np.where(email | twitter, 2.5, 1))
+
+    return dict(zip(member_ids, np.round(totals, 2).tolist()))
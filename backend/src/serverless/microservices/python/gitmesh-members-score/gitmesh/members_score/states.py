@@ -0,0 +1,133 @@
+"""
+Persistence of the state the members score keeps between runs of a tenant: the monthly aggregates, the cluster
+centres, the publishing checkpoints and the calibrations of the online scorers.
+
+Every store serialises its state of a tenant to bytes, and keeps them in a StateBackend, selected with
+MEMBERS_SCORE_STATE_BACKEND:
+  - file writes them to a local directory. Only the worker that wrote them sees them, so it is single worker:
+    it is rejected when there are more PYTHON_WORKER_REPLICAS.
+  - s3 writes them to S3_MICROSERVICES_ASSETS_BUCKET, under a key prefix, so every replica sees the state written
+    by the others: the incremental updates, warm starts, resumed publishing and online scores do not depend on the
+    worker that took the message.
+"""
+import os
+
+from gitmesh.backend.infrastructure import S3
+from gitmesh.backend.infrastructure.config import (
+    MEMBERS_SCORE_STATE_BACKEND,
+    PYTHON_WORKER_REPLICAS,
+    S3_MICROSERVICES_ASSETS_BUCKET,
+)
+
+
+class StateBackend(object):
+    """
+    Interface of the storage of the serialised states, one per tenant and name.
+    """
+
+    def load(self, tenant_id, name):
+        """
+        Args:
+            tenant_id (str): the tenant ID
+            name (str): the name of the state of the tenant. Example: centres.npy
+
+        Returns:
+            bytes: the state, None if there is none
+        """
+        raise NotImplementedError
+
+    def save(self, tenant_id, name, data):
+        raise NotImplementedError
+
+    def delete(self, tenant_id, name):
+        raise NotImplementedError
+
+
+class FileStateBackend(StateBackend):
+    """
+    States stored as one file per tenant and name in a local directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, tenant_id, name):
+        return os.path.join(self.directory, f"{tenant_id}.{name}")
+
+    def load(self, tenant_id, name):
+        path = self._path(tenant_id, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def save(self, tenant_id, name, data):
+        # Write then rename, so that a crashed run never leaves a truncated file behind
+        path = self._path(tenant_id, name)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def delete(self, tenant_id, name):
+        path = self._path(tenant_id, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class S3StateBackend(StateBackend):
+    """
+    States stored as one object per tenant and name under a key prefix of an S3 bucket, shared by the workers.
+    S3 writes are atomic, a reader gets the previous object or the new one.
+    """
+
+    def __init__(self, prefix, s3=None):
+        """
+        Args:
+            prefix (str): the key prefix. Example: members-score/centres
+            s3 (S3, optional): the bucket. Defaults to S3_MICROSERVICES_ASSETS_BUCKET.
+        """
+        self.prefix = prefix.strip("/")
+        self.s3 = s3 if s3 is not None else S3(S3_MICROSERVICES_ASSETS_BUCKET)
+
+    def _key(self, tenant_id, name):
+        return f"{self.prefix}/{tenant_id}.{name}"
+
+    def load(self, tenant_id, name):
+        return self.s3.get(self._key(tenant_id, name))
+
+    def save(self, tenant_id, name, data):
+        self.s3.put(self._key(tenant_id, name), data)
+
+    def delete(self, tenant_id, name):
+        self.s3.delete(self._key(tenant_id, name))
+
+
+STATE_BACKENDS = {
+    "file": FileStateBackend,
+    "s3": S3StateBackend,
+}
+
+
+def state_backend_from_config(location):
+    """
+    The state backend selected with MEMBERS_SCORE_STATE_BACKEND
+
+    Args:
+        location (str): the setting of the store, a directory or a key prefix. Unset disables the store.
+
+    Returns:
+        StateBackend: the backend, None if location is not set
+    """
+    if not location:
+        return None
+    if MEMBERS_SCORE_STATE_BACKEND not in STATE_BACKENDS:
+        raise ValueError(
+            f"Unknown members score state backend {MEMBERS_SCORE_STATE_BACKEND}, expected one of {list(STATE_BACKENDS)}"
+        )
+    if MEMBERS_SCORE_STATE_BACKEND == "file" and PYTHON_WORKER_REPLICAS > 1:
+        raise ValueError(
+            f"The file members score state is local to a worker, it can not be shared by {PYTHON_WORKER_REPLICAS} "
+            f"replicas: use the s3 state backend"
+        )
+    return STATE_BACKENDS[MEMBERS_SCORE_STATE_BACKEND](location)
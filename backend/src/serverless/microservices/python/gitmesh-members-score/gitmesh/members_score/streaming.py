@@ -0,0 +1,208 @@
+"""
+Streaming members score, for tenants too large to hold their mean scores and members in memory.
+
+The mean scores are read over a server-side cursor, in chunks ordered by member, and folded into two compact
+arrays: the member ids, as 16 bytes each, and their raw score. The levels are fitted on a ScoreSketch of bounded
+size, and the current scores of the members are streamed the same way to publish the changed ones only.
+Memory is one chunk of rows, the sketch, and 32 bytes per member. Calibrating the online scorers keeps the score of
+the closed months of every member too, 8 more bytes per member.
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+
+from gitmesh.backend.infrastructure.config import MEMBERS_SCORE_CHUNK_SIZE
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import current_span, span, traced
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.queries import register_query
+from gitmesh.members_score.aggregates import month_ordinal
+from gitmesh.members_score.checkpoints import PublishCheckpoint, publish_with_checkpoint
+from gitmesh.members_score.members_score import DAYS, DEGRADED_DAYS, MEAN_SCORES, TIME_BUDGET
+from gitmesh.members_score.normalisers import ScoreSketch, nearest_levels
+from gitmesh.members_score.online import Calibration
+from gitmesh.members_score.scoring import id_bytes, mean_score_columns, monthly_scores
+
+logger = get_logger(__name__)
+
+MEMBER_SCORES = register_query(
+    "members_score_member_scores",
+    """select id, score from members where "tenantId" = CAST(:tenant_id as uuid) order by id""",
+    types={"tenant_id": "uuid"},
+)
+
+
+class StreamingMembersScore(object):
+    def __init__(
+        self,
+        tenant_id,
+        repository=False,
+        test=False,
+        send=True,
+        degraded=False,
+        chunk_size=None,
+        checkpoint_store=None,
+        calibrate=False,
+    ):
+        """
+        Initialise the streaming members score.
+
+        Args:
+            tenant_id (str): the tenant ID
+            repository (Repository, optional): the repository of the tenant. Defaults to a new one.
+            test (bool, optional): whether the new repository uses the test database. Defaults to False.
+            send (bool, optional): whether the changed scores are sent. Defaults to True.
+            degraded (bool, optional): score the degraded plan's window. Defaults to False.
+            chunk_size (int, optional): rows read and members published at a time. Defaults to MEMBERS_SCORE_CHUNK_SIZE.
+            checkpoint_store (CheckpointStore, optional): keeps the changed scores left when the time budget is spent
+            calibrate (bool, optional): whether main computes the calibration of the online scorers. Defaults to False.
+        """
+        self.tenant_id = tenant_id
+        self.degraded = degraded
+        self.days = DEGRADED_DAYS if degraded else DAYS
+        self.repository = repository if repository else Repository(tenant_id=self.tenant_id, test=test)
+        self.send = send
+        self.chunk_size = chunk_size or MEMBERS_SCORE_CHUNK_SIZE
+
+        self.team_members = id_bytes(self.repository.find_team_members_by_tenant([self.tenant_id])[self.tenant_id])
+        self.centres = None
+        self.checkpoint_store = checkpoint_store
+        # Token of the checkpoint of the scores left to publish by the last main, None if it published them all
+        self.resume_token = None
+        self.calibrate = calibrate
+        # Score of the closed months of every member, kept by raw_scores when calibrating
+        self.closed = None
+        # Calibration of the online scorers computed by the last main, see online.Calibration
+        self.calibration = None
+
+    @traced("members_score.streaming.raw_scores")
+    def raw_scores(self, sketch=None, now=None):
+        """
+        Raw score of every member, see MembersScore._member_scores_.
+        When calibrating, the score of the closed months of every member is kept in self.closed, in the same order.
+
+        Args:
+            sketch (ScoreSketch, optional): updated with the scores of the active members
+            now (datetime, optional): the current time. Defaults to datetime.now().
+
+        Returns:
+            (np.ndarray, np.ndarray): the ids of the members, sorted, and their raw scores
+        """
+        now = now or datetime.now()
+        open_month = month_ordinal(now.date())
+        ids, scores, closed = [], [], []
+        carry_id, carry_score, carry_closed = None, 0.0, 0.0
+
+        def flush(run_ids, run_scores, run_closed):
+            run_scores[np.isin(run_ids, self.team_members)] = -1
+            ids.append(run_ids)
+            scores.append(run_scores)
+            if self.calibrate:
+                closed.append(run_closed)
+            if sketch is not None:
+                sketch.update(run_scores[run_scores != 0])
+
+        for rows in self.repository.stream_query(
+            MEAN_SCORES, chunk_size=self.chunk_size, tenant_id=self.repository.tenant_id, days=self.days
+        ):
+            member_ids, summed_daily_score, stddev_daily_score, month, year = mean_score_columns(rows)
+            monthly = monthly_scores(summed_daily_score, stddev_daily_score, month, year, now)
+
+            # The rows are ordered by member, sum the runs of rows of the same member
+            chunk_ids = id_bytes(member_ids)
+            starts = np.concatenate(([0], np.flatnonzero(chunk_ids[1:] != chunk_ids[:-1]) + 1))
+            run_ids, run_scores = chunk_ids[starts], np.add.reduceat(monthly, starts)
+            run_closed = None
+            if self.calibrate:
+                run_closed = np.add.reduceat(np.where((year * 12 + month - 1) != open_month, monthly, 0.0), starts)
+
+            # The first member of the chunk may continue the last one of the previous chunk
+            if carry_id is not None:
+                if run_ids[0] == carry_id:
+                    run_scores[0] += carry_score
+                    if self.calibrate:
+                        run_closed[0] += carry_closed
+                else:
+                    flush(np.array([carry_id], dtype="S16"), np.array([carry_score]), np.array([carry_closed]))
+            flush(run_ids[:-1], run_scores[:-1], run_closed[:-1] if self.calibrate else None)
+            carry_id, carry_score = run_ids[-1], run_scores[-1]
+            carry_closed = run_closed[-1] if self.calibrate else 0.0
+
+        if carry_id is not None:
+            flush(np.array([carry_id], dtype="S16"), np.array([carry_score]), np.array([carry_closed]))
+
+        if not ids:
+            self.closed = np.zeros(0) if self.calibrate else None
+            return np.zeros(0, dtype="S16"), np.zeros(0)
+        self.closed = np.concatenate(closed) if self.calibrate else None
+        return np.concatenate(ids), np.concatenate(scores)
+
+    @traced("members_score.streaming.original_scores")
+    def original_scores(self, ids):
+        """
+        Current score of the members, streamed in the order of their ids
+
+        Args:
+            ids (np.ndarray): the sorted member ids
+
+        Returns:
+            np.ndarray: their scores, NaN for the members without one
+        """
+        original = np.full(len(ids), np.nan)
+        for rows in self.repository.stream_query(MEMBER_SCORES, chunk_size=self.chunk_size, tenant_id=self.tenant_id):
+            chunk_ids = id_bytes([row[0] for row in rows])
+            positions = np.minimum(np.searchsorted(ids, chunk_ids), max(len(ids) - 1, 0))
+            found = (ids[positions] == chunk_ids) if len(ids) else np.zeros(len(rows), dtype=bool)
+            original[positions[found]] = np.array([np.nan if row[1] is None else row[1] for row in rows], dtype=float)[
+                found
+            ]
+        return original
+
+    @traced("members_score.streaming.main")
+    def main(self):
+        """
+        Score the members and publish the changed scores
+
+        Returns:
+            dict: {"members": number of scored members, "changed": number of published scores}
+        """
+        # Keeping track of time for lambda timeout
+        start = time.time()
+        current_span().set_attributes(tenant=str(self.tenant_id), service="members_score")
+
+        now = datetime.now()
+        sketch = ScoreSketch()
+        ids, raw = self.raw_scores(sketch, now)
+        if len(ids) == 0:
+            return {"members": 0, "changed": 0}
+
+        self.centres = sketch.fit(10)
+        levels = nearest_levels(raw, self.centres)
+        del raw
+        # The degraded plan misses the older months, the online scores keep their last full calibration
+        if self.calibrate and not self.degraded:
+            self.calibration = Calibration(ids, self.closed, levels, self.team_members, self.centres, now.date())
+        self.closed = None
+
+        changed_positions = np.flatnonzero(levels != self.original_scores(ids))
+        checkpoint = PublishCheckpoint(
+            ids[changed_positions],
+            levels[changed_positions],
+            members=len(ids),
+        )
+        with span("members_score.publish", rows=len(changed_positions)):
+            self.resume_token = publish_with_checkpoint(
+                self.tenant_id,
+                checkpoint,
+                self.checkpoint_store,
+                self.repository,
+                start + TIME_BUDGET,
+                self.send,
+                self.chunk_size,
+            )
+
+        logger.info(
+            f"Streamed the scores of tenant {self.tenant_id}: {len(ids)} members, {len(changed_positions)} changed"
+        )
+        return {"members": len(ids), "changed": len(changed_positions)}
@@ -1,5 +1,35 @@
+import itertools
+import statistics
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from dateutil import parser
+from sqlalchemy import create_engine, text
+
 from gitmesh.backend.repository import Repository
-from gitmesh.members_score import MembersScore
+from gitmesh.members_score import MembersScore, members_score_batch, members_score_worker
+from gitmesh.members_score import batch, states
+from gitmesh.members_score.aggregates import FileAggregateStore, StateAggregateStore
+from gitmesh.members_score.checkpoints import FileCheckpointStore, resume_publishing
+from gitmesh.members_score.members_score import DEGRADED_DAYS
+from gitmesh.members_score.normalisers import (
+    FileCentreStore,
+    KMeansNormaliser,
+    OptimalKMeansNormaliser,
+    QuantileNormaliser,
+    ScoreSketch,
+    StateCentreStore,
+    WarmStartNormaliser,
+    nearest_levels,
+)
+from gitmesh.members_score import online
+from gitmesh.members_score.online import Calibration, OnlineScorer, has_online_scorer, online_scorer
+from gitmesh.members_score.scoring import bytes_id, lookalike_scores, member_scores
+from gitmesh.members_score.states import S3StateBackend, state_backend_from_config
+from gitmesh.members_score.streaming import StreamingMembersScore
 
 
 def test_calculate_member_score(api: "Repository"):
@@ -55,3 +85,567 @@ def test_check_specific_member_scores(api: "Repository"):
     assert updates_str["f97995cd-6400-49e9-84a6-6ef9f38ffbf6"] == 6
     assert updates_str["f2e355ed-3a45-4b63-b228-59ee7aeafe0c"] == 7
     assert updates_str["bc6665c0-203c-4d9c-b95f-07877df7f9be"] == 1
+
+
+def test_degraded_plan(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    members_score = MembersScore(api.tenant_id, api, send=False, degraded=True)
+
+    updates = members_score.main()
+
+    assert members_score.days == DEGRADED_DAYS
+    assert 0 < len(updates) <= 207
+
+
+def _microservice_id(api):
+    # The members score microservice of the tenant, primed in the find_by_id cache like the coordinator does
+    microservices = api.find_available_microservices("members_score")
+    return next(str(microservice.id) for microservice in microservices if str(microservice.tenantId) == api.tenant_id)
+
+
+def test_worker_requeues_with_degraded_plan(api: "Repository", mocker):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    mocker.patch("gitmesh.members_score.worker.Repository", return_value=api)
+    mocker.patch("gitmesh.members_score.worker.TIME_BUDGET", 0)
+    services_sqs = mocker.patch("gitmesh.members_score.worker.ServicesSQS")
+    microservice_id = _microservice_id(api)
+
+    members_score_worker(api.tenant_id, microservice_id)
+
+    services_sqs.return_value.send_message.assert_called_once_with(
+        api.tenant_id, microservice_id, "members_score", params={"degraded": True}
+    )
+    api.set_deadline(None)
+
+
+def test_batch_reports_timeouts(api: "Repository", mocker):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    mocker.patch("gitmesh.members_score.worker.Repository", return_value=api)
+    mocker.patch("gitmesh.members_score.worker.TIME_BUDGET", 0)
+    services_sqs = mocker.patch("gitmesh.members_score.worker.ServicesSQS")
+
+    # The batch job records the timeout as the failure of the tenant, instead of requeuing it
+    report = batch._score_tenant(api.tenant_id, _microservice_id(api), api.db_url, False)
+    assert report["members"] is None
+    assert "RepositoryTimeoutError" in report["error"]
+    services_sqs.assert_not_called()
+    api.set_deadline(None)
+
+
+def test_mean_scores_include_zero_days(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    members_score = MembersScore(api.tenant_id, api, send=False)
+
+    with api.engine.connect() as con:
+        last_day = con.execute("select now()::timestamp::date").scalar()
+        daily = con.execute(
+            f"""select "memberId", date("timestamp"), count(*), sum(score) from activities
+            where "tenantId" = '{api.tenant_id}' group by "memberId", date("timestamp")"""
+        ).fetchall()
+
+    # Every day of the window, with 0 on the days without activities
+    days = [last_day - timedelta(days=n) for n in range(members_score.days, -1, -1)]
+    activities = {(member_id, day): (count, score) for member_id, day, count, score in daily}
+
+    for member_id, mean_count, mean_score, stddev_count, stddev_score, month, year in members_score.mean_scores:
+        month_days = [day for day in days if (day.year, day.month) == (int(year), int(month))]
+        counts = [activities.get((member_id, day), (0, 0))[0] for day in month_days]
+        scores = [activities.get((member_id, day), (0, 0))[1] for day in month_days]
+        if not any(counts):
+            # Members only active outside of the window get a single zero row
+            assert date(int(year), int(month), 1) == last_day.replace(day=1)
+            continue
+
+        assert abs(float(mean_count) - statistics.mean(counts)) < 1e-9
+        assert abs(float(mean_score) - statistics.mean(scores)) < 1e-9
+        assert abs(float(stddev_count) - (statistics.stdev(counts) if len(counts) > 1 else 0)) < 1e-9
+        assert abs(float(stddev_score) - (statistics.stdev(scores) if len(scores) > 1 else 0)) < 1e-9
+
+
+def test_vectorised_scores_match_rows(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    members_score = MembersScore(api.tenant_id, api, send=False)
+
+    expected = {}
+    for i, row in enumerate(members_score.mean_scores):
+        if row[0] in members_score.team_members:
+            expected[row[0]] = -1
+        else:
+            expected[row[0]] = expected.get(row[0], 0) + members_score.calculate_member_score(i, row)
+
+    scores = members_score._member_scores_([])
+
+    assert list(scores) == list(expected)
+    assert all(abs(scores[member_id] - expected[member_id]) < 1e-9 for member_id in expected)
+
+
+def test_incremental_scores_match_full(api: "Repository", tmp_path):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    store = FileAggregateStore(str(tmp_path))
+    full = MembersScore(api.tenant_id, api, send=False)
+
+    def assert_same_rows(members_score):
+        assert [row[0] for row in members_score.mean_scores] == [row[0] for row in full.mean_scores]
+        for row, expected in zip(members_score.mean_scores, full.mean_scores):
+            assert all(abs(float(a) - float(b)) < 1e-9 for a, b in zip(row[1:], expected[1:]))
+        scores, expected = members_score._member_scores_([]), full._member_scores_([])
+        assert all(abs(scores[member_id] - expected[member_id]) < 1e-9 for member_id in expected)
+
+    # First run builds the aggregates
+    assert_same_rows(MembersScore(api.tenant_id, api, send=False, store=store))
+
+    # Later runs only aggregate the members with activities updated since the watermark
+    aggregates = store.load(api.tenant_id)
+    aggregates.watermark = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    aggregates.rows = {}
+    store.save(api.tenant_id, aggregates)
+    assert_same_rows(MembersScore(api.tenant_id, api, send=False, store=store))
+    assert_same_rows(MembersScore(api.tenant_id, api, send=False, store=store))
+
+    # A merge moves the activities of a member to the kept one without updating them, updates the kept member
+    # and deletes the merged one: cache the activities of the kept member as the ones of a deleted member
+    aggregates = store.load(api.tenant_id)
+    kept, merged = next(member_id for member_id, _ in aggregates.rows), uuid.uuid4()
+    aggregates.rows = {
+        (merged if member_id == kept else member_id, month): value
+        for (member_id, month), value in aggregates.rows.items()
+    }
+    aggregates.members.add(merged)
+    aggregates.watermark = datetime.now(timezone.utc)
+    store.save(api.tenant_id, aggregates)
+    with create_engine(api.db_url).begin() as con:
+        con.execute(text('update members set "updatedAt" = now() where id = :id'), {"id": kept})
+    assert_same_rows(MembersScore(api.tenant_id, api, send=False, store=store))
+    assert merged not in store.load(api.tenant_id).members
+
+
+class DictBucket(object):
+    """An S3 bucket in memory, shared by the state backends of the workers of a test"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    def put(self, key, body):
+        self.objects[key] = body
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+
+def test_aggregates_are_shared_by_the_workers(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    bucket = DictBucket()
+
+    # A worker builds the aggregates, another one updates them incrementally
+    MembersScore(api.tenant_id, api, send=False, store=StateAggregateStore(S3StateBackend("aggregates", bucket)))
+    assert list(bucket.objects) == [f"aggregates/{api.tenant_id}.npz"]
+    other = StateAggregateStore(S3StateBackend("aggregates", bucket))
+    aggregates = other.load(api.tenant_id)
+    assert aggregates is not None and aggregates.rows
+    assert other.load(str(uuid.uuid4())) is None
+
+
+def test_file_state_is_single_worker(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(states, "PYTHON_WORKER_REPLICAS", 1)
+    assert isinstance(state_backend_from_config(str(tmp_path)), states.FileStateBackend)
+    assert state_backend_from_config(None) is None
+
+    monkeypatch.setattr(states, "PYTHON_WORKER_REPLICAS", 2)
+    with pytest.raises(ValueError):
+        state_backend_from_config(str(tmp_path))
+    monkeypatch.setattr(states, "MEMBERS_SCORE_STATE_BACKEND", "s3")
+    assert isinstance(state_backend_from_config("aggregates"), S3StateBackend)
+
+
+def test_online_scores_match_batch(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    members_score = MembersScore(api.tenant_id, api, send=False)
+    scorer = OnlineScorer(api.tenant_id, api, send=False)
+    scorer.recalibrate(members_score)
+
+    now = datetime.now()
+    expected = member_scores(members_score.mean_scores, members_score.team_members, now)
+    for member_id, raw in expected.items():
+        if member_id not in scorer.team_members:
+            assert abs(scorer.states[member_id].score(now) - raw) < 1e-9
+            assert scorer.level(raw) == scorer.levels[member_id]
+
+
+def test_online_scorer_applies_activities(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    scorer = OnlineScorer(api.tenant_id, api, send=False)
+    scorer.recalibrate(MembersScore(api.tenant_id, api, send=False))
+
+    member_id = next(member_id for member_id in scorer.states if member_id not in scorer.team_members)
+    record = {
+        "memberId": str(member_id),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "score": 10,
+        "platform": "github",
+        "sourceId": "online-score-test",
+    }
+    before = scorer.states[member_id].score(datetime.now())
+
+    changed = scorer.consume([record])
+    after = scorer.states[member_id].score(datetime.now())
+    assert after > before
+    assert set(changed) <= {member_id}
+    assert scorer.levels[member_id] == scorer.level(after)
+
+    # Upserting the same activity again does not count it twice
+    assert scorer.consume([record]) == {}
+    assert scorer.states[member_id].score(datetime.now()) == after
+
+
+def test_online_scorers_wait_for_a_batch_run(api: "Repository", monkeypatch):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    monkeypatch.setattr(online, "_scorers", online.OrderedDict())
+    monkeypatch.setattr(online, "MEMBERS_SCORE_ONLINE_SCORERS", 2)
+
+    # A new scorer does not fetch the tenant, it leaves the activities to the batch run
+    scorer = online_scorer(api.tenant_id, api, send=False)
+    record = {"memberId": str(uuid.uuid4()), "timestamp": datetime.now(timezone.utc).isoformat(), "score": 10}
+    assert not scorer.calibrated
+    assert scorer.consume([record]) == {}
+    assert scorer.states == {}
+
+    # Only the most recently used scorers are kept
+    online_scorer(str(uuid.uuid4()), api, send=False)
+    assert online_scorer(api.tenant_id, api, send=False) is scorer
+    online_scorer(str(uuid.uuid4()), api, send=False)
+    assert has_online_scorer(api.tenant_id)
+    assert len(online._scorers) == 2
+
+
+def test_online_scorers_load_the_calibration_of_another_process(api: "Repository", monkeypatch, tmp_path):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    monkeypatch.setattr(online, "_scorers", online.OrderedDict())
+    monkeypatch.setattr(online, "MEMBERS_SCORE_CALIBRATIONS_DIR", str(tmp_path))
+
+    # The batch job scores the tenant in a process of its pool, which saves the calibration
+    reports = members_score_batch(tenants=[api.tenant_id], processes=1, db_url=api.db_url, send=False)
+    assert reports[0]["error"] is None
+    assert not has_online_scorer(api.tenant_id)
+
+    # The scorer of this process never ran the batch, it loads the calibration on its first message
+    scorer = online_scorer(api.tenant_id, api, send=False)
+    members_score = MembersScore(api.tenant_id, api, send=False)
+    now = datetime.now()
+    expected = member_scores(members_score.mean_scores, members_score.team_members, now)
+    member_id = next(member_id for member_id, raw in expected.items() if raw > 0)
+    record = {
+        "memberId": str(member_id),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "score": 10,
+        "platform": "github",
+        "sourceId": "online-calibration-test",
+    }
+    assert set(scorer.consume([record])) <= {uuid.UUID(str(member_id))}
+    assert scorer.calibrated
+
+    states = {str(member_id): state for member_id, state in scorer.states.items()}
+    after = states[str(member_id)].score(datetime.now())
+    assert after > expected[member_id]
+    assert scorer.levels[uuid.UUID(str(member_id))] == scorer.level(after)
+    # The other members have the scores of the batch run
+    assert all(
+        abs(states[str(other)].score(now) - raw) < 1e-9
+        for other, raw in expected.items()
+        if raw > 0 and other != member_id
+    )
+
+
+def _sum_of_squares(values, labels):
+    return sum(((values[labels == label] - values[labels == label].mean()) ** 2).sum() for label in set(labels))
+
+
+def test_optimal_normaliser_is_optimal():
+
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        values = np.round(rng.pareto(1.5, 12), 1)
+        labels, centres = OptimalKMeansNormaliser().fit(values, 4)
+
+        # Every partition of the sorted distinct values in contiguous clusters
+        distinct = np.unique(values)
+        k = min(4, len(distinct))
+        best = min(
+            _sum_of_squares(values, np.searchsorted(distinct[list(cuts)], values, side="right"))
+            for cuts in itertools.combinations(range(1, len(distinct)), k - 1)
+        )
+        assert abs(_sum_of_squares(values, labels) - best) < 1e-9
+        assert list(np.sort(centres)) == list(centres)
+        assert all(len(set(labels[values == value])) == 1 for value in distinct)
+
+
+def test_normalisers_levels_are_comparable():
+
+    for seed in range(5):
+        # Skewed like the raw scores of the active members
+        values = np.round(np.random.default_rng(seed).lognormal(3, 1, 1000), 2)
+
+        optimal, _ = OptimalKMeansNormaliser().fit(values, 10)
+        kmeans, _ = KMeansNormaliser().fit(values, 10)
+        assert np.abs(optimal - kmeans).max() <= 1
+        assert _sum_of_squares(values, optimal) <= _sum_of_squares(values, kmeans) + 1e-9
+        assert np.array_equal(optimal, OptimalKMeansNormaliser().fit(values, 10)[0])
+
+        # Grouped values refined with Lloyd iterations stay close to the exact partition
+        grouped, _ = OptimalKMeansNormaliser(max_exact=16).fit(values, 10)
+        assert np.abs(grouped - optimal).max() <= 1
+        assert _sum_of_squares(values, grouped) <= 1.1 * _sum_of_squares(values, optimal)
+
+        quantiles, _ = QuantileNormaliser().fit(values, 10)
+        assert np.all(np.diff(quantiles[np.argsort(values)]) >= 0)
+        assert np.bincount(quantiles).max() <= 2 * len(values) / 10 + 1
+
+
+def test_score_sketch_fits_the_optimal_centres():
+
+    for seed in range(5):
+        rng = np.random.default_rng(seed)
+        # Fewer distinct scores than the size of the sketch: the fit is the exact one, whatever the chunks
+        values = np.round(rng.lognormal(3, 1, 5000))
+        labels, centres = OptimalKMeansNormaliser().fit(values, 10)
+        sketch = ScoreSketch(size=512)
+        for chunk in np.array_split(values, 37):
+            sketch.update(chunk)
+        assert np.allclose(sketch.fit(10), centres)
+        levels = nearest_levels(values, centres)
+        assert _sum_of_squares(values, levels) <= _sum_of_squares(values, labels) + 1e-6
+
+        # More distinct scores than its size: the groups of the sketch stay close to the exact partition
+        values = np.round(rng.lognormal(3, 1, 5000), 2)
+        labels, _ = OptimalKMeansNormaliser().fit(values, 10)
+        sketch = ScoreSketch(size=256)
+        for chunk in np.array_split(values, 37):
+            sketch.update(chunk)
+        levels = nearest_levels(values, sketch.fit(10))
+        assert _sum_of_squares(values, levels) <= 1.01 * _sum_of_squares(values, labels)
+
+    assert nearest_levels(np.array([0.0, 1.0, 4.0, 5.0, 9.0]), np.array([1.0, 8.0])).tolist() == [0, 1, 1, 2, 2]
+    assert nearest_levels(np.array([0.0, 1.0]), np.zeros(0)).tolist() == [0, 0]
+    assert len(ScoreSketch().fit(10)) == 0
+
+
+def test_lookalike_scores():
+
+    now = datetime.now()
+    formats = ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%f+02:00", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d %b %Y %H:%M"]
+    member_ids, emails, usernames = [], [], []
+    action_members, timestamps, action_scores = [], [], []
+    for n in range(40):
+        member_ids.append(f"member-{n}")
+        emails.append(["member@example.com"] if n % 2 else [])
+        usernames.append({"github": "member", **({"twitter": "member"} if n % 3 == 0 else {})})
+        for i in range(n % 7):
+            action_members.append(n)
+            timestamps.append((now - timedelta(days=7 * n + 3 * i, hours=i)).strftime(formats[i % 5]))
+            action_scores.append(1 + i % 4)
+
+    # The scores of the member by member implementation
+    totals = dict.fromkeys(member_ids, 0)
+    for member, timestamp, action_score in zip(action_members, timestamps, action_scores):
+        months = (now - parser.parse(timestamp).replace(tzinfo=None)).days / 30
+        totals[member_ids[member]] += (0.9**months) * action_score
+    expected = {}
+    for member_id, member_emails, member_usernames in zip(member_ids, emails, usernames):
+        twitter = "twitter" in member_usernames
+        if member_emails and twitter:
+            totals[member_id] *= 4
+        elif member_emails or twitter:
+            totals[member_id] *= 2.5
+        expected[member_id] = round(totals[member_id], 2)
+
+    scores = lookalike_scores(
+        member_ids, np.array(action_members), timestamps, np.array(action_scores), emails, usernames, now
+    )
+    assert scores == expected
+    assert lookalike_scores([], np.zeros(0), [], np.zeros(0), [], [], now) == {}
+
+
+def test_warm_start_normalise(api: "Repository", tmp_path):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    centre_store = FileCentreStore(str(tmp_path))
+
+    # The warm start converges to the optimal levels, see below
+    first = MembersScore(
+        api.tenant_id, api, send=False, centre_store=centre_store, normaliser=OptimalKMeansNormaliser()
+    )
+    first_levels = first.normalise(first._member_scores_([]))
+    assert np.array_equal(centre_store.load(api.tenant_id), first.centres)
+
+    # The same scores keep the same levels, and the warm start stops right away
+    second = MembersScore(api.tenant_id, api, send=False, centre_store=centre_store)
+    assert second.normalise(second._member_scores_([])) == first_levels
+
+    # The centres written by a worker warm start the runs of the others
+    bucket = DictBucket()
+    StateCentreStore(S3StateBackend("centres", bucket)).save(api.tenant_id, first.centres)
+    other_store = StateCentreStore(S3StateBackend("centres", bucket))
+    assert np.array_equal(other_store.load(api.tenant_id), first.centres)
+    third = MembersScore(api.tenant_id, api, send=False, centre_store=other_store)
+    assert third.normalise(third._member_scores_([])) == first_levels
+
+    values = np.array([score for score in first._member_scores_([]).values() if score != 0])
+    normaliser = WarmStartNormaliser(first.centres)
+    labels, _ = normaliser.fit(values, 10)
+    assert normaliser.iterations == 1
+    assert np.array_equal(labels, OptimalKMeansNormaliser().fit(values, 10)[0])
+
+    # Centres of another number of levels are not usable
+    normaliser = WarmStartNormaliser(first.centres[:3])
+    normaliser.fit(values, 10)
+    assert normaliser.iterations is None
+
+
+def test_streaming_scores_match(api: "Repository"):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    # The levels of the sketch are the exact 1-D k-means ones
+    members_score = MembersScore(api.tenant_id, api, send=False, normaliser=OptimalKMeansNormaliser())
+    scores = members_score._member_scores_([])
+    # normalise replaces the raw scores by the levels
+    levels = members_score.normalise(dict(scores))
+
+    # Small chunks, so that the rows of a member are split across chunks
+    streaming = StreamingMembersScore(api.tenant_id, api, send=False, chunk_size=7, calibrate=True)
+    ids, raw = streaming.raw_scores()
+    member_ids = [str(uuid.UUID(bytes=member_id.ljust(16, b"\0"))) for member_id in ids]
+    assert member_ids == sorted(str(member_id) for member_id in scores)
+
+    raw_by_member = dict(zip(member_ids, raw.tolist()))
+    assert all(abs(raw_by_member[str(member_id)] - score) < 1e-9 for member_id, score in scores.items())
+
+    result = streaming.main()
+    assert result["members"] == len(scores)
+    streamed_levels = dict(zip(member_ids, nearest_levels(raw, streaming.centres).tolist()))
+    assert {str(member_id): level for member_id, level in levels.items()} == streamed_levels
+
+    # The streamed calibration of the online scorers is the one of the batch run
+    calibration = streaming.calibration
+    expected = Calibration.from_members_score(members_score, levels)
+    closed = dict(zip(map(bytes_id, expected.member_ids.tolist()), expected.closed.tolist()))
+    assert [bytes_id(member_id) for member_id in calibration.member_ids.tolist()] == [
+        uuid.UUID(member_id) for member_id in member_ids
+    ]
+    assert all(
+        abs(closed[bytes_id(member_id)] - score) < 1e-9
+        for member_id, score in zip(calibration.member_ids.tolist(), calibration.closed.tolist())
+    )
+    assert calibration.levels.tolist() == list(streamed_levels.values())
+
+
+def test_batch_scores_match(api: "Repository"):
+
+    reports = members_score_batch(processes=2, db_url=api.db_url, send=False)
+    assert len(reports) == 3
+
+    for report in reports:
+        assert report["error"] is None
+        assert report["seconds"] >= 0
+        api.set_tenant_id(report["tenant_id"])
+        assert report["members"] == len(MembersScore(api.tenant_id, api, send=False).main())
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    reports = members_score_batch(tenants=[api.tenant_id], db_url=api.db_url, send=False)
+    assert [report["tenant_id"] for report in reports] == [api.tenant_id]
+
+
+def test_publishing_resumes_from_checkpoint(api: "Repository", mocker, tmp_path):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    checkpoint_store = FileCheckpointStore(str(tmp_path))
+
+    # No time left to publish: every changed score is checkpointed
+    mocker.patch("gitmesh.members_score.members_score.TIME_BUDGET", -1)
+    members_score = MembersScore(api.tenant_id, api, send=False, checkpoint_store=checkpoint_store)
+    levels = members_score.main()
+    token = members_score.resume_token
+    assert token is not None
+
+    checkpoint = checkpoint_store.load(api.tenant_id, token)
+    assert checkpoint.position == 0 and checkpoint.members == len(levels)
+    changed = {
+        member_id: level for member_id, level in levels.items() if level != members_score.original_scores.get(member_id)
+    }
+    assert 0 < len(checkpoint.member_ids) == len(changed)
+    assert checkpoint.member_ids.dtype == np.dtype("S16")
+    assert dict(zip(map(bytes_id, checkpoint.member_ids.tolist()), checkpoint.levels.tolist())) == {
+        uuid.UUID(str(member_id)): level for member_id, level in changed.items()
+    }
+    assert checkpoint_store.load(api.tenant_id, "another token") is None
+
+    # The next run publishes the rest, and drops the checkpoint
+    update = mocker.patch("gitmesh.members_score.checkpoints.MembersController.update")
+    checkpoint, next_token = resume_publishing(
+        api.tenant_id, token, checkpoint_store, time.time() + 60, api, send=False
+    )
+    assert next_token is None and checkpoint.done
+    assert update.call_count == len(changed)
+    assert checkpoint_store.load(api.tenant_id, token) is None
+
+
+def test_worker_requeues_with_resume_token(api: "Repository", mocker):
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
+    mocker.patch("gitmesh.members_score.worker.Repository", return_value=api)
+    # Every run gets its own backends, on a bucket shared like the one of the replicas
+    bucket = DictBucket()
+    mocker.patch("gitmesh.members_score.worker.MEMBERS_SCORE_CHECKPOINTS_DIR", "checkpoints")
+    mocker.patch(
+        "gitmesh.members_score.worker.state_backend_from_config",
+        side_effect=lambda location: S3StateBackend(location, bucket) if location else None,
+    )
+    services_sqs = mocker.patch("gitmesh.members_score.worker.ServicesSQS")
+
+    microservice_id = _microservice_id(api)
+
+    mocker.patch("gitmesh.members_score.members_score.TIME_BUDGET", -1)
+    members = members_score_worker(api.tenant_id, microservice_id, send=False)
+    params = services_sqs.return_value.send_message.call_args.kwargs["params"]
+    assert set(params) == {"resume"}
+    assert list(bucket.objects) == [f"checkpoints/{api.tenant_id}.checkpoint.npz"]
+
+    # The resumed run does not score the tenant again
+    mocker.patch("gitmesh.members_score.members_score.TIME_BUDGET", 800)
+    members_score = mocker.patch("gitmesh.members_score.worker.MembersScore")
+    assert members_score_worker(api.tenant_id, microservice_id, params, send=False) == members
+    members_score.assert_not_called()
+    services_sqs.return_value.send_message.assert_called_once()
+
+
+def test_in_database_scores_match(api: "Repository"):
+
+    for tenant_id in (
+        "f5c97d75-b919-4be6-9e57-b851efb336a1",
+        "f6ea695e-cd8d-437b-acaa-474c53d76b05",
+        "b044af41-657a-4925-9541-cf8dfbdc687b",
+    ):
+        api.set_tenant_id(tenant_id)
+        expected = MembersScore(api.tenant_id, api, send=False)._member_scores_([])
+        members_score = MembersScore(api.tenant_id, api, send=False, in_database=True)
+        assert members_score.mean_scores is None
+        assert len(members_score.raw_scores) == len(expected)
+
+        scores = members_score._member_scores_([])
+        assert list(scores) == list(expected)
+        assert all(abs(scores[member_id] - score) <= 1e-9 * max(1, abs(score)) for member_id, score in expected.items())
+
+    api.set_tenant_id("f5c97d75-b919-4be6-9e57-b851efb336a1")
@@ -1,5 +1,170 @@
-from gitmesh.members_score import MembersScore
+import time
 
+from gitmesh.backend.enums import Services
+from gitmesh.backend.infrastructure.config import (
+    MEMBERS_SCORE_AGGREGATES_DIR,
+    MEMBERS_SCORE_CENTRES_DIR,
+    MEMBERS_SCORE_CHECKPOINTS_DIR,
+    MEMBERS_SCORE_STREAMING_MEMBERS,
+)
+from gitmesh.backend.infrastructure import ServicesSQS
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import current_span, traced
+from gitmesh.backend.models import Member, Microservice, Tenant
+from gitmesh.backend.repository import Repository
+from gitmesh.backend.repository.errors import RepositoryTimeoutError
+from gitmesh.members_score.aggregates import StateAggregateStore
+from gitmesh.members_score.checkpoints import StateCheckpointStore, resume_publishing
+from gitmesh.members_score.members_score import MembersScore, TIME_BUDGET
+from gitmesh.members_score.normalisers import StateCentreStore
+from gitmesh.members_score.online import (
+    Calibration,
+    calibrate_online_scorers,
+    calibration_store_from_config,
+    has_online_scorer,
+    online_scorer,
+)
+from gitmesh.members_score.states import state_backend_from_config
+from gitmesh.members_score.streaming import StreamingMembersScore
 
-def members_score_worker(tenant_id):
-    MembersScore(tenant_id).main()
+logger = get_logger(__name__)
+
+
+@traced("members_score.worker")
+def members_score_worker(tenant_id, microservice_id=None, params=None, db_url=False, send=True, requeue=True):
+    """
+    Compute and publish the members score of a tenant, streamed for the tenants with many members.
+    If the database does not answer within the time budget, the tenant is requeued with the degraded plan.
+    If the changed scores are not all published within the time budget, the tenant is requeued with the token of
+    the checkpoint of the scores left, and the next run only publishes them.
+
+    Args:
+        tenant_id (str): the tenant ID
+        microservice_id (str, optional): the members score microservice of the tenant
+        params (dict, optional): params of the queue message. {"degraded": True} selects the degraded plan,
+                                 {"resume": token} publishes the scores left by a previous run.
+        db_url (str, optional): the database url. Defaults to the configured one.
+        send (bool, optional): whether the changed scores are sent. Defaults to True.
+        requeue (bool, optional): whether the tenant is requeued as above. Defaults to True. Without, the timeouts are
+                                  raised to the caller, and the scores left to publish wait for the next run.
+
+    Returns:
+        int: the number of scored members, None when the tenant was requeued with the degraded plan, or when the
+             tenant or its microservice was deleted
+
+    Raises:
+        RepositoryTimeoutError: when the database does not answer within the time budget, without requeue
+    """
+    start = time.time()
+    params = params or {}
+    degraded = params.get("degraded", False)
+    resume = params.get("resume")
+    params = {key: value for key, value in params.items() if key != "resume"}
+    current_span().set_attributes(
+        tenant=str(tenant_id), service="members_score", degraded=degraded, resume=bool(resume)
+    )
+
+    aggregates_backend = state_backend_from_config(MEMBERS_SCORE_AGGREGATES_DIR)
+    store = StateAggregateStore(aggregates_backend) if aggregates_backend else None
+    centres_backend = state_backend_from_config(MEMBERS_SCORE_CENTRES_DIR)
+    centre_store = StateCentreStore(centres_backend) if centres_backend else None
+    checkpoints_backend = state_backend_from_config(MEMBERS_SCORE_CHECKPOINTS_DIR)
+    checkpoint_store = StateCheckpointStore(checkpoints_backend) if checkpoints_backend else None
+    calibration_store = calibration_store_from_config()
+    # The degraded plan misses the older months, the online scores keep their last full calibration
+    calibrate = not degraded and (calibration_store is not None or has_online_scorer(tenant_id))
+
+    def requeue_resume(token):
+        if token is None:
+            return
+        if not requeue:
+            logger.info(f"Left the members_score checkpoint {token} of tenant {tenant_id} to the next run")
+            return
+        ServicesSQS().send_message(
+            tenant_id, microservice_id, Services.MEMBERS_SCORE.value, params={**params, "resume": token}
+        )
+
+    repository = Repository(tenant_id=tenant_id, db_url=db_url)
+    # Served by the find_by_id cache, which the coordinator primed with the microservices of this cycle
+    if repository.find_by_id(Tenant, tenant_id) is None or (
+        microservice_id and repository.find_by_id(Microservice, microservice_id) is None
+    ):
+        logger.info(f"Tenant {tenant_id} or its members_score microservice {microservice_id} was deleted, skipping it")
+        return None
+
+    repository.set_deadline(TIME_BUDGET)
+    try:
+        if resume and checkpoint_store is not None:
+            checkpoint, token = resume_publishing(
+                tenant_id, resume, checkpoint_store, start + TIME_BUDGET, repository, send
+            )
+            if checkpoint is not None:
+                requeue_resume(token)
+                return checkpoint.members
+            # A later run replaced the checkpoint, or it is lost: score the tenant again
+            logger.info(f"No members_score checkpoint {resume} for tenant {tenant_id}, scoring it again")
+
+        # The planner estimate of the large tenants, it does not read the members
+        if (
+            MEMBERS_SCORE_STREAMING_MEMBERS
+            and repository.count(Member, approximate=True) >= MEMBERS_SCORE_STREAMING_MEMBERS
+        ):
+            streaming = StreamingMembersScore(
+                tenant_id,
+                repository,
+                send=send,
+                degraded=degraded,
+                checkpoint_store=checkpoint_store,
+                calibrate=calibrate,
+            )
+            members = streaming.main()["members"]
+            requeue_resume(streaming.resume_token)
+            calibrate_online_scorers(tenant_id, streaming.calibration, calibration_store)
+            return members
+
+        members_score = MembersScore(
+            tenant_id,
+            repository,
+            send=send,
+            degraded=degraded,
+            store=store,
+            centre_store=centre_store,
+            checkpoint_store=checkpoint_store,
+            # The online scorers are calibrated from the monthly rows, which the in database plan does not fetch
+            in_database=False if calibrate else None,
+        )
+        levels = members_score.main()
+        requeue_resume(members_score.resume_token)
+        if calibrate:
+            calibrate_online_scorers(
+                tenant_id, Calibration.from_members_score(members_score, levels), calibration_store
+            )
+        return len(levels)
+    except RepositoryTimeoutError as e:
+        if not requeue:
+            raise
+        if degraded:
+            logger.error(f"members_score timed out for tenant {tenant_id} with the degraded plan: {e}")
+        else:
+            logger.warning(f"members_score timed out for tenant {tenant_id}, requeuing with the degraded plan: {e}")
+            ServicesSQS().send_message(
+                tenant_id, microservice_id, Services.MEMBERS_SCORE.value, params={**params, "degraded": True}
+            )
+    finally:
+        repository.log_query_stats()
+
+
+def online_score_worker(tenant_id, records):
+    """
+    Update the scores of the members of the activities upserted by the Node.js operations worker, which forwards
+    them in members_score_online messages, publishing the changed levels.
+
+    Args:
+        tenant_id (str): the tenant ID
+        records ([dict]): the activities of the message
+    """
+    try:
+        online_scorer(tenant_id).consume(records)
+    except RepositoryTimeoutError as e:
+        # The next batch run scores the activities anyway
+        logger.warning(f"online members_score timed out for tenant {tenant_id}: {e}")
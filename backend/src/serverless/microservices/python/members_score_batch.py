@@ -0,0 +1,15 @@
+"""
+Batch members score of all the tenants, as a job of its own: the python worker starts it when the members score
+coordinator runs with MEMBERS_SCORE_BATCH, and it can be scheduled on its own too.
+"""
+import sys
+
+from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.members_score import members_score_batch
+
+logger = get_logger(__name__)
+
+if __name__ == "__main__":
+    logger.info("Starting the members_score batch")
+    reports = members_score_batch()
+    sys.exit(1 if any(report["error"] is not None for report in reports) else 0)
@@ -1,11 +1,15 @@
 import json
+import os
+import subprocess
+import sys
 
 from gitmesh.backend.enums import Services
 from gitmesh.backend.infrastructure import SQS
-from gitmesh.backend.infrastructure.config import PYTHON_WORKER_QUEUE
+from gitmesh.backend.infrastructure.config import MEMBERS_SCORE_BATCH, PYTHON_WORKER_QUEUE
 from gitmesh.backend.infrastructure.logging import get_logger
+from gitmesh.backend.infrastructure.tracing import span
 from gitmesh.backend.utils.coordinator import base_coordinator
-from gitmesh.members_score import members_score_worker
+from gitmesh.members_score import members_score_worker, online_score_worker
 
 logger = get_logger(__name__)
 
@@ -13,6 +17,10 @@ sqs = SQS(PYTHON_WORKER_QUEUE)
 
 logger.info(f"Listening for messages on: {PYTHON_WORKER_QUEUE}")
 
+# The members score batch runs in a process of its own, so that it does not hold up the queue
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "members_score_batch.py")
+batch = None
+
 while True:
     msg = sqs.receive_message(delete=False, wait_time_seconds=15)
     if msg is not None:
@@ -26,15 +34,28 @@ while True:
         member = body.get('member', '')
         params = body.get('params', None)
 
-        if service == Services.MEMBERS_SCORE.value:
-            sqs.delete_message(msg_receipt)
-            logger.info("triggering members_score")
-            members_score_worker(tenant_id)
-
-        elif msg_type == Services.MEMBERS_SCORE.value:
-            sqs.delete_message(msg_receipt)
-            logger.info("triggering members_score coordinator")
-            base_coordinator(str(Services.MEMBERS_SCORE.value))
-
-        else:
-            logger.error(f"Error while processing a queue message! Unrecognized message format: {body}")
+        # Root span of the message, the traces are sampled here
+        with span("python_worker.message", service=service or msg_type, tenant=tenant_id):
+            if service == Services.MEMBERS_SCORE.value:
+                sqs.delete_message(msg_receipt)
+                logger.info("triggering members_score")
+                members_score_worker(tenant_id, microservice_id, params)
+
+            elif msg_type == Services.MEMBERS_SCORE.value:
+                sqs.delete_message(msg_receipt)
+                if MEMBERS_SCORE_BATCH:
+                    if batch is not None and batch.poll() is None:
+                        logger.info("members_score batch still running, skipping this one")
+                    else:
+                        logger.info("triggering members_score batch")
+                        batch = subprocess.Popen([sys.executable, "-u", BATCH_SCRIPT])
+                else:
+                    logger.info("triggering members_score coordinator")
+                    base_coordinator(str(Services.MEMBERS_SCORE.value))
+
+            elif msg_type == Services.MEMBERS_SCORE_ONLINE.value:
+                sqs.delete_message(msg_receipt)
+                online_score_worker(tenant_id, body.get('records', []))
+
+            else:
+                logger.error(f"Error while processing a queue message! Unrecognized message format: {body}")
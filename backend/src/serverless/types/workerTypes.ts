@@ -9,10 +9,12 @@ export enum NodeWorkerMessageType {
 
 export enum PythonWorkerMessageType {
   MEMBERS_SCORE = 'members_score',
+  MEMBERS_SCORE_ONLINE = 'members_score_online',
 }
 
 export interface PythonWorkerMessage {
   type: PythonWorkerMessageType
   member?: string
   tenant?: string
+  records?: any[]
 }